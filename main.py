@@ -1,5 +1,5 @@
 # main.py — AutoPanel (Master Shop + Connected Seller Bots) — FULL FEATURES
-# Railway-ready | python-telegram-bot==20.8 | SQLite
+# Railway-ready | python-telegram-bot==20.7 (pinned in requirements.txt) | SQLite
 #
 # =========================
 # ENV VARS (Railway Vars)
@@ -13,6 +13,14 @@
 # PLAN_B_PRICE            default 10  (White-label welcome)
 # PLAN_DAYS               default 30
 # MASTER_BOT_USERNAME     master bot username without @ (needed for seller-bot "Extend Subscription" deep-link)
+# WEBHOOK_URL             public https base URL; when set all bots use webhooks instead of long polling
+# WEBHOOK_LISTEN / WEBHOOK_PORT   local bind address for the webhook server (default 0.0.0.0:8080)
+# WEBHOOK_SECRET          path + header secret (random per boot if unset)
+# HTTP_POOL_SIZE / HTTP_PER_BOT   shared Bot API connection pool size / per-bot in-flight cap (128 / 8)
+# POLL_IDLE_AFTER / POLL_PARK_AFTER   seconds without updates before a seller bot polls as idle / parked
+# NAV_MODE                edit (default): catalog browsing edits one message in place | send: new message per step
+# STATE_FLUSH_SECONDS     how often in-progress flows (user_data) are written to SQLite (default 2)
+# OUTBOUND_RATE           per-bot Bot API send rate shared by replies, notifications and broadcasts (28/s)
 #
 # =========================
 # IMPORTANT RULES IMPLEMENTED
@@ -40,15 +48,23 @@
 #       ONLY welcome messages (seller shops) append "Bot made by @RekkoOwn" when branded or expired.
 #       No branding in menu messages.
 #
-import os, time, re, asyncio, sqlite3, logging, secrets, datetime, secrets
-from typing import Optional, Dict, Any, List, Tuple
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import os, time, re, json, heapq, asyncio, sqlite3, logging, secrets, datetime, threading, functools, queue
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple, Callable, Set
+
+import httpx
+import telegram
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler,
-    ContextTypes, filters
+    TypeHandler, ContextTypes, BaseRateLimiter, filters
 )
+from telegram.request import HTTPXRequest
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
@@ -88,6 +104,112 @@ def money(x: float) -> str:
         return str(int(round(x)))
     return f"{x:.2f}".rstrip("0").rstrip(".")
 
+class LRUCache:
+    """Thread-safe bounded dict with LRU eviction and hit/miss counters."""
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, int(maxsize))
+        self._d: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._d.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._d[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._d[key] = value
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._d.pop(key, default)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._d
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._d), "hits": self.hits, "misses": self.misses}
+
+_MISS = object()
+
+class SnapshotCache:
+    """Read-through cache of immutable per-key snapshots. Writers call invalidate(key) after
+    committing; a load that raced an invalidation (or a clear()) is returned but not cached.
+    Generations are only kept for keys with a load in flight, so the bookkeeping stays bounded."""
+    def __init__(self, maxsize: int, loader: Callable[[Any], Any]):
+        self.loader = loader
+        self._lru = LRUCache(maxsize)
+        self._gen: Dict[Any, List[int]] = {}  # key -> [loads in flight, generation]
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        hit = self._lru.get(key, _MISS)
+        if hit is not _MISS:
+            return hit
+        with self._lock:
+            slot = self._gen.setdefault(key, [0, 0])
+            slot[0] += 1
+            gen, epoch = slot[1], self._epoch
+        ok = False
+        try:
+            val = self.loader(key)
+            ok = True
+        finally:
+            with self._lock:
+                slot[0] -= 1
+                if ok and slot[1] == gen and self._epoch == epoch:
+                    self._lru.put(key, val)
+                if not slot[0]:
+                    del self._gen[key]
+        return val
+
+    def peek(self, key, default=None):
+        """Cached value or default; never calls the loader."""
+        return self._lru.get(key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self._lru
+
+    def invalidate(self, key):
+        with self._lock:
+            slot = self._gen.get(key)
+            if slot is not None:
+                slot[1] += 1
+            self._lru.pop(key)
+
+    def set(self, key, val):
+        """Store a value the caller just committed; loads already in flight will not overwrite it."""
+        with self._lock:
+            slot = self._gen.get(key)
+            if slot is not None:
+                slot[1] += 1
+            self._lru.put(key, val)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._lru.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self._lru.stats()
+
 
 # --- orders (Order ID + delivered keys) ---
 _ALPH = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
@@ -95,33 +217,6 @@ _ALPH = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
 def gen_order_id(n: int = 10) -> str:
     return "ORD-" + "".join(secrets.choice(_ALPH) for _ in range(int(n)))
 
-def create_order(shop_owner_id: int, user_id: int, product_id: int, product_name: str, qty: int, total: float, keys: List[str]) -> str:
-    """Create an order row and return order_id. Never raises (best-effort)."""
-    order_id = gen_order_id(10)
-    keys_text = "\n".join(keys or [])
-    conn = db(); cur = conn.cursor()
-    for _ in range(5):
-        try:
-            cur.execute(
-                "INSERT INTO orders(order_id,shop_owner_id,user_id,product_id,product_name,qty,total,keys_text,created_at) VALUES(?,?,?,?,?,?,?,?,?)",
-                (order_id, int(shop_owner_id), int(user_id), int(product_id), product_name, int(qty), float(total), keys_text, ts())
-            )
-            conn.commit(); conn.close()
-            return order_id
-        except sqlite3.IntegrityError:
-            order_id = gen_order_id(10)
-        except Exception:
-            try:
-                conn.close()
-            except Exception:
-                pass
-            return order_id
-    try:
-        conn.close()
-    except Exception:
-        pass
-    return order_id
-
 def list_orders(shop_owner_id: int, user_id: int, limit: int = 50) -> List[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
     cur.execute("SELECT * FROM orders WHERE shop_owner_id=? AND user_id=? ORDER BY created_at DESC LIMIT ?",
@@ -497,7 +592,9 @@ TRANSLATIONS = {'ar': {'ask_order_id': 'أرسل رقم الطلب:',
              'order_found': '✅ 已找到訂單：'}}
 
 def tr(uid: int, key: str, fallback: str = "") -> str:
-    lang = get_user_lang(uid)
+    return tr_lang(cached_user_lang(uid), key, fallback)
+
+def tr_lang(lang: str, key: str, fallback: str = "") -> str:
     # English can be overridden by Super Admin
     if lang == "en":
         ov = ui_get(key)
@@ -508,7 +605,12 @@ def tr(uid: int, key: str, fallback: str = "") -> str:
         return d[key]
     return (TRANSLATIONS.get("en") or {}).get(key, fallback or key)
 
-def get_user_lang(uid: int) -> str:
+# Language prefs and UI overrides are served from memory so tr() never does I/O: the
+# pre-handler in register_handlers warms the sender's language per update, and any other
+# miss (evicted, or a uid that is not the sender) renders in English while a DB thread fills it.
+LANG_CACHE_SIZE = int((os.getenv("LANG_CACHE_SIZE") or "50000").strip() or "50000")
+
+def _load_user_lang(uid: int) -> str:
     try:
         conn = db(); cur = conn.cursor()
         cur.execute("SELECT lang FROM user_prefs WHERE user_id=?", (int(uid),))
@@ -519,47 +621,74 @@ def get_user_lang(uid: int) -> str:
     except Exception:
         return "en"
 
+_LANG_CACHE = SnapshotCache(LANG_CACHE_SIZE, _load_user_lang)
+
+def get_user_lang(uid: int) -> str:
+    return _LANG_CACHE.get(int(uid))
+
+def user_lang_cached(uid: int) -> bool:
+    return int(uid) in _LANG_CACHE
+
+_LANG_FILLING: set = set()
+
+def _lang_filled(uid: int, _fut):
+    _LANG_FILLING.discard(uid)
+
+def cached_user_lang(uid: int) -> str:
+    uid = int(uid)
+    lang = _LANG_CACHE.peek(uid, _MISS)
+    if lang is not _MISS:
+        return lang
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return get_user_lang(uid)  # already off the event loop (DB thread / startup)
+    if uid not in _LANG_FILLING:
+        _LANG_FILLING.add(uid)
+        loop.run_in_executor(DB_EXECUTOR, get_user_lang, uid).add_done_callback(functools.partial(_lang_filled, uid))
+    return "en"
+
 def set_user_lang(uid: int, lang: str):
     lang = (lang or "en").strip()
     if lang not in SUPPORTED_LANGS:
         lang = "en"
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO user_prefs(user_id, lang) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET lang=excluded.lang",
-                (int(uid), lang))
-    conn.commit(); conn.close()
+    db_exec("INSERT INTO user_prefs(user_id, lang) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET lang=excluded.lang",
+            (int(uid), lang))
+    _LANG_CACHE.set(int(uid), lang)
 
 
 # ---------------- UI TEXT OVERRIDES (English only) ----------------
 # Super Admin can override English UI strings (buttons/prompts). Other languages still use TRANSLATIONS.
+# The whole table is held in memory as a read-only snapshot and reloaded after every change.
+_UI_TEXTS: MappingProxyType = MappingProxyType({})
+_UI_LOCK = threading.Lock()
 
-def ui_get(key: str) -> str:
-    key = (key or '').strip()
-    if not key:
-        return ''
-    try:
+def ui_reload():
+    global _UI_TEXTS
+    with _UI_LOCK:
         conn = db(); cur = conn.cursor()
-        cur.execute('SELECT value FROM ui_texts WHERE key=?', (key,))
-        r = cur.fetchone(); conn.close()
-        return (r['value'] if r else '') or ''
-    except Exception:
-        return ''
+        cur.execute('SELECT key, value FROM ui_texts')
+        rows = cur.fetchall(); conn.close()
+        _UI_TEXTS = MappingProxyType({r['key']: r['value'] or '' for r in rows})
+        _KB_CACHE.clear()
+
+def ui_get(key: str) -> str:
+    return _UI_TEXTS.get((key or '').strip(), '')
 
 def ui_set(key: str, value: str):
     key = (key or '').strip()
     if not key:
         return
-    conn = db(); cur = conn.cursor()
-    cur.execute('INSERT INTO ui_texts(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
-                (key, (value or '').strip()[:200]))
-    conn.commit(); conn.close()
+    db_exec('INSERT INTO ui_texts(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
+            (key, (value or '').strip()[:200]))
+    ui_reload()
 
 def ui_delete(key: str):
     key = (key or '').strip()
     if not key:
         return
-    conn = db(); cur = conn.cursor()
-    cur.execute('DELETE FROM ui_texts WHERE key=?', (key,))
-    conn.commit(); conn.close()
+    db_exec('DELETE FROM ui_texts WHERE key=?', (key,))
+    ui_reload()
 
 
 # ---------------- SAFE SEND HELPERS ----------------
@@ -620,25 +749,296 @@ async def on_error(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ---------------- DB ----------------
+# Connections are pooled: db() hands out an already-open, already-tuned connection and
+# conn.close() gives it back to the pool instead of closing it.
+DB_POOL_SIZE = int((os.getenv("DB_POOL_SIZE") or "16").strip() or "16")
+DB_BUSY_TIMEOUT_MS = int((os.getenv("DB_BUSY_TIMEOUT_MS") or "5000").strip() or "5000")
+DB_CACHE_KB = int((os.getenv("DB_CACHE_KB") or "16384").strip() or "16384")
+DB_MMAP_BYTES = int((os.getenv("DB_MMAP_BYTES") or str(256 * 1024 * 1024)).strip() or "0")
+DB_STMT_CACHE = int((os.getenv("DB_STMT_CACHE") or "256").strip() or "256")
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() returns it to its pool."""
+    pool: Optional["DBPool"] = None
+
+    def close(self):
+        pool = self.pool
+        if pool is None or not pool.release(self):
+            super().close()
+
+class DBPool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, int(size))
+        self._idle: List[PooledConnection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STMT_CACHE,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_KB)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_BYTES)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.pool = self
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, conn: PooledConnection) -> bool:
+        """Put conn back in the pool. Returns False if the caller should really close it."""
+        try:
+            if conn.in_transaction:
+                # helpers that bail out before commit() expect their writes to be discarded
+                conn.rollback()
+        except sqlite3.Error:
+            return False
+        with self._lock:
+            if any(c is conn for c in self._idle):
+                return True
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return True
+        return False
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.pool = None
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+DB_POOL = DBPool(DB_FILE, DB_POOL_SIZE)
+
 def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return DB_POOL.acquire()
+
+# All writes go through one writer thread (see DBWriter) instead of racing for SQLite's
+# write lock from every pooled connection. Write helpers queue a fn(cur) and block until
+# the batch holding it has committed.
+DB_GROUP_COMMIT_MS = float((os.getenv("DB_GROUP_COMMIT_MS") or "2").strip() or "2")
+DB_GROUP_MAX = int((os.getenv("DB_GROUP_MAX") or "256").strip() or "256")
+
+class DBWriter:
+    """Single writer: queued write fns are applied in one transaction per batch (group commit).
+    Each fn runs in its own SAVEPOINT, so a failing write only rolls back itself."""
+    def __init__(self, pool: DBPool, window_ms: float, max_batch: int):
+        self.pool = pool
+        self.window = max(0.0, float(window_ms)) / 1000
+        self.max_batch = max(1, int(max_batch))
+        self._q: "queue.Queue[Tuple[Callable[[sqlite3.Cursor], Any], Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._cur: Optional[sqlite3.Cursor] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, fn: Callable[[sqlite3.Cursor], Any]) -> Future:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        fut: Future = Future()
+        self._q.put((fn, fut))
+        return fut
+
+    def write(self, fn: Callable[[sqlite3.Cursor], Any]) -> Any:
+        if threading.current_thread() is self._thread:
+            # a write fn calling another write helper: it is already inside the batch
+            return fn(self._cur)
+        return self.submit(fn).result()
+
+    def _run(self):
+        conn = self.pool._open()
+        conn.pool = None
+        conn.isolation_level = None  # we issue BEGIN/SAVEPOINT/COMMIT ourselves
+        self._cur = conn.cursor()
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                left = deadline - time.monotonic()
+                try:
+                    batch.append(self._q.get(timeout=left) if left > 0 else self._q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(conn, batch)
+            except BaseException as e:
+                log.exception("DB writer batch failed")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    def _apply(self, conn: sqlite3.Connection, batch: List[Tuple[Callable[[sqlite3.Cursor], Any], Future]]):
+        cur = self._cur
+        done: List[Tuple[Future, Any]] = []
+        cur.execute("BEGIN IMMEDIATE")
+        for fn, fut in batch:
+            if not fut.set_running_or_notify_cancel():
+                continue
+            cur.execute("SAVEPOINT w")
+            try:
+                res = fn(cur)
+            except Exception as e:
+                if not conn.in_transaction:
+                    raise  # SQLite aborted the whole transaction; fail the batch
+                cur.execute("ROLLBACK TO w")
+                cur.execute("RELEASE w")
+                fut.set_exception(e)
+            else:
+                cur.execute("RELEASE w")
+                done.append((fut, res))
+        try:
+            cur.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                cur.execute("ROLLBACK")
+            raise
+        self.batches += 1
+        self.writes += len(done)
+        for fut, res in done:
+            fut.set_result(res)
+
+DB_WRITER = DBWriter(DB_POOL, DB_GROUP_COMMIT_MS, DB_GROUP_MAX)
+
+def db_write(fn: Callable[[sqlite3.Cursor], Any]) -> Any:
+    """Run fn(cur) on the writer thread; returns fn's result once its batch has committed."""
+    return DB_WRITER.write(fn)
+
+def db_exec(sql: str, params: Tuple = ()) -> int:
+    """Single write statement through the writer. Returns rowcount."""
+    return db_write(lambda cur: cur.execute(sql, params).rowcount)
 
+def db_insert(sql: str, params: Tuple = ()) -> int:
+    """Single INSERT through the writer. Returns lastrowid."""
+    return db_write(lambda cur: int(cur.execute(sql, params).lastrowid))
 
-def ensure_column(table: str, col: str, col_def_sql: str):
-    """Add a missing column safely (SQLite)."""
+# All bots share one event loop, so handlers never call the (blocking) helpers below
+# directly: they `await run_db(helper, ...)`, which runs the helper on a DB thread.
+# Write helpers park their thread until the group commit lands, so keep plenty of them.
+DB_THREADS = int((os.getenv("DB_THREADS") or "16").strip() or "16")
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, DB_THREADS), thread_name_prefix="db")
+
+async def run_db(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+# Strong references to fire-and-forget tasks: the loop only keeps weak ones, and a crash would otherwise go unnoticed.
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+def _background_done(task: asyncio.Task):
+    BACKGROUND_TASKS.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        log.error("Background task %s failed", task.get_name(), exc_info=exc)
+
+def spawn(coro, name: Optional[str] = None) -> asyncio.Task:
+    """create_task that keeps a reference until the task ends and logs its exception."""
+    task = asyncio.create_task(coro, name=name)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+async def cancel_background_tasks():
+    tasks = list(BACKGROUND_TASKS)
+    for t in tasks:
+        t.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+@contextmanager
+def db_tx():
+    """Yield a cursor inside BEGIN IMMEDIATE; commit on success, roll back if the block raises."""
     conn = db(); cur = conn.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = {r[1] for r in cur.fetchall()}
-    if col not in cols:
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col_def_sql}")
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        yield cur
         conn.commit()
-    conn.close()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-def init_db():
+
+# list_expired_seller_bots: driven by idx_seller_bots_enabled + sellers PK, so cost tracks enabled bots only
+_EXPIRED_SELLER_BOTS = """
+    SELECT b.seller_id FROM seller_bots b LEFT JOIN sellers s ON s.seller_id=b.seller_id
+    WHERE b.enabled=1 AND b.seller_id<>? AND (s.seller_id IS NULL OR s.banned_shop=1
+          OR COALESCE(s.restricted_until,0)>? OR COALESCE(s.sub_until,0)<=?)"""
+
+# catalog() snapshot loader: one shop-wide read per table, newest first
+_CATALOG_CATS = "SELECT * FROM categories WHERE shop_owner_id=? ORDER BY id DESC"
+_CATALOG_COCATS = "SELECT * FROM cocategories WHERE shop_owner_id=? ORDER BY id DESC"
+_CATALOG_PRODS = "SELECT * FROM products WHERE shop_owner_id=? ORDER BY id DESC"
+
+# Core queries checked at startup: a plan step that SCANs a table without an index (or sorts
+# into a temp b-tree) means that query will degrade linearly with table size.
+HOT_QUERIES: Dict[str, Tuple[str, Tuple]] = {
+    "stock_count": ("SELECT available_count FROM products WHERE shop_owner_id=? AND id=?", (0, 0)),
+    "purchase_claim": ("SELECT id FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0 ORDER BY id ASC LIMIT ?", (0, 0, 1)),
+    "list_product_keys": ("SELECT id, key_line FROM product_keys WHERE shop_owner_id=? AND product_id=? ORDER BY id ASC LIMIT ? OFFSET ?", (0, 0, 15, 0)),
+    "list_tx": ("SELECT * FROM transactions WHERE shop_owner_id=? AND user_id=? ORDER BY id DESC LIMIT ?", (0, 0, 30)),
+    "list_orders": ("SELECT * FROM orders WHERE shop_owner_id=? AND user_id=? ORDER BY created_at DESC LIMIT ?", (0, 0, 50)),
+    "get_open_ticket": ("SELECT id FROM tickets WHERE shop_owner_id=? AND user_id=? AND status='open' ORDER BY id DESC LIMIT 1", (0, 0)),
+    "catalog_cats": (_CATALOG_CATS, (0,)),
+    "catalog_cocats": (_CATALOG_COCATS, (0,)),
+    "catalog_prods": (_CATALOG_PRODS, (0,)),
+    "list_shop_user_ids": ("SELECT user_id FROM balances WHERE shop_owner_id=? ORDER BY rowid DESC LIMIT ?", (0, 80)),
+    "get_balance": ("SELECT balance FROM balances WHERE shop_owner_id=? AND user_id=?", (0, 0)),
+    "dep_methods_list": ("SELECT * FROM deposit_methods WHERE shop_owner_id=? AND enabled=1 ORDER BY sort_order ASC, id ASC", (0,)),
+    "list_enabled_seller_bots": ("SELECT * FROM seller_bots WHERE enabled=1", ()),
+    "expired_seller_bots": (_EXPIRED_SELLER_BOTS, (0, 0, 0)),
+}
+
+def explain_hot_queries() -> Dict[str, List[str]]:
+    """Log EXPLAIN QUERY PLAN for every HOT_QUERIES entry; warn on full table scans."""
+    plans: Dict[str, List[str]] = {}
     conn = db(); cur = conn.cursor()
+    for name, (sql, params) in HOT_QUERIES.items():
+        try:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            steps = [str(r[3]) for r in cur.fetchall()]
+        except sqlite3.Error as e:
+            log.warning("EXPLAIN %s failed: %s", name, e)
+            continue
+        plans[name] = steps
+        bad = [st for st in steps if (st.startswith("SCAN ") and " INDEX " not in st + " ") or "TEMP B-TREE" in st]
+        if bad:
+            log.warning("query plan %s: full scan/sort -> %s", name, " | ".join(steps))
+        else:
+            log.info("query plan %s: %s", name, " | ".join(steps))
+    conn.close()
+    return plans
+
+# ---------------- SCHEMA MIGRATIONS ----------------
+# Each step runs once, in order, inside its own BEGIN IMMEDIATE transaction, and records its
+# version in schema_version. Steps must stay idempotent (IF NOT EXISTS / _add_column) so a
+# pre-migration database can adopt them. Never edit a shipped step: append a new one.
+def _add_column(cur: sqlite3.Cursor, table: str, col: str, col_def_sql: str):
+    cur.execute(f"PRAGMA table_info({table})")
+    if col not in {r[1] for r in cur.fetchall()}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col_def_sql}")
 
+def _m001_base_schema(cur: sqlite3.Cursor):
     cur.execute("CREATE TABLE IF NOT EXISTS users(user_id INTEGER PRIMARY KEY, username TEXT DEFAULT '', first_name TEXT DEFAULT '', last_name TEXT DEFAULT '', last_seen INTEGER DEFAULT 0)")
     cur.execute("CREATE TABLE IF NOT EXISTS user_prefs(user_id INTEGER PRIMARY KEY, lang TEXT DEFAULT 'en')")
     cur.execute("CREATE TABLE IF NOT EXISTS ui_texts(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
@@ -679,26 +1079,12 @@ def init_db():
         connect_premium_title TEXT DEFAULT '',
         connect_premium_desc TEXT DEFAULT ''
     )""")
-    # migrate existing DBs (older shop_settings columns)
-    try:
-        cur.execute("ALTER TABLE shop_settings ADD COLUMN connect_free_title TEXT DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE shop_settings ADD COLUMN connect_free_desc TEXT DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE shop_settings ADD COLUMN connect_premium_title TEXT DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE shop_settings ADD COLUMN connect_premium_desc TEXT DEFAULT ''")
-    except Exception:
-        pass
+    # older DBs predate the Connect Bot columns
+    _add_column(cur, "shop_settings", "connect_free_title", "connect_free_title TEXT DEFAULT ''")
+    _add_column(cur, "shop_settings", "connect_free_desc", "connect_free_desc TEXT DEFAULT ''")
+    _add_column(cur, "shop_settings", "connect_premium_title", "connect_premium_title TEXT DEFAULT ''")
+    _add_column(cur, "shop_settings", "connect_premium_desc", "connect_premium_desc TEXT DEFAULT ''")
 
-
-    
     cur.execute("""
     CREATE TABLE IF NOT EXISTS payment_methods(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -784,7 +1170,6 @@ def init_db():
         admin_msg_id INTEGER DEFAULT 0
     )""")
 
-
     cur.execute("""
     CREATE TABLE IF NOT EXISTS deposit_methods(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -827,18 +1212,8 @@ def init_db():
         created_at INTEGER NOT NULL
     )""")
 
-    
-
-    # --- lightweight migrations ---
-    try:
-        cur.execute("ALTER TABLE deposit_requests ADD COLUMN method_id TEXT DEFAULT ''")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE deposit_requests ADD COLUMN method_name TEXT DEFAULT ''")
-    except Exception:
-        pass
-
+    _add_column(cur, "deposit_requests", "method_id", "method_id TEXT DEFAULT ''")
+    _add_column(cur, "deposit_requests", "method_name", "method_name TEXT DEFAULT ''")
 
     # --- Orders table (Order ID + delivered keys) ---
     cur.execute("""
@@ -853,17 +1228,126 @@ def init_db():
         keys_text TEXT DEFAULT '',
         created_at INTEGER NOT NULL
     )""")
-    # --- migrations (safe) ---
-    try:
-        ensure_column('ticket_messages', 'file_id', "file_id TEXT DEFAULT ''")
-        ensure_column('ticket_messages', 'file_type', "file_type TEXT DEFAULT ''")
-    except Exception:
-        pass
 
-    conn.commit(); conn.close()
+    _add_column(cur, "ticket_messages", "file_id", "file_id TEXT DEFAULT ''")
+    _add_column(cur, "ticket_messages", "file_type", "file_type TEXT DEFAULT ''")
+
+def _m002_indexes(cur: sqlite3.Cursor):
+    # one index per hot helper query (WHERE prefix + ORDER BY tail); frozen with the step,
+    # later indexes go into their own migration
+    for sql in (
+        # purchase key claim / reconcile_stock (covering for the COUNT)
+        "CREATE INDEX IF NOT EXISTS idx_product_keys_stock ON product_keys(shop_owner_id, product_id, delivered_once, id)",
+        # list_product_keys / count_product_keys (rowid tail keeps ORDER BY id free)
+        "CREATE INDEX IF NOT EXISTS idx_product_keys_product ON product_keys(shop_owner_id, product_id)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(shop_owner_id, user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(shop_owner_id, user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets(shop_owner_id, user_id, status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages(ticket_id)",
+        "CREATE INDEX IF NOT EXISTS idx_categories_shop ON categories(shop_owner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_cocategories_parent ON cocategories(shop_owner_id, category_id)",
+        "CREATE INDEX IF NOT EXISTS idx_products_parent ON products(shop_owner_id, category_id, cocategory_id)",
+        "CREATE INDEX IF NOT EXISTS idx_products_cocat ON products(shop_owner_id, cocategory_id)",
+        # list_shop_user_ids: newest shoppers first without sorting the whole shop
+        "CREATE INDEX IF NOT EXISTS idx_balances_shop ON balances(shop_owner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payment_methods_shop ON payment_methods(shop_owner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_deposit_methods_shop ON deposit_methods(shop_owner_id, enabled, sort_order)",
+        "CREATE INDEX IF NOT EXISTS idx_seller_bots_enabled ON seller_bots(enabled)",
+    ):
+        cur.execute(sql)
+
+def _m003_available_count(cur: sqlite3.Cursor):
+    _add_column(cur, "products", "available_count", "available_count INTEGER DEFAULT 0")
+    cur.execute("""UPDATE products SET available_count=(
+                       SELECT COUNT(1) FROM product_keys k
+                       WHERE k.shop_owner_id=products.shop_owner_id AND k.product_id=products.id AND k.delivered_once=0)""")
+
+def _m004_broadcast_jobs(cur: sqlite3.Cursor):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shop_owner_id INTEGER NOT NULL,
+        bot_key INTEGER NOT NULL,             -- MASTER_BOT_KEY or seller_id: the bot that sends
+        text TEXT DEFAULT '',
+        file_id TEXT DEFAULT '',
+        file_type TEXT DEFAULT '',
+        status TEXT DEFAULT 'running',        -- running/done/cancelled
+        last_user_id INTEGER DEFAULT 0,       -- recipient cursor (recipients go in user_id order)
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        chat_id INTEGER DEFAULT 0,            -- status message to edit with progress
+        message_id INTEGER DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+def _m005_user_state(cur: sqlite3.Cursor):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_state(
+        bot_key INTEGER NOT NULL,             -- MASTER_BOT_KEY or seller_id: each bot has its own user_data
+        user_id INTEGER NOT NULL,
+        data TEXT NOT NULL,                   -- JSON of the persisted user_data keys
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY(bot_key, user_id)
+    ) WITHOUT ROWID""")
+
+def _m006_catalog_indexes(cur: sqlite3.Cursor):
+    # catalog() loads a shop's cocategories/products newest first; the parent indexes above
+    # lead with category_id, so without these the ORDER BY id sorts in a temp b-tree
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cocategories_shop_id ON cocategories(shop_owner_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_shop_id ON products(shop_owner_id, id)")
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Cursor], None]]] = [
+    (1, "base schema", _m001_base_schema),
+    (2, "hot query indexes", _m002_indexes),
+    (3, "products.available_count", _m003_available_count),
+    (4, "broadcast_jobs", _m004_broadcast_jobs),
+    (5, "user_state", _m005_user_state),
+    (6, "catalog snapshot indexes", _m006_catalog_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(cur: sqlite3.Cursor) -> int:
+    cur.execute("SELECT COALESCE(MAX(version),0) FROM schema_version")
+    return int(cur.fetchone()[0])
+
+def migrate() -> int:
+    """Bring the DB up to SCHEMA_VERSION. Returns the number of steps applied."""
+    conn = db(); cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at INTEGER NOT NULL)")
+    conn.commit()
+    current = schema_version(cur)
+    conn.close()
+    applied = 0
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        t0 = time.monotonic()
+        try:
+            with db_tx() as cur:
+                # re-check under the write lock: another process may have got here first
+                if schema_version(cur) >= version:
+                    continue
+                step(cur)
+                cur.execute("INSERT INTO schema_version(version,name,applied_at) VALUES(?,?,?)", (version, name, ts()))
+        except Exception:
+            log.exception("Migration %s (%s) failed", version, name)
+            raise
+        applied += 1
+        log.info("Migration %s (%s) applied in %.2fs", version, name, time.monotonic() - t0)
+    return applied
+
+def init_db():
+    if migrate():
+        conn = db()
+        conn.execute("PRAGMA optimize")
+        conn.close()
+    explain_hot_queries()
+    ui_reload()
 
-    ensure_shop_settings(SUPER_ADMIN_ID)
-    s = dict(get_shop_settings(SUPER_ADMIN_ID))
+    s = get_shop_settings(SUPER_ADMIN_ID)
     if not (s["welcome_text"] or "").strip():
         set_shop_setting(SUPER_ADMIN_ID, "welcome_text",
             f"✅ Welcome to <b>{esc(STORE_NAME)}</b>\nGet your 24/7 Store Panel Here !!\n\nBot created by @RekkoOwn\nGroup : @AutoPanels"
@@ -884,28 +1368,38 @@ def init_db():
         set_shop_setting(SUPER_ADMIN_ID, "connect_premium_desc", "Remove branding and run White-Label.")
 
 # --- settings ---
-def ensure_shop_settings(shop_owner_id: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT 1 FROM shop_settings WHERE shop_owner_id=?", (shop_owner_id,))
-    if not cur.fetchone():
-        cur.execute("""INSERT INTO shop_settings(shop_owner_id,wallet_message,welcome_text,welcome_file_id,welcome_file_type,connect_desc,connect_free_title,connect_free_desc,connect_premium_title,connect_premium_desc)
-                       VALUES(?,?,?,?,?,?,?,?,?,?)""",
-                    (shop_owner_id, "", "", "", "", "", "", "", "", ""))
-        conn.commit()
-    conn.close()
+_SHOP_SETTINGS_INSERT = """INSERT OR IGNORE INTO shop_settings(shop_owner_id,wallet_message,welcome_text,welcome_file_id,welcome_file_type,connect_desc,connect_free_title,connect_free_desc,connect_premium_title,connect_premium_desc)
+                           VALUES(?,'','','','','','','','','')"""
+
+# Read paths never write: a shop without a settings row reads as all-empty, and the row is
+# created by the first set_shop_setting(). Reads are served from per-shop read-only snapshots.
+SHOP_SETTINGS_DEFAULTS: Dict[str, Any] = {
+    "wallet_message": "", "welcome_text": "", "welcome_file_id": "", "welcome_file_type": "",
+    "connect_desc": "", "connect_free_title": "", "connect_free_desc": "",
+    "connect_premium_title": "", "connect_premium_desc": "",
+}
 
-def get_shop_settings(shop_owner_id: int) -> sqlite3.Row:
-    ensure_shop_settings(shop_owner_id)
+SHOP_CACHE_SIZE = int((os.getenv("SHOP_CACHE_SIZE") or "4096").strip() or "4096")
+
+def _load_shop_settings(shop_owner_id: int) -> MappingProxyType:
     conn = db(); cur = conn.cursor()
     cur.execute("SELECT * FROM shop_settings WHERE shop_owner_id=?", (shop_owner_id,))
     r = cur.fetchone(); conn.close()
-    return r
+    if not r:
+        return MappingProxyType({"shop_owner_id": shop_owner_id, **SHOP_SETTINGS_DEFAULTS})
+    return MappingProxyType(dict(r))
+
+_SETTINGS_CACHE = SnapshotCache(SHOP_CACHE_SIZE, _load_shop_settings)
+
+def get_shop_settings(shop_owner_id: int) -> MappingProxyType:
+    return _SETTINGS_CACHE.get(shop_owner_id)
 
 def set_shop_setting(shop_owner_id: int, field: str, value: str):
-    ensure_shop_settings(shop_owner_id)
-    conn = db(); cur = conn.cursor()
-    cur.execute(f"UPDATE shop_settings SET {field}=? WHERE shop_owner_id=?", (value or "", shop_owner_id))
-    conn.commit(); conn.close()
+    def _w(cur: sqlite3.Cursor):
+        cur.execute(_SHOP_SETTINGS_INSERT, (shop_owner_id,))
+        cur.execute(f"UPDATE shop_settings SET {field}=? WHERE shop_owner_id=?", (value or "", shop_owner_id))
+    db_write(_w)
+    _SETTINGS_CACHE.invalidate(shop_owner_id)
 
 # --- payment methods (extra deposit methods) ---
 def pm_list(shop_owner_id: int) -> List[sqlite3.Row]:
@@ -915,23 +1409,15 @@ def pm_list(shop_owner_id: int) -> List[sqlite3.Row]:
     return rows
 
 def pm_add(shop_owner_id: int, name: str, instructions: str) -> int:
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO payment_methods(shop_owner_id,name,instructions) VALUES(?,?,?)",
-                (shop_owner_id, (name or '').strip()[:40], (instructions or '').strip()[:3500]))
-    rid = int(cur.lastrowid)
-    conn.commit(); conn.close()
-    return rid
+    return db_insert("INSERT INTO payment_methods(shop_owner_id,name,instructions) VALUES(?,?,?)",
+                     (shop_owner_id, (name or '').strip()[:40], (instructions or '').strip()[:3500]))
 
 def pm_update(pm_id: int, name: str, instructions: str):
-    conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE payment_methods SET name=?, instructions=? WHERE id=?",
-                ((name or '').strip()[:40], (instructions or '').strip()[:3500], int(pm_id)))
-    conn.commit(); conn.close()
+    db_exec("UPDATE payment_methods SET name=?, instructions=? WHERE id=?",
+            ((name or '').strip()[:40], (instructions or '').strip()[:3500], int(pm_id)))
 
 def pm_delete(pm_id: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM payment_methods WHERE id=?", (int(pm_id),))
-    conn.commit(); conn.close()
+    db_exec("DELETE FROM payment_methods WHERE id=?", (int(pm_id),))
 
 def pm_get(pm_id: int) -> Optional[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
@@ -951,14 +1437,37 @@ def build_deposit_methods(shop_owner_id: int) -> List[Dict[str, str]]:
 
 
 # --- users ---
-def upsert_user(u):
-    conn = db(); cur = conn.cursor()
-    cur.execute(
+# Profiles are written only when the name fields change or last_seen is USER_SEEN_INTERVAL old,
+# so chatty users don't turn every message into a DB write.
+USER_SEEN_INTERVAL = int((os.getenv("USER_SEEN_INTERVAL") or "300").strip() or "300")
+USER_CACHE_SIZE = int((os.getenv("USER_CACHE_SIZE") or "50000").strip() or "50000")
+_USER_CACHE = LRUCache(USER_CACHE_SIZE)  # user_id -> ((username, first_name, last_name), last_written)
+
+def _user_profile(u) -> Tuple[str, str, str]:
+    return (u.username or "", u.first_name or "", u.last_name or "")
+
+def user_profile_stale(u) -> Optional[Tuple[str, str, str]]:
+    """The profile upsert_user(u) would write, or None if the cached row is fresh.
+    One cache read; cheap enough to call on the event loop."""
+    prof = _user_profile(u)
+    hit = _USER_CACHE.get(u.id)
+    if hit and hit[0] == prof and ts() - hit[1] < USER_SEEN_INTERVAL:
+        return None
+    return prof
+
+def upsert_user(u, prof: Optional[Tuple[str, str, str]] = None):
+    """Write u's profile. Pass the result of user_profile_stale(u) to skip re-checking the cache."""
+    if prof is None:
+        prof = user_profile_stale(u)
+        if prof is None:
+            return
+    now = ts()
+    db_exec(
         "INSERT INTO users(user_id, username, first_name, last_name, last_seen) VALUES(?,?,?,?,?) "
         "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name, last_seen=excluded.last_seen",
-        (u.id, u.username or "", u.first_name or "", u.last_name or "", ts())
+        (u.id, *prof, now)
     )
-    conn.commit(); conn.close()
+    _USER_CACHE.put(u.id, (prof, now))
 
 def user_row(uid: int) -> Optional[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
@@ -976,100 +1485,175 @@ def user_display(uid: int) -> str:
     name = " ".join([x for x in [(r["first_name"] or "").strip(), (r["last_name"] or "").strip()] if x]).strip()
     return name or str(uid)
 
+def user_displays(uids: List[int]) -> List[str]:
+    return [user_display(u) for u in uids]
+
 # --- session (master only) ---
 def set_session(uid: int, shop_owner_id: int, locked: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute(
+    db_exec(
         "INSERT INTO sessions(user_id, shop_owner_id, locked) VALUES(?,?,?) "
         "ON CONFLICT(user_id) DO UPDATE SET shop_owner_id=excluded.shop_owner_id, locked=excluded.locked",
         (uid, shop_owner_id, int(locked))
     )
-    conn.commit(); conn.close()
 
 # --- balances ---
 def ensure_balance(shop_owner_id: int, uid: int):
+    db_exec("INSERT OR IGNORE INTO balances(shop_owner_id, user_id, balance) VALUES(?,?,0)", (shop_owner_id, uid))
+
+# A balances row doubles as shop membership (broadcast audience / user lists). It is written
+# once per (shop, user): _SHOP_MEMBERS remembers who is known so repeat visits stay read-only.
+_SHOP_MEMBERS = LRUCache(USER_CACHE_SIZE)
+
+def register_shop_user(shop_owner_id: int, uid: int):
+    if _SHOP_MEMBERS.get((shop_owner_id, uid)):
+        return
     conn = db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO balances(shop_owner_id, user_id, balance) VALUES(?,?,0)", (shop_owner_id, uid))
-    conn.commit(); conn.close()
+    cur.execute("SELECT 1 FROM balances WHERE shop_owner_id=? AND user_id=?", (shop_owner_id, uid))
+    found = cur.fetchone() is not None
+    conn.close()
+    if not found:
+        ensure_balance(shop_owner_id, uid)
+    _SHOP_MEMBERS.put((shop_owner_id, uid), True)
 
 def get_balance(shop_owner_id: int, uid: int) -> float:
-    ensure_balance(shop_owner_id, uid)
     conn = db(); cur = conn.cursor()
     cur.execute("SELECT balance FROM balances WHERE shop_owner_id=? AND user_id=?", (shop_owner_id, uid))
     r = cur.fetchone(); conn.close()
     return float(r["balance"] or 0) if r else 0.0
 
 def set_balance(shop_owner_id: int, uid: int, val: float):
-    conn = db(); cur = conn.cursor()
-    cur.execute(
+    db_exec(
         "INSERT INTO balances(shop_owner_id, user_id, balance) VALUES(?,?,?) "
         "ON CONFLICT(shop_owner_id, user_id) DO UPDATE SET balance=excluded.balance",
         (shop_owner_id, uid, max(0.0, float(val)))
     )
-    conn.commit(); conn.close()
+
+def _add_balance(cur: sqlite3.Cursor, shop_owner_id: int, uid: int, delta: float) -> float:
+    cur.execute("INSERT OR IGNORE INTO balances(shop_owner_id, user_id, balance) VALUES(?,?,0)", (shop_owner_id, uid))
+    cur.execute("UPDATE balances SET balance=MAX(0, balance+?) WHERE shop_owner_id=? AND user_id=? RETURNING balance",
+                (float(delta), shop_owner_id, uid))
+    return float(cur.fetchone()["balance"] or 0)
 
 def add_balance(shop_owner_id: int, uid: int, delta: float) -> float:
-    bal = get_balance(shop_owner_id, uid)
-    newv = max(0.0, bal + float(delta))
-    set_balance(shop_owner_id, uid, newv)
-    return newv
+    return db_write(lambda cur: _add_balance(cur, shop_owner_id, uid, delta))
+
+def list_shop_user_ids(shop_owner_id: int, limit: int = -1) -> List[int]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT user_id FROM balances WHERE shop_owner_id=? ORDER BY rowid DESC LIMIT ?", (shop_owner_id, int(limit)))
+    rows = cur.fetchall(); conn.close()
+    return [int(r["user_id"]) for r in rows]
 
-def list_shop_user_ids(shop_owner_id: int) -> List[int]:
+def search_shop_user_ids(shop_owner_id: int, q: str, limit: int = 40) -> List[int]:
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT user_id FROM balances WHERE shop_owner_id=? ORDER BY rowid DESC", (shop_owner_id,))
+    cur.execute("""
+        SELECT u.user_id FROM users u
+        JOIN balances b ON b.user_id=u.user_id AND b.shop_owner_id=?
+        WHERE lower(u.username) LIKE ?
+        LIMIT ?
+    """, (shop_owner_id, f"%{q}%", int(limit)))
     rows = cur.fetchall(); conn.close()
     return [int(r["user_id"]) for r in rows]
 
+_TX_INSERT = "INSERT INTO transactions(shop_owner_id,user_id,kind,amount,note,qty,created_at) VALUES(?,?,?,?,?,?,?)"
+
 def log_tx(shop_owner_id: int, uid: int, kind: str, amount: float, note: str = "", qty: int = 1):
+    db_exec(_TX_INSERT, (shop_owner_id, uid, kind, float(amount), note or "", int(qty or 1), ts()))
+
+def list_tx(shop_owner_id: int, uid: int, limit: int = 30) -> List[sqlite3.Row]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT * FROM transactions WHERE shop_owner_id=? AND user_id=? ORDER BY id DESC LIMIT ?",
+                (shop_owner_id, uid, int(limit)))
+    rows = cur.fetchall(); conn.close()
+    return rows
+
+# --- deposit requests ---
+def deposit_create(shop_owner_id: int, uid: int, amount: float, proof_file_id: str, method_id: str, method_name: str) -> int:
+    return db_insert("""INSERT INTO deposit_requests(shop_owner_id,user_id,amount,proof_file_id,status,created_at,method_id,method_name)
+                        VALUES(?,?,?,?,?,?,?,?)""",
+                     (shop_owner_id, uid, float(amount), proof_file_id, "pending", ts(), method_id, method_name))
+
+def deposit_get(rid: int) -> Optional[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO transactions(shop_owner_id,user_id,kind,amount,note,qty,created_at) VALUES(?,?,?,?,?,?,?)",
-                (shop_owner_id, uid, kind, float(amount), note or "", int(qty or 1), ts()))
-    conn.commit(); conn.close()
+    cur.execute("SELECT * FROM deposit_requests WHERE id=?", (int(rid),))
+    r = cur.fetchone(); conn.close()
+    return r
+
+def deposit_set_admin_msg(rid: int, chat_id: int, msg_id: int):
+    db_exec("UPDATE deposit_requests SET admin_chat_id=?, admin_msg_id=? WHERE id=?", (chat_id, msg_id, int(rid)))
+
+def deposit_handle(rid: int, approve: bool, handled_by: int) -> bool:
+    """Move a pending request to approved/rejected (crediting the balance on approve).
+    Returns False if it was already handled."""
+    def _w(cur: sqlite3.Cursor) -> bool:
+        cur.execute("UPDATE deposit_requests SET status=?, handled_by=?, handled_at=? WHERE id=? AND status='pending' "
+                    "RETURNING shop_owner_id, user_id, amount",
+                    ("approved" if approve else "rejected", handled_by, ts(), int(rid)))
+        r = cur.fetchone()
+        if not r:
+            return False
+        if approve:
+            sid, uid, amount = int(r["shop_owner_id"]), int(r["user_id"]), float(r["amount"])
+            _add_balance(cur, sid, uid, amount)
+            cur.execute(_TX_INSERT, (sid, uid, "deposit", amount, "", 1, ts()))
+        return True
+    return db_write(_w)
 
 
 
 
 
 # --- bans ---
-def is_banned_user(shop_owner_id: int, uid: int) -> bool:
+def _load_user_ban(key: Tuple[int, int]) -> Tuple[int, int]:
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT banned, restricted_until FROM user_bans WHERE shop_owner_id=? AND user_id=?", (shop_owner_id, uid))
+    cur.execute("SELECT banned, restricted_until FROM user_bans WHERE shop_owner_id=? AND user_id=?", key)
     r = cur.fetchone(); conn.close()
-    if not r:
-        return False
-    if int(r["banned"] or 0) == 1:
+    return (int(r["banned"] or 0), int(r["restricted_until"] or 0)) if r else (0, 0)
+
+_BAN_CACHE = SnapshotCache(USER_CACHE_SIZE, _load_user_ban)
+
+def is_banned_user(shop_owner_id: int, uid: int) -> bool:
+    banned, restricted_until = _BAN_CACHE.get((shop_owner_id, uid))
+    if banned == 1:
         return True
-    if int(r["restricted_until"] or 0) > ts():
+    if restricted_until > ts():
         return True
     return False
 
 def ban_user(shop_owner_id: int, uid: int, banned: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO user_bans(shop_owner_id,user_id,banned,restricted_until) VALUES(?,?,?,0)
-                   ON CONFLICT(shop_owner_id,user_id) DO UPDATE SET banned=excluded.banned""",
-                (shop_owner_id, uid, int(banned)))
-    conn.commit(); conn.close()
+    db_exec("""INSERT INTO user_bans(shop_owner_id,user_id,banned,restricted_until) VALUES(?,?,?,0)
+               ON CONFLICT(shop_owner_id,user_id) DO UPDATE SET banned=excluded.banned""",
+            (shop_owner_id, uid, int(banned)))
+    _BAN_CACHE.invalidate((shop_owner_id, uid))
 
 def restrict_user(shop_owner_id: int, uid: int, days: int):
     until = ts() + max(0, int(days)) * 86400
-    conn = db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO user_bans(shop_owner_id,user_id,banned,restricted_until) VALUES(?,?,0,?)
-                   ON CONFLICT(shop_owner_id,user_id) DO UPDATE SET restricted_until=excluded.restricted_until, banned=0""",
-                (shop_owner_id, uid, until))
-    conn.commit(); conn.close()
+    db_exec("""INSERT INTO user_bans(shop_owner_id,user_id,banned,restricted_until) VALUES(?,?,0,?)
+               ON CONFLICT(shop_owner_id,user_id) DO UPDATE SET restricted_until=excluded.restricted_until, banned=0""",
+            (shop_owner_id, uid, until))
+    _BAN_CACHE.invalidate((shop_owner_id, uid))
 
 # --- sellers / plans ---
-def ensure_seller(seller_id: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO sellers(seller_id, sub_until, plan) VALUES(?,?,?)", (seller_id, 0, "branded"))
-    conn.commit(); conn.close()
+_SELLER_INSERT = "INSERT OR IGNORE INTO sellers(seller_id, sub_until, plan) VALUES(?,0,'branded')"
 
-def seller_row(seller_id: int) -> Optional[sqlite3.Row]:
+def _seller_update(seller_id: int, sql: str, params: Tuple):
+    """UPDATE sellers ... WHERE seller_id=?, creating the row first (one writer batch)."""
+    def _w(cur: sqlite3.Cursor):
+        cur.execute(_SELLER_INSERT, (seller_id,))
+        cur.execute(sql, (*params, seller_id))
+    db_write(_w)
+    _SELLER_CACHE.invalidate(seller_id)
+
+def _load_seller_row(seller_id: int) -> Optional[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
     cur.execute("SELECT * FROM sellers WHERE seller_id=?", (seller_id,))
     r = cur.fetchone(); conn.close()
     return r
 
+_SELLER_CACHE = SnapshotCache(SHOP_CACHE_SIZE, _load_seller_row)
+
+def seller_row(seller_id: int) -> Optional[sqlite3.Row]:
+    return _SELLER_CACHE.get(seller_id)
+
 def seller_plan(seller_id: int) -> str:
     if is_super(seller_id):
         return "whitelabel"
@@ -1077,10 +1661,7 @@ def seller_plan(seller_id: int) -> str:
     return (r["plan"] if r else "branded") or "branded"
 
 def seller_set_plan(seller_id: int, plan: str):
-    ensure_seller(seller_id)
-    conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE sellers SET plan=? WHERE seller_id=?", (plan, seller_id))
-    conn.commit(); conn.close()
+    _seller_update(seller_id, "UPDATE sellers SET plan=? WHERE seller_id=?", (plan,))
 
 def seller_days_left(seller_id: int) -> int:
     if is_super(seller_id):
@@ -1103,26 +1684,18 @@ def seller_active(seller_id: int) -> bool:
     return int(r["sub_until"] or 0) > ts()
 
 def seller_add_days(seller_id: int, days: int):
-    ensure_seller(seller_id)
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT sub_until FROM sellers WHERE seller_id=?", (seller_id,))
-    r = cur.fetchone()
-    base = max(int(r["sub_until"] or 0), ts())
-    cur.execute("UPDATE sellers SET sub_until=? WHERE seller_id=?", (base + int(days) * 86400, seller_id))
-    conn.commit(); conn.close()
+    _seller_update(seller_id, "UPDATE sellers SET sub_until=MAX(COALESCE(sub_until,0), ?) + ? WHERE seller_id=?",
+                   (ts(), int(days) * 86400))
+    EXPIRY.wake(seller_id)
 
 def super_set_seller_flag(seller_id: int, field: str, val: int):
-    ensure_seller(seller_id)
-    conn = db(); cur = conn.cursor()
-    cur.execute(f"UPDATE sellers SET {field}=? WHERE seller_id=?", (int(val), seller_id))
-    conn.commit(); conn.close()
+    _seller_update(seller_id, f"UPDATE sellers SET {field}=? WHERE seller_id=?", (int(val),))
+    EXPIRY.wake(seller_id)
 
 def super_restrict_seller(seller_id: int, days: int):
-    ensure_seller(seller_id)
     until = ts() + max(0, int(days)) * 86400
-    conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE sellers SET restricted_until=? WHERE seller_id=?", (until, seller_id))
-    conn.commit(); conn.close()
+    _seller_update(seller_id, "UPDATE sellers SET restricted_until=? WHERE seller_id=?", (until,))
+    EXPIRY.wake(seller_id)
 
 def list_sellers_only() -> List[sqlite3.Row]:
     # ONLY real sellers: has subscription OR has connected bot token
@@ -1135,17 +1708,28 @@ def list_sellers_only() -> List[sqlite3.Row]:
     rows = cur.fetchall(); conn.close()
     return rows
 
+def search_seller_ids(q: str) -> List[int]:
+    matched: List[int] = []
+    for s in list_sellers_only():
+        sid = int(s["seller_id"])
+        u = user_row(sid)
+        if u and (u["username"] or "").lower().find(q) != -1:
+            matched.append(sid)
+    return matched
+
 # --- seller bots ---
 def upsert_seller_bot(seller_id: int, token: str, username: str):
-    ensure_seller(seller_id)
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO seller_bots(seller_id, bot_token, bot_username, enabled, created_at, updated_at)
-        VALUES(?,?,?,?,?,?)
-        ON CONFLICT(seller_id) DO UPDATE SET bot_token=excluded.bot_token, bot_username=excluded.bot_username,
-            enabled=1, updated_at=excluded.updated_at
-    """, (seller_id, token, username, 1, ts(), ts()))
-    conn.commit(); conn.close()
+    def _w(cur: sqlite3.Cursor):
+        cur.execute(_SELLER_INSERT, (seller_id,))
+        cur.execute("""
+            INSERT INTO seller_bots(seller_id, bot_token, bot_username, enabled, created_at, updated_at)
+            VALUES(?,?,?,?,?,?)
+            ON CONFLICT(seller_id) DO UPDATE SET bot_token=excluded.bot_token, bot_username=excluded.bot_username,
+                enabled=1, updated_at=excluded.updated_at
+        """, (seller_id, token, username, 1, ts(), ts()))
+    db_write(_w)
+    _SELLER_CACHE.invalidate(seller_id)
+    EXPIRY.wake(seller_id)
 
 def get_seller_bot(seller_id: int) -> Optional[sqlite3.Row]:
     conn = db(); cur = conn.cursor()
@@ -1159,53 +1743,147 @@ def list_enabled_seller_bots() -> List[sqlite3.Row]:
     rows = cur.fetchall(); conn.close()
     return rows
 
-def disable_seller_bot(seller_id: int):
+def list_expired_seller_bots() -> List[int]:
+    """Enabled seller bots that are no longer startable (expired, restricted or banned shop)."""
+    now = ts()
     conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE seller_bots SET enabled=0, updated_at=? WHERE seller_id=?", (ts(), seller_id))
-    conn.commit(); conn.close()
+    cur.execute(_EXPIRED_SELLER_BOTS, (SUPER_ADMIN_ID, now, now))
+    ids = [int(r[0]) for r in cur.fetchall()]; conn.close()
+    return ids
 
-# --- catalog helpers ---
-def cat_get(shop_owner_id: int, cid: int) -> Optional[sqlite3.Row]:
+def seller_bot_deadlines() -> List[Tuple[int, int]]:
+    """(deadline, seller_id) for every future sub_until / restricted_until of an enabled bot."""
+    now = ts()
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM categories WHERE shop_owner_id=? AND id=?", (shop_owner_id, cid))
-    r = cur.fetchone(); conn.close()
-    return r
+    cur.execute("""SELECT b.seller_id, s.sub_until, s.restricted_until FROM seller_bots b
+                   JOIN sellers s ON s.seller_id=b.seller_id WHERE b.enabled=1""")
+    out = [(int(t), int(r[0])) for r in cur.fetchall() for t in (r[1] or 0, r[2] or 0) if int(t) > now]
+    conn.close()
+    return out
 
-def cocat_get(shop_owner_id: int, sid: int) -> Optional[sqlite3.Row]:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM cocategories WHERE shop_owner_id=? AND id=?", (shop_owner_id, sid))
-    r = cur.fetchone(); conn.close()
-    return r
+def disable_seller_bot(seller_id: int):
+    db_exec("UPDATE seller_bots SET enabled=0, updated_at=? WHERE seller_id=?", (ts(), seller_id))
 
-def prod_get(shop_owner_id: int, pid: int) -> Optional[sqlite3.Row]:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE shop_owner_id=? AND id=?", (shop_owner_id, pid))
-    r = cur.fetchone(); conn.close()
-    return r
+def enable_seller_bot(seller_id: int):
+    db_exec("UPDATE seller_bots SET enabled=1, updated_at=? WHERE seller_id=?", (ts(), seller_id))
+    EXPIRY.wake(seller_id)
 
-def cat_list(shop_owner_id: int) -> List[sqlite3.Row]:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM categories WHERE shop_owner_id=? ORDER BY id DESC", (shop_owner_id,))
-    rows = cur.fetchall(); conn.close()
-    return rows
+def delete_seller_bot(seller_id: int):
+    db_exec("DELETE FROM seller_bots WHERE seller_id=?", (seller_id,))
 
-def cocat_list(shop_owner_id: int, cat_id: int) -> List[sqlite3.Row]:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM cocategories WHERE shop_owner_id=? AND category_id=? ORDER BY id DESC", (shop_owner_id, cat_id))
-    rows = cur.fetchall(); conn.close()
-    return rows
+def seller_bot_startable(seller_id: int) -> bool:
+    r = seller_row(seller_id)
+    return seller_active(seller_id) and not (r and int(r["banned_shop"] or 0) == 1)
+
+# --- catalog helpers ---
+# Browsing reads a per-shop snapshot of the whole catalog (compact __slots__ records indexed by
+# id and parent) instead of querying SQLite. Every catalog mutation helper bumps the shop's
+# catalog version; a snapshot built for an older version is rebuilt on next access.
+CATALOG_CACHE_SIZE = int((os.getenv("CATALOG_CACHE_SIZE") or "512").strip() or "512")
+
+class _CatalogRecord:
+    """Row-like read-only record: r["name"] and r.name both work."""
+    __slots__ = ()
 
-def prod_list(shop_owner_id: int, cat_id: int, cocat_id: int) -> List[sqlite3.Row]:
+    def __init__(self, row: sqlite3.Row):
+        for k in self.__slots__:
+            object.__setattr__(self, k, row[k])
+
+    def __setattr__(self, key, value):
+        raise AttributeError("catalog records are read-only")
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+class Category(_CatalogRecord):
+    __slots__ = ("id", "shop_owner_id", "name", "description", "file_id", "file_type")
+
+class Cocategory(_CatalogRecord):
+    __slots__ = ("id", "shop_owner_id", "category_id", "name", "description", "file_id", "file_type")
+
+class Product(_CatalogRecord):
+    __slots__ = ("id", "shop_owner_id", "category_id", "cocategory_id", "name", "price",
+                 "description", "file_id", "file_type", "tg_link")
+
+class CatalogSnapshot:
+    __slots__ = ("version", "cats", "cocats", "prods", "cat_order", "cocats_by_cat", "prods_by_parent")
+
+    def __init__(self, version: int, cats: List[Category], cocats: List[Cocategory], prods: List[Product]):
+        # lists arrive ORDER BY id DESC, which is the display order
+        self.version = version
+        self.cats: Dict[int, Category] = {c.id: c for c in cats}
+        self.cocats: Dict[int, Cocategory] = {c.id: c for c in cocats}
+        self.prods: Dict[int, Product] = {p.id: p for p in prods}
+        self.cat_order: Tuple[Category, ...] = tuple(cats)
+        by_cat: Dict[int, List[Cocategory]] = {}
+        for c in cocats:
+            by_cat.setdefault(c.category_id, []).append(c)
+        self.cocats_by_cat: Dict[int, Tuple[Cocategory, ...]] = {k: tuple(v) for k, v in by_cat.items()}
+        by_parent: Dict[Tuple[int, int], List[Product]] = {}
+        for p in prods:
+            by_parent.setdefault((p.category_id, p.cocategory_id), []).append(p)
+        self.prods_by_parent: Dict[Tuple[int, int], Tuple[Product, ...]] = {k: tuple(v) for k, v in by_parent.items()}
+
+_CATALOG_CACHE = LRUCache(CATALOG_CACHE_SIZE)
+_CATALOG_VERSION: Dict[int, int] = {}
+_CATALOG_LOCK = threading.Lock()
+
+def catalog_version(shop_owner_id: int) -> int:
+    return _CATALOG_VERSION.get(shop_owner_id, 0)
+
+def bump_catalog(shop_owner_id: int):
+    with _CATALOG_LOCK:
+        _CATALOG_VERSION[shop_owner_id] = _CATALOG_VERSION.get(shop_owner_id, 0) + 1
+
+def catalog(shop_owner_id: int) -> CatalogSnapshot:
+    version = catalog_version(shop_owner_id)
+    snap = _CATALOG_CACHE.get(shop_owner_id)
+    if snap is not None and snap.version == version:
+        return snap
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE shop_owner_id=? AND category_id=? AND cocategory_id=? ORDER BY id DESC",
-                (shop_owner_id, cat_id, cocat_id))
-    rows = cur.fetchall(); conn.close()
-    return rows
+    cur.execute(_CATALOG_CATS, (shop_owner_id,))
+    cats = [Category(r) for r in cur.fetchall()]
+    cur.execute(_CATALOG_COCATS, (shop_owner_id,))
+    cocats = [Cocategory(r) for r in cur.fetchall()]
+    cur.execute(_CATALOG_PRODS, (shop_owner_id,))
+    prods = [Product(r) for r in cur.fetchall()]
+    conn.close()
+    # stamped with the version read *before* loading: a concurrent bump forces another rebuild
+    snap = CatalogSnapshot(version, cats, cocats, prods)
+    _CATALOG_CACHE.put(shop_owner_id, snap)
+    return snap
+
+def cat_get(shop_owner_id: int, cid: int) -> Optional[Category]:
+    return catalog(shop_owner_id).cats.get(cid)
+
+def cocat_get(shop_owner_id: int, sid: int) -> Optional[Cocategory]:
+    return catalog(shop_owner_id).cocats.get(sid)
+
+def prod_get(shop_owner_id: int, pid: int) -> Optional[Product]:
+    return catalog(shop_owner_id).prods.get(pid)
+
+def cat_list(shop_owner_id: int) -> Tuple[Category, ...]:
+    return catalog(shop_owner_id).cat_order
+
+def cocat_list(shop_owner_id: int, cat_id: int) -> Tuple[Cocategory, ...]:
+    return catalog(shop_owner_id).cocats_by_cat.get(cat_id, ())
+
+def prod_list(shop_owner_id: int, cat_id: int, cocat_id: int) -> Tuple[Product, ...]:
+    return catalog(shop_owner_id).prods_by_parent.get((cat_id, cocat_id), ())
+
+# products.available_count mirrors COUNT(undelivered keys) and is kept in step by every
+# helper that adds, claims or deletes keys (in the same write); reconcile_stock() repairs drift.
+_STOCK_ADJUST = "UPDATE products SET available_count=MAX(0, COALESCE(available_count,0)+?) WHERE shop_owner_id=? AND id=?"
 
 def stock_count(shop_owner_id: int, pid: int) -> int:
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT COUNT(1) c FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0",
-                (shop_owner_id, pid))
+    cur.execute("SELECT available_count c FROM products WHERE shop_owner_id=? AND id=?", (shop_owner_id, pid))
     r = cur.fetchone(); conn.close()
     return int(r["c"] or 0) if r else 0
 
@@ -1213,34 +1891,124 @@ def add_keys(shop_owner_id: int, pid: int, lines: List[str]) -> int:
     lines = [l.strip() for l in lines if l.strip()]
     if not lines:
         return 0
-    conn = db(); cur = conn.cursor()
-    cur.executemany("INSERT INTO product_keys(shop_owner_id,product_id,key_line) VALUES(?,?,?)",
-                    [(shop_owner_id, pid, l) for l in lines])
-    conn.commit()
-    n = cur.rowcount
-    conn.close()
-    return n
+    def _w(cur: sqlite3.Cursor) -> int:
+        n = cur.executemany("INSERT INTO product_keys(shop_owner_id,product_id,key_line) VALUES(?,?,?)",
+                            [(shop_owner_id, pid, l) for l in lines]).rowcount
+        cur.execute(_STOCK_ADJUST, (n, shop_owner_id, pid))
+        return n
+    return db_write(_w)
 
 def clear_keys(shop_owner_id: int, pid: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0", (shop_owner_id, pid))
-    conn.commit(); conn.close()
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0", (shop_owner_id, pid))
+        cur.execute("UPDATE products SET available_count=0 WHERE shop_owner_id=? AND id=?", (shop_owner_id, pid))
+    db_write(_w)
 
-def pop_keys(shop_owner_id: int, pid: int, uid: int, qty: int) -> List[str]:
+def _count_stock(cur: sqlite3.Cursor, shop_owner_id: int, pid: int) -> int:
+    cur.execute("SELECT COUNT(1) c FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0",
+                (shop_owner_id, pid))
+    return int(cur.fetchone()["c"] or 0)
+
+# reconcile_stock drift check: one pass over products, unsold keys counted off idx_product_keys_stock
+_STOCK_DRIFT = """
+    SELECT p.shop_owner_id, p.id, COALESCE(p.available_count,0) c, COUNT(k.id) n
+    FROM products p LEFT JOIN product_keys k
+         ON k.shop_owner_id=p.shop_owner_id AND k.product_id=p.id AND k.delivered_once=0
+    GROUP BY p.shop_owner_id, p.id HAVING c<>n"""
+
+def reconcile_stock() -> List[Tuple[int, int, int, int]]:
+    """Find products whose available_count drifted from the real key count and fix them.
+    Returns (shop_owner_id, product_id, stored, actual) for every product repaired."""
     conn = db(); cur = conn.cursor()
-    cur.execute("""SELECT id, key_line FROM product_keys
-                   WHERE shop_owner_id=? AND product_id=? AND delivered_once=0
-                   ORDER BY id ASC LIMIT ?""", (shop_owner_id, pid, qty))
-    rows = cur.fetchall()
-    ids = [int(r["id"]) for r in rows]
-    keys = [r["key_line"] for r in rows]
-    if ids:
-        cur.execute(f"""UPDATE product_keys
-                        SET delivered_once=1, delivered_to=?, delivered_at=?
-                        WHERE id IN ({",".join(["?"]*len(ids))})""",
-                    (uid, ts(), *ids))
-    conn.commit(); conn.close()
-    return keys
+    cur.execute(_STOCK_DRIFT)
+    drifted = [(int(r["shop_owner_id"]), int(r["id"])) for r in cur.fetchall()]
+    conn.close()
+
+    fixed: List[Tuple[int, int, int, int]] = []
+    for sid, pid in drifted:
+        def _w(cur: sqlite3.Cursor, sid=sid, pid=pid) -> Optional[Tuple[int, int, int, int]]:
+            # recount under the write lock so concurrent sales/imports can't skew the fix
+            cur.execute("SELECT COALESCE(available_count,0) c FROM products WHERE shop_owner_id=? AND id=?", (sid, pid))
+            r = cur.fetchone()
+            if not r:
+                return None
+            actual = _count_stock(cur, sid, pid)
+            if actual == int(r["c"]):
+                return None
+            cur.execute("UPDATE products SET available_count=? WHERE shop_owner_id=? AND id=?", (actual, sid, pid))
+            return (sid, pid, int(r["c"]), actual)
+        res = db_write(_w)
+        if res:
+            log.warning("stock drift shop=%s product=%s stored=%s actual=%s (fixed)", *res)
+            fixed.append(res)
+    return fixed
+
+def purchase(shop_owner_id: int, uid: int, pid: int, qty: int) -> Dict[str, Any]:
+    """Buy qty keys of a product in one write: claim keys, debit balance, write order + ledger.
+    status is "ok", "missing" (no product), "stock" or "balance". No order, ledger or balance
+    change is written unless "ok"; the one exception is a "stock" result caused by a drifted
+    available_count, which also corrects that counter to the real number of unsold keys."""
+    qty = max(1, int(qty))
+    res: Dict[str, Any] = {"status": "ok", "order_id": "", "keys": [], "total": 0.0, "balance": 0.0, "name": ""}
+
+    def _w(cur: sqlite3.Cursor) -> Dict[str, Any]:
+        # the writer batch holds SQLite's write lock, so these checks can't race another buyer
+        cur.execute("SELECT name, price, available_count FROM products WHERE shop_owner_id=? AND id=?", (shop_owner_id, pid))
+        p = cur.fetchone()
+        if not p:
+            res["status"] = "missing"
+            return res
+        res["name"] = p["name"]
+        total = res["total"] = float(p["price"]) * qty
+        if int(p["available_count"] or 0) < qty:
+            res["status"] = "stock"
+            return res
+        cur.execute("SELECT balance FROM balances WHERE shop_owner_id=? AND user_id=?", (shop_owner_id, uid))
+        r = cur.fetchone()
+        bal = res["balance"] = float(r["balance"] or 0) if r else 0.0
+        if bal < total:
+            res["status"] = "balance"
+            return res
+
+        now = ts()
+        cur.execute("""UPDATE product_keys SET delivered_once=1, delivered_to=?, delivered_at=?
+                       WHERE id IN (SELECT id FROM product_keys
+                                    WHERE shop_owner_id=? AND product_id=? AND delivered_once=0
+                                    ORDER BY id ASC LIMIT ?)
+                       RETURNING id, key_line""", (uid, now, shop_owner_id, pid, qty))
+        claimed = sorted(cur.fetchall(), key=lambda r: r["id"])
+        if len(claimed) < qty:
+            # available_count drifted high: put the keys back and correct the counter
+            cur.execute(f"UPDATE product_keys SET delivered_once=0, delivered_to=0, delivered_at=0 WHERE id IN ({','.join('?' * len(claimed))})",
+                        [r["id"] for r in claimed])
+            cur.execute("UPDATE products SET available_count=? WHERE shop_owner_id=? AND id=?", (len(claimed), shop_owner_id, pid))
+            log.warning("stock drift on purchase shop=%s product=%s", shop_owner_id, pid)
+            res["status"] = "stock"
+            return res
+        keys = res["keys"] = [r["key_line"] for r in claimed]
+        cur.execute(_STOCK_ADJUST, (-qty, shop_owner_id, pid))
+        cur.execute("UPDATE balances SET balance=MAX(0, balance-?) WHERE shop_owner_id=? AND user_id=? AND balance>=?",
+                    (total, shop_owner_id, uid, total))
+        if cur.rowcount != 1:
+            raise sqlite3.IntegrityError("purchase checks changed under the write lock")
+        res["balance"] = max(0.0, bal - total)
+
+        for _ in range(5):
+            order_id = gen_order_id(10)
+            try:
+                cur.execute(
+                    "INSERT INTO orders(order_id,shop_owner_id,user_id,product_id,product_name,qty,total,keys_text,created_at) VALUES(?,?,?,?,?,?,?,?,?)",
+                    (order_id, shop_owner_id, uid, pid, p["name"], qty, total, "\n".join(keys), now)
+                )
+                break
+            except sqlite3.IntegrityError:
+                continue
+        else:
+            raise sqlite3.IntegrityError("could not allocate an order id")
+        res["order_id"] = order_id
+        cur.execute(_TX_INSERT, (shop_owner_id, uid, "purchase", -total, f"{p['name']} | {order_id}", qty, now))
+        return res
+    return db_write(_w)
 
 
 # --- deposit methods ---
@@ -1257,21 +2025,15 @@ def dep_method_get(shop_owner_id: int, mid: int) -> Optional[sqlite3.Row]:
     return r
 
 def dep_method_add(shop_owner_id: int, name: str, pay_text: str):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO deposit_methods(shop_owner_id,name,pay_text,enabled,sort_order) VALUES(?,?,?,?,0)",
-                (shop_owner_id, name.strip(), pay_text.strip(), 1))
-    conn.commit(); conn.close()
+    db_exec("INSERT INTO deposit_methods(shop_owner_id,name,pay_text,enabled,sort_order) VALUES(?,?,?,?,0)",
+            (shop_owner_id, name.strip(), pay_text.strip(), 1))
 
 def dep_method_update(shop_owner_id: int, mid: int, name: str, pay_text: str):
-    conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE deposit_methods SET name=?, pay_text=? WHERE shop_owner_id=? AND id=?",
-                (name.strip(), pay_text.strip(), shop_owner_id, mid))
-    conn.commit(); conn.close()
+    db_exec("UPDATE deposit_methods SET name=?, pay_text=? WHERE shop_owner_id=? AND id=?",
+            (name.strip(), pay_text.strip(), shop_owner_id, mid))
 
 def dep_method_delete(shop_owner_id: int, mid: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM deposit_methods WHERE shop_owner_id=? AND id=?", (shop_owner_id, mid))
-    conn.commit(); conn.close()
+    db_exec("DELETE FROM deposit_methods WHERE shop_owner_id=? AND id=?", (shop_owner_id, mid))
 
 
 def list_product_keys(shop_owner_id: int, product_id: int, limit: int = 50, offset: int = 0) -> List[sqlite3.Row]:
@@ -1290,6 +2052,75 @@ def count_product_keys(shop_owner_id: int, product_id: int) -> int:
     r = cur.fetchone(); conn.close()
     return int(r["c"] or 0) if r else 0
 
+def key_get(shop_owner_id: int, product_id: int, kid: int) -> Optional[sqlite3.Row]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT delivered_once FROM product_keys WHERE shop_owner_id=? AND id=? AND product_id=?", (shop_owner_id, kid, product_id))
+    r = cur.fetchone(); conn.close()
+    return r
+
+def delete_key(shop_owner_id: int, product_id: int, kid: int):
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND id=? AND product_id=? AND delivered_once=0", (shop_owner_id, kid, product_id))
+        if cur.rowcount:
+            cur.execute(_STOCK_ADJUST, (-cur.rowcount, shop_owner_id, product_id))
+    db_write(_w)
+
+# --- catalog mutations ---
+def cat_add(shop_owner_id: int, name: str) -> int:
+    rid = db_insert("INSERT INTO categories(shop_owner_id,name) VALUES(?,?)", (shop_owner_id, name))
+    bump_catalog(shop_owner_id)
+    return rid
+
+def cocat_add(shop_owner_id: int, cat_id: int, name: str) -> int:
+    rid = db_insert("INSERT INTO cocategories(shop_owner_id,category_id,name) VALUES(?,?,?)", (shop_owner_id, cat_id, name))
+    bump_catalog(shop_owner_id)
+    return rid
+
+def prod_add(shop_owner_id: int, cat_id: int, cocat_id: int, name: str, price: float) -> int:
+    rid = db_insert("INSERT INTO products(shop_owner_id,category_id,cocategory_id,name,price) VALUES(?,?,?,?,?)",
+                    (shop_owner_id, cat_id, cocat_id, name, float(price)))
+    bump_catalog(shop_owner_id)
+    return rid
+
+_CATALOG_FIELDS = {
+    "categories": {"name", "file_id", "file_type"},
+    "cocategories": {"name", "file_id", "file_type"},
+    "products": {"name", "price", "description", "file_id", "file_type", "tg_link"},
+}
+
+def catalog_update(table: str, shop_owner_id: int, rid: int, **fields):
+    if not fields or not set(fields) <= _CATALOG_FIELDS.get(table, set()):
+        raise ValueError(f"bad catalog update {table}: {sorted(fields)}")
+    db_exec(f"UPDATE {table} SET {', '.join(f'{k}=?' for k in fields)} WHERE shop_owner_id=? AND id=?",
+            (*fields.values(), shop_owner_id, rid))
+    bump_catalog(shop_owner_id)
+
+def prod_delete(shop_owner_id: int, pid: int):
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM products WHERE shop_owner_id=? AND id=?", (shop_owner_id, pid))
+        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id=?", (shop_owner_id, pid))
+    db_write(_w)
+    bump_catalog(shop_owner_id)
+
+def cat_delete(shop_owner_id: int, cat_id: int):
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM categories WHERE shop_owner_id=? AND id=?", (shop_owner_id, cat_id))
+        cur.execute("DELETE FROM cocategories WHERE shop_owner_id=? AND category_id=?", (shop_owner_id, cat_id))
+        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id IN "
+                    "(SELECT id FROM products WHERE shop_owner_id=? AND category_id=?)", (shop_owner_id, shop_owner_id, cat_id))
+        cur.execute("DELETE FROM products WHERE shop_owner_id=? AND category_id=?", (shop_owner_id, cat_id))
+    db_write(_w)
+    bump_catalog(shop_owner_id)
+
+def cocat_delete(shop_owner_id: int, sub_id: int):
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM cocategories WHERE shop_owner_id=? AND id=?", (shop_owner_id, sub_id))
+        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id IN "
+                    "(SELECT id FROM products WHERE shop_owner_id=? AND cocategory_id=?)", (shop_owner_id, shop_owner_id, sub_id))
+        cur.execute("DELETE FROM products WHERE shop_owner_id=? AND cocategory_id=?", (shop_owner_id, sub_id))
+    db_write(_w)
+    bump_catalog(shop_owner_id)
+
 
 # --- support ---
 def get_open_ticket(shop_owner_id: int, user_id: int) -> Optional[int]:
@@ -1302,19 +2133,93 @@ def get_open_ticket(shop_owner_id: int, user_id: int) -> Optional[int]:
     return int(r["id"]) if r else None
 
 def create_ticket(shop_owner_id: int, user_id: int) -> int:
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO tickets(shop_owner_id,user_id,status,created_at,updated_at) VALUES(?,?,?,?,?)",
-                (shop_owner_id, user_id, "open", ts(), ts()))
-    tid = cur.lastrowid
-    conn.commit(); conn.close()
-    return int(tid)
+    return db_insert("INSERT INTO tickets(shop_owner_id,user_id,status,created_at,updated_at) VALUES(?,?,?,?,?)",
+                     (shop_owner_id, user_id, "open", ts(), ts()))
 
 def add_ticket_msg(ticket_id: int, sender_id: int, text: str, file_id: str = "", file_type: str = ""):
+    def _w(cur: sqlite3.Cursor):
+        cur.execute("INSERT INTO ticket_messages(ticket_id,sender_id,text,file_id,file_type,created_at) VALUES(?,?,?,?,?,?)",
+                    (ticket_id, sender_id, text, file_id or "", file_type or "", ts()))
+        cur.execute("UPDATE tickets SET updated_at=? WHERE id=?", (ts(), ticket_id))
+    db_write(_w)
+
+# --- broadcast jobs ---
+def count_shop_users(shop_owner_id: int) -> int:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT COUNT(1) FROM balances WHERE shop_owner_id=?", (shop_owner_id,))
+    n = int(cur.fetchone()[0]); conn.close()
+    return n
+
+def broadcast_recipients(shop_owner_id: int, after_user_id: int, limit: int) -> List[int]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT user_id FROM balances WHERE shop_owner_id=? AND user_id>? ORDER BY user_id LIMIT ?",
+                (shop_owner_id, int(after_user_id), int(limit)))
+    ids = [int(r[0]) for r in cur.fetchall()]; conn.close()
+    return ids
+
+def broadcast_create(shop_owner_id: int, bot_key: int, text: str, file_id: str, file_type: str, total: int) -> int:
+    return db_insert("""INSERT INTO broadcast_jobs(shop_owner_id,bot_key,text,file_id,file_type,total,created_at,updated_at)
+                        VALUES(?,?,?,?,?,?,?,?)""",
+                     (shop_owner_id, int(bot_key), text or "", file_id or "", file_type or "", int(total), ts(), ts()))
+
+def broadcast_set_message(job_id: int, chat_id: int, message_id: int):
+    db_exec("UPDATE broadcast_jobs SET chat_id=?, message_id=? WHERE id=?", (int(chat_id), int(message_id), job_id))
+
+def broadcast_get(job_id: int) -> Optional[sqlite3.Row]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT * FROM broadcast_jobs WHERE id=?", (job_id,))
+    r = cur.fetchone(); conn.close()
+    return r
+
+def list_running_broadcasts() -> List[sqlite3.Row]:
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT * FROM broadcast_jobs WHERE status='running' ORDER BY id")
+    rows = cur.fetchall(); conn.close()
+    return rows
+
+def broadcast_progress(job_id: int, last_user_id: int, sent: int, failed: int) -> str:
+    """Persist the cursor and counters; returns the job status (a stop may have cancelled it)."""
+    def _w(cur: sqlite3.Cursor) -> str:
+        cur.execute("UPDATE broadcast_jobs SET last_user_id=?, sent=?, failed=?, updated_at=? WHERE id=? RETURNING status",
+                    (int(last_user_id), int(sent), int(failed), ts(), job_id))
+        r = cur.fetchone()
+        return r[0] if r else "cancelled"
+    return db_write(_w)
+
+def broadcast_finish(job_id: int, status: str) -> bool:
+    """running -> done/cancelled; False when the job was already finished."""
+    return db_exec("UPDATE broadcast_jobs SET status=?, updated_at=? WHERE id=? AND status='running'",
+                   (status, ts(), job_id)) > 0
+
+# --- user state ---
+def user_state_load(bot_key: int, user_id: int, max_age: int) -> Dict[str, Any]:
     conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO ticket_messages(ticket_id,sender_id,text,file_id,file_type,created_at) VALUES(?,?,?,?,?,?)",
-                (ticket_id, sender_id, text, file_id or "", file_type or "", ts()))
-    cur.execute("UPDATE tickets SET updated_at=? WHERE id=?", (ts(), ticket_id))
-    conn.commit(); conn.close()
+    cur.execute("SELECT data, updated_at FROM user_state WHERE bot_key=? AND user_id=?", (bot_key, user_id))
+    r = cur.fetchone()
+    conn.close()
+    if not r or int(r["updated_at"]) < ts() - max_age:
+        return {}
+    try:
+        return json.loads(r["data"]) or {}
+    except ValueError:
+        return {}
+
+def user_state_save(rows: List[Tuple[int, int, str]]) -> int:
+    """Batch upsert of (bot_key, user_id, json); an empty '{}' deletes the row."""
+    def _w(cur: sqlite3.Cursor) -> int:
+        now = ts()
+        keep = [(b, u, d, now) for b, u, d in rows if d != "{}"]
+        drop = [(b, u) for b, u, d in rows if d == "{}"]
+        if keep:
+            cur.executemany("INSERT INTO user_state(bot_key,user_id,data,updated_at) VALUES(?,?,?,?) "
+                            "ON CONFLICT(bot_key,user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at", keep)
+        if drop:
+            cur.executemany("DELETE FROM user_state WHERE bot_key=? AND user_id=?", drop)
+        return len(rows)
+    return db_write(_w)
+
+def user_state_purge(max_age: int) -> int:
+    return db_exec("DELETE FROM user_state WHERE updated_at<?", (ts() - max_age,))
 
 def _strip_branding(text: str) -> str:
     lines = (text or "").splitlines()
@@ -1326,77 +2231,542 @@ def _strip_branding(text: str) -> str:
         out.append(ln)
     return "\n".join(out).strip()
 
-def render_welcome_text(shop_owner_id: int) -> str:
-    s = get_shop_settings(shop_owner_id)
-    base = (s["welcome_text"] or "").strip()
-
-    # Seller shops: apply branding only if NOT whitelabel active
-    if shop_owner_id != SUPER_ADMIN_ID:
-        if seller_active(shop_owner_id) and seller_plan(shop_owner_id) == "whitelabel":
-            return _strip_branding(base)
-        cleaned = _strip_branding(base)
-        # Always ensure the 2-line branding footer is present
-        return (cleaned + "\n\n" + BRAND_LINE).strip()
-
-    # Master shop: show branding too (welcome only)
+@functools.lru_cache(maxsize=1024)
+def _welcome_from(base: str, whitelabel: bool) -> str:
     cleaned = _strip_branding(base)
+    if whitelabel:
+        return cleaned
+    # Always ensure the 2-line branding footer is present
     return (cleaned + "\n\n" + BRAND_LINE).strip() if cleaned else BRAND_LINE
 
+def render_welcome_text(shop_owner_id: int) -> str:
+    base = (get_shop_settings(shop_owner_id)["welcome_text"] or "").strip()
+    # Seller shops drop branding only while White-Label is active; the master shop always shows it.
+    whitelabel = (shop_owner_id != SUPER_ADMIN_ID and seller_active(shop_owner_id)
+                  and seller_plan(shop_owner_id) == "whitelabel")
+    return _welcome_from(base, whitelabel)
+
 
 
 # ---------------- MENUS ----------------
+# Menus depend only on (language, role, bot kind) - or the shop id for the admin panel - so the
+# markups are built once and shared (PTB markups are immutable). ui_reload() clears the cache.
+KB_CACHE_SIZE = int((os.getenv("KB_CACHE_SIZE") or "4096").strip() or "4096")
+_KB_CACHE = LRUCache(KB_CACHE_SIZE)
+
+def cached_kb(key: Tuple, build: Callable[[], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+    markup = _KB_CACHE.get(key)
+    if markup is None:
+        markup = build()
+        _KB_CACHE.put(key, markup)
+    return markup
+
 def master_menu(uid: int) -> InlineKeyboardMarkup:
-    btns = [
-        InlineKeyboardButton(tr(uid, "btn_products"), callback_data="m:products"),
-        InlineKeyboardButton(tr(uid, "btn_wallet"), callback_data="m:wallet"),
-        InlineKeyboardButton(tr(uid, "btn_history"), callback_data="m:history"),
-        InlineKeyboardButton(tr(uid, "btn_support"), callback_data="m:support"),
-        InlineKeyboardButton(tr(uid, "btn_connect"), callback_data="m:connect"),
-        InlineKeyboardButton(tr(uid, "btn_lang"), callback_data="m:lang"),
-    ]
-    if is_super(uid):
-        btns += [
-            InlineKeyboardButton(tr(uid, "btn_admin"), callback_data="m:admin"),
-            InlineKeyboardButton(tr(uid, "btn_super"), callback_data="m:super"),
+    lang = cached_user_lang(uid)
+    def build() -> InlineKeyboardMarkup:
+        btns = [
+            InlineKeyboardButton(tr_lang(lang, "btn_products"), callback_data="m:products"),
+            InlineKeyboardButton(tr_lang(lang, "btn_wallet"), callback_data="m:wallet"),
+            InlineKeyboardButton(tr_lang(lang, "btn_history"), callback_data="m:history"),
+            InlineKeyboardButton(tr_lang(lang, "btn_support"), callback_data="m:support"),
+            InlineKeyboardButton(tr_lang(lang, "btn_connect"), callback_data="m:connect"),
+            InlineKeyboardButton(tr_lang(lang, "btn_lang"), callback_data="m:lang"),
         ]
-    return grid(btns, 2)
+        if is_super(uid):
+            btns += [
+                InlineKeyboardButton(tr_lang(lang, "btn_admin"), callback_data="m:admin"),
+                InlineKeyboardButton(tr_lang(lang, "btn_super"), callback_data="m:super"),
+            ]
+        return grid(btns, 2)
+    return cached_kb(("master", lang, is_super(uid)), build)
 
 def seller_menu(uid: int, seller_id: int) -> InlineKeyboardMarkup:
-    btns = [
-        InlineKeyboardButton(tr(uid, "btn_products"), callback_data="m:products"),
-        InlineKeyboardButton(tr(uid, "btn_wallet"), callback_data="m:wallet"),
-        InlineKeyboardButton(tr(uid, "btn_history"), callback_data="m:history"),
-        InlineKeyboardButton(tr(uid, "btn_support"), callback_data="m:support"),
-        InlineKeyboardButton(tr(uid, "btn_lang"), callback_data="m:lang"),
-    ]
-    if uid == seller_id or is_super(uid):
-        btns += [
-            InlineKeyboardButton(tr(uid, "btn_admin"), callback_data="m:admin"),
-            InlineKeyboardButton(tr(uid, "btn_extend"), callback_data="m:extend"),
+    owner = uid == seller_id or is_super(uid)
+    lang = cached_user_lang(uid)
+    def build() -> InlineKeyboardMarkup:
+        btns = [
+            InlineKeyboardButton(tr_lang(lang, "btn_products"), callback_data="m:products"),
+            InlineKeyboardButton(tr_lang(lang, "btn_wallet"), callback_data="m:wallet"),
+            InlineKeyboardButton(tr_lang(lang, "btn_history"), callback_data="m:history"),
+            InlineKeyboardButton(tr_lang(lang, "btn_support"), callback_data="m:support"),
+            InlineKeyboardButton(tr_lang(lang, "btn_lang"), callback_data="m:lang"),
         ]
-    return grid(btns, 2)
+        if owner:
+            btns += [
+                InlineKeyboardButton(tr_lang(lang, "btn_admin"), callback_data="m:admin"),
+                InlineKeyboardButton(tr_lang(lang, "btn_extend"), callback_data="m:extend"),
+            ]
+        return grid(btns, 2)
+    return cached_kb(("seller", lang, owner), build)
+
+def admin_panel_kb(sid: int) -> InlineKeyboardMarkup:
+    return cached_kb(("admin", sid), lambda: grid([
+        InlineKeyboardButton("👥 Users List", callback_data=f"a:users:{sid}"),
+        InlineKeyboardButton("📢 Broadcast", callback_data=f"a:bcast:{sid}"),
+        InlineKeyboardButton("🖼 Edit Welcome", callback_data=f"a:welcome:{sid}"),
+        InlineKeyboardButton("💳 Deposit Methods", callback_data=f"a:pm:{sid}"),
+        InlineKeyboardButton("🧩 Manage Catalog", callback_data=f"a:manage:{sid}"),
+        InlineKeyboardButton("⬅️ Menu", callback_data="m:menu"),
+    ], 2))
+
+
+# ---------------- OUTBOUND SCHEDULER ----------------
+# Telegram: ~30 messages/s per bot overall, ~1/s into one private chat, 20/min into one group.
+OUTBOUND_RATE = float((os.getenv("OUTBOUND_RATE") or "28").strip() or "28")
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_WAIT = 60  # a RetryAfter longer than this is raised to the caller instead of waited out
+OUTBOUND_BULK = "bulk"  # rate_limit_args marker for broadcast-style traffic
+
+class TokenBucket:
+    """asyncio token bucket. pause() holds back every caller (RetryAfter applies to the whole
+    bot); bulk callers also step aside while a transactional caller is waiting."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(0.01, rate)
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._urgent = 0
+        self._no_urgent = asyncio.Event()
+        self._no_urgent.set()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, bulk: bool = False):
+        if not bulk:
+            self._urgent += 1
+            self._no_urgent.clear()
+        try:
+            while True:
+                if bulk and self._urgent:
+                    await self._no_urgent.wait()
+                    continue
+                # the lock only guards the token arithmetic; waits happen outside it so a
+                # transactional caller arriving meanwhile is seen by every bulk caller on wake-up
+                async with self._lock:
+                    now = time.monotonic()
+                    if now < self._paused_until:
+                        delay = self._paused_until - now
+                    else:
+                        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                        self._last = now
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        delay = (1 - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+        finally:
+            if not bulk:
+                self._urgent -= 1
+                if not self._urgent:
+                    self._no_urgent.set()
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    ra = exc.retry_after
+    return float(ra.total_seconds() if hasattr(ra, "total_seconds") else ra)
+
+class OutboundScheduler(BaseRateLimiter):
+    """Per-bot rate limiter plugged into the Application, so every Bot API call (the _safe
+    helpers, reply_text, broadcasts) passes through it. Calls that target a chat take a token
+    from the bot-wide bucket; send*/copy*/forward* also take one from that chat's bucket.
+    Pass rate_limit_args=OUTBOUND_BULK to queue behind transactional traffic."""
+    totals: Dict[str, int] = {"calls": 0, "bulk": 0, "retry_after": 0, "gave_up": 0}
+
+    def __init__(self):
+        self.bucket = TokenBucket(OUTBOUND_RATE, max(1, int(OUTBOUND_RATE)))
+        self._chats = LRUCache(20000)  # chat_id -> TokenBucket
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = TokenBucket(20 / 60, 3) if chat_id < 0 else TokenBucket(1.0, 3)
+            self._chats.put(chat_id, b)
+        return b
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        bulk = rate_limit_args == OUTBOUND_BULK
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = -1  # @channel usernames count as groups
+        per_chat = endpoint.startswith(("send", "copy", "forward"))
+        OutboundScheduler.totals["calls"] += 1
+        if bulk:
+            OutboundScheduler.totals["bulk"] += 1
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            if per_chat:
+                await self._chat_bucket(chat_id).acquire(bulk)
+            await self.bucket.acquire(bulk)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = _retry_after_seconds(e)
+                OutboundScheduler.totals["retry_after"] += 1
+                # never hold the whole bot longer than a caller is willing to wait
+                self.bucket.pause(min(wait, OUTBOUND_MAX_WAIT) + 0.1)
+                if attempt == OUTBOUND_MAX_RETRIES or wait > OUTBOUND_MAX_WAIT:
+                    OutboundScheduler.totals["gave_up"] += 1
+                    raise
+                log.info("%s flood-limited, retrying in %.1fs", endpoint, wait)
+
+# ---------------- HTTP POOL ----------------
+HTTP_POOL_SIZE = int((os.getenv("HTTP_POOL_SIZE") or "128").strip() or "128")
+HTTP_KEEPALIVE = int((os.getenv("HTTP_KEEPALIVE") or "32").strip() or "32")
+HTTP_PER_BOT = int((os.getenv("HTTP_PER_BOT") or "8").strip() or "8")
+HTTP_POOL_TIMEOUT = float((os.getenv("HTTP_POOL_TIMEOUT") or "10").strip() or "10")
+
+# SharedRequest overrides HTTPXRequest._build_client and reads _client_kwargs. Both are PTB
+# internals, verified against this exact release only; bump it together with requirements.txt.
+PTB_VERIFIED_VERSION = "20.7"
+
+class SharedRequest(HTTPXRequest):
+    """HTTPXRequest backed by one process-wide httpx client per pool name, so every bot reuses the
+    same keep-alive connections. Each instance only adds a per-bot in-flight cap; shutdown() leaves
+    the shared client open for the other bots, aclose_all() closes them at process exit."""
+    _clients: Dict[str, httpx.AsyncClient] = {}
+
+    def __init__(self, pool: str, per_bot: int, pool_size: Optional[int], keepalive: Optional[int], **kw):
+        self._pool = pool
+        self._limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=keepalive)
+        self._slots = asyncio.Semaphore(max(1, per_bot))
+        super().__init__(pool_timeout=HTTP_POOL_TIMEOUT, **kw)
+        if not isinstance(getattr(self, "_client_kwargs", None), dict):
+            raise RuntimeError(f"SharedRequest needs python-telegram-bot=={PTB_VERIFIED_VERSION} "
+                               f"(HTTPXRequest internals changed in {telegram.__version__})")
+
+    def _build_client(self) -> httpx.AsyncClient:
+        client = self._clients.get(self._pool)
+        if client is None or client.is_closed:
+            client = self._clients[self._pool] = httpx.AsyncClient(**{**self._client_kwargs, "limits": self._limits})
+        return client
+
+    async def shutdown(self) -> None:
+        return
+
+    @classmethod
+    async def aclose_all(cls):
+        clients, cls._clients = list(cls._clients.values()), {}
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception:
+                log.exception("closing shared HTTP client")
+
+    async def do_request(self, *args, **kwargs):
+        async with self._slots:
+            return await super().do_request(*args, **kwargs)
+
+if telegram.__version__ != PTB_VERIFIED_VERSION:
+    log.warning("python-telegram-bot %s installed, SharedRequest was verified against %s",
+                telegram.__version__, PTB_VERIFIED_VERSION)
+
+def build_app(token: str) -> Application:
+    # API calls share one bounded pool; getUpdates long-polls (one per polling bot) get their own
+    # unbounded pool so they can never starve sendMessage & co.
+    return (
+        Application.builder().token(token)
+        .request(SharedRequest("api", HTTP_PER_BOT, HTTP_POOL_SIZE, HTTP_KEEPALIVE))
+        .get_updates_request(SharedRequest("poll", 1, None, None))
+        .rate_limiter(OutboundScheduler())
+        .build()
+    )
+
+# ---------------- WEBHOOK SERVER ----------------
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip().rstrip("/")
+WEBHOOK_LISTEN = (os.getenv("WEBHOOK_LISTEN") or "0.0.0.0").strip()
+WEBHOOK_PORT = int((os.getenv("WEBHOOK_PORT") or "8080").strip() or "8080")
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip() or secrets.token_urlsafe(24)
+WEBHOOK_BACKLOG = int((os.getenv("WEBHOOK_BACKLOG") or "64").strip() or "64")  # queued updates per bot
+WEBHOOK_MAX_BODY = 1 << 20
+WEBHOOK_IDLE_TIMEOUT = 75
+WEBHOOK_BACKLOG_POLL = 0.05  # seconds between queue checks while a bot's backlog is full
+MASTER_BOT_KEY = 0  # webhook path key of the master bot; seller bots use their seller_id
+
+class WebhookServer:
+    """One HTTP/1.1 endpoint for every bot: POST /<secret>/<bot_key> is decoded, put on that bot's
+    Application.update_queue and acknowledged with 200 right away, so updates are processed one at
+    a time and in order exactly as with polling. While a bot already has `backlog` updates queued
+    the reply waits, which makes Telegram slow down instead of piling up work in memory."""
+    def __init__(self, secret: str, backlog: int):
+        self.secret = secret
+        self.apps: Dict[int, Application] = {}
+        self.backlog = max(1, backlog)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: set = set()
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._client, host, port)
+        log.info("Webhook server listening on %s:%s", host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._clients):  # idle keep-alive connections would hold wait_closed()
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def url_for(self, bot_key: int) -> str:
+        return f"{WEBHOOK_URL}/{self.secret}/{int(bot_key)}"
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        line = await asyncio.wait_for(reader.readline(), WEBHOOK_IDLE_TIMEOUT)
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers: Dict[str, str] = {}
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= 100:
+                raise ValueError("too many headers")
+            name, _, value = h.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        n = int(headers.get("content-length") or 0)
+        if n < 0 or n > WEBHOOK_MAX_BODY:
+            raise ValueError("bad content-length")
+        body = await reader.readexactly(n) if n else b""
+        return method, path, headers, body
+
+    async def _handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> str:
+        if method != "POST":
+            return "405 Method Not Allowed"
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not secrets.compare_digest(parts[0], self.secret):
+            return "404 Not Found"
+        if not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), self.secret):
+            return "403 Forbidden"
+        try:
+            app = self.apps.get(int(parts[1]))
+        except ValueError:
+            app = None
+        if app is None:
+            return "404 Not Found"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception:
+            return "400 Bad Request"
+        while app.update_queue.qsize() >= self.backlog:
+            await asyncio.sleep(WEBHOOK_BACKLOG_POLL)
+        await app.update_queue.put(update)
+        return "200 OK"
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                req = await self._read_request(reader)
+                if req is None:
+                    break
+                status = await self._handle(*req)
+                keep = req[2].get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+WEBHOOK_SERVER = WebhookServer(WEBHOOK_SECRET, WEBHOOK_BACKLOG)
+
+async def fake_telegram_post(bot_key: int, update: Dict[str, Any], host: str = "127.0.0.1",
+                             port: int = WEBHOOK_PORT, secret: str = WEBHOOK_SECRET) -> int:
+    """Local stand-in for Telegram's webhook delivery: POSTs one update dict to the webhook
+    server exactly as Telegram would and returns the HTTP status code."""
+    body = json.dumps(update).encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"POST /{secret}/{int(bot_key)} HTTP/1.1\r\nHost: {host}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        status = await reader.readline()
+        return int(status.split()[1])
+    finally:
+        writer.close()
+
+# ---------------- MULTI-BOT MANAGER ----------------
+POLL_IDLE_AFTER = int((os.getenv("POLL_IDLE_AFTER") or "600").strip() or "600")        # s without updates -> idle
+POLL_PARK_AFTER = int((os.getenv("POLL_PARK_AFTER") or "21600").strip() or "21600")    # s without updates -> parked
+POLL_PARK_INTERVAL = float((os.getenv("POLL_PARK_INTERVAL") or "15").strip() or "15")
+POLL_BACKOFF_MAX = 600
+POLL_PROFILES: Dict[str, Tuple[float, int]] = {
+    # mode -> (pause between getUpdates calls, long-poll timeout); an update always ends a long poll early
+    "active": (0.0, 10),
+    "idle": (0.0, 50),
+    "parked": (POLL_PARK_INTERVAL, 50),
+}
 
+class PollState:
+    """Per-bot polling bookkeeping for BotManager.tune_polling()."""
+    __slots__ = ("mode", "last_update", "hits", "rate", "errors", "retry_at", "waking", "lock")
+
+    def __init__(self):
+        self.mode = "active"
+        self.last_update = time.time()
+        self.hits = 0
+        self.rate = 0.0        # EWMA of updates per tune tick (~1 min)
+        self.errors = 0        # consecutive polling errors
+        self.retry_at = 0.0    # polling failed to start; retry after this time
+        self.waking = False
+        self.lock = asyncio.Lock()
 
-# ---------------- MULTI-BOT MANAGER ----------------# ---------------- MULTI-BOT MANAGER ----------------
 class BotManager:
     def __init__(self):
         self.apps: Dict[int, Application] = {}
         self.tasks: Dict[int, asyncio.Task] = {}
+        self.polling: Dict[int, PollState] = {}
+        self.master: Optional[Application] = None
+
+    def app_for(self, bot_key: int) -> Optional[Application]:
+        return self.master if bot_key == MASTER_BOT_KEY else self.apps.get(bot_key)
+
+    async def serve(self, bot_key: int, app: Application) -> Optional[asyncio.Task]:
+        """Start receiving updates for an initialized+started app: webhook when WEBHOOK_URL is set,
+        otherwise long polling (returns the polling task)."""
+        if bot_key == MASTER_BOT_KEY:
+            self.master = app
+        if WEBHOOK_URL:
+            WEBHOOK_SERVER.apps[int(bot_key)] = app
+            await app.bot.set_webhook(
+                url=WEBHOOK_SERVER.url_for(bot_key),
+                secret_token=WEBHOOK_SERVER.secret,
+                drop_pending_updates=True,
+            )
+            return None
+        return spawn(self._poll(bot_key, app, "active", drop_pending_updates=True), name=f"poll:{bot_key}")
+
+    async def _poll(self, bot_key: int, app: Application, mode: str, drop_pending_updates: bool = False):
+        st = self.polling.get(bot_key)
+        interval, timeout = POLL_PROFILES[mode]
+        try:
+            await app.updater.start_polling(
+                poll_interval=interval,
+                timeout=timeout,
+                bootstrap_retries=3 if st else -1,
+                drop_pending_updates=drop_pending_updates,
+                error_callback=functools.partial(self._poll_error, bot_key) if st else None,
+            )
+        except Exception:
+            if st is None:
+                raise
+            st.errors += 1
+            delay = min(POLL_BACKOFF_MAX, 5 * 2 ** min(st.errors, 10))
+            st.retry_at = time.time() + delay
+            log.warning("polling start failed bot=%s, retry in %ss", bot_key, delay)
+            return
+        if st:
+            st.mode = mode
+            st.retry_at = 0.0
+
+    def _poll_error(self, bot_key: int, exc: Exception):
+        st = self.polling.get(bot_key)
+        if not st:
+            return
+        st.errors += 1
+        if st.errors == 1 or st.errors % 50 == 0:
+            log.warning("polling error bot=%s (%s in a row): %s", bot_key, st.errors, exc)
+
+    def note_update(self, bot_key: int):
+        st = self.polling.get(bot_key)
+        if not st:
+            return
+        st.last_update = time.time()
+        st.hits += 1
+        st.errors = 0
+        if st.mode != "active" and not st.waking:
+            st.waking = True
+            spawn(self._repoll(bot_key, "active"), name=f"repoll:{bot_key}")
+
+    async def _repoll(self, bot_key: int, mode: str):
+        st = self.polling.get(bot_key)
+        app = self.apps.get(bot_key)
+        if not st or not app:
+            return
+        try:
+            async with st.lock:
+                if st.mode == mode and app.updater.running:
+                    return
+                if app.updater.running:
+                    await app.updater.stop()
+                await self._poll(bot_key, app, mode)
+        except Exception:
+            log.exception("repoll failed bot=%s", bot_key)
+        finally:
+            st.waking = False
+
+    async def tune_polling(self):
+        """Move polling bots between active / idle / parked by time since their last update, and
+        restart bots whose polling failed once their backoff has passed."""
+        now = time.time()
+        jobs = []
+        for key, st in list(self.polling.items()):
+            st.rate = 0.7 * st.rate + 0.3 * st.hits
+            st.hits = 0
+            idle = now - st.last_update
+            mode = "active" if idle < POLL_IDLE_AFTER else "idle" if idle < POLL_PARK_AFTER else "parked"
+            if st.retry_at:
+                if now >= st.retry_at:
+                    jobs.append(self._repoll(key, mode))
+            elif mode != st.mode:
+                jobs.append(self._repoll(key, mode))
+        if jobs:
+            await asyncio.gather(*jobs)
+
+    def polling_stats(self) -> Dict[str, int]:
+        out = {"active": 0, "idle": 0, "parked": 0, "retrying": 0}
+        for st in list(self.polling.values()):
+            out["retrying" if st.retry_at else st.mode] += 1
+        return out
 
     async def start_seller_bot(self, seller_id: int, token: str):
         await self.stop_seller_bot(seller_id)
-        app = Application.builder().token(token).build()
+        app = build_app(token)
         register_handlers(app, shop_owner_id=seller_id, bot_kind="seller")
-        await app.initialize()
-        await app.start()
-        task = asyncio.create_task(app.updater.start_polling(drop_pending_updates=True))
+        try:
+            await app.initialize()
+            await app.start()
+        except BaseException:
+            # failed or cancelled (start_many timeout) before it was registered: release it here
+            try:
+                if app.running:
+                    await app.stop()
+                await app.shutdown()
+            except Exception:
+                pass
+            raise
         self.apps[seller_id] = app
-        self.tasks[seller_id] = task
+        if not WEBHOOK_URL:
+            self.polling[seller_id] = PollState()
+        task = await self.serve(seller_id, app)
+        if task:
+            self.tasks[seller_id] = task
         log.info("Started seller bot seller_id=%s", seller_id)
 
     async def stop_seller_bot(self, seller_id: int):
         task = self.tasks.pop(seller_id, None)
         app = self.apps.pop(seller_id, None)
+        self.polling.pop(seller_id, None)
         if not app:
             return
         try:
@@ -1404,6 +2774,11 @@ class BotManager:
                 task.cancel()
         except Exception:
             pass
+        if WEBHOOK_SERVER.apps.pop(seller_id, None) is not None:
+            try:
+                await app.bot.delete_webhook()
+            except Exception:
+                pass
         try:
             await app.updater.stop()
         except Exception:
@@ -1415,25 +2790,404 @@ class BotManager:
             pass
         log.info("Stopped seller bot seller_id=%s", seller_id)
 
+    async def start_many(self, bots: List[Tuple[int, str]], concurrency: int, timeout: float) -> Tuple[int, int]:
+        """Start seller bots in parallel, at most `concurrency` at a time and `timeout` seconds each.
+        Returns (started, failed)."""
+        sem = asyncio.Semaphore(max(1, concurrency))
+        done = {"ok": 0, "fail": 0, "skip": 0}
+        step = max(1, len(bots) // 10)
+
+        async def one(sid: int, token: str):
+            async with sem:
+                try:
+                    if not await run_db(seller_bot_startable, sid):
+                        done["skip"] += 1
+                    else:
+                        await asyncio.wait_for(self.start_seller_bot(sid, token), timeout)
+                        done["ok"] += 1
+                except asyncio.TimeoutError:
+                    done["fail"] += 1
+                    log.warning("Seller bot %s did not start within %ss", sid, timeout)
+                    await self.stop_seller_bot(sid)
+                except Exception:
+                    done["fail"] += 1
+                    log.exception("Failed to start seller bot %s", sid)
+                finished = done["ok"] + done["fail"] + done["skip"]
+                if finished % step == 0 or finished == len(bots):
+                    log.info("Seller bots: %s/%s done (%s started, %s failed, %s skipped)",
+                             finished, len(bots), done["ok"], done["fail"], done["skip"])
+
+        await asyncio.gather(*(one(sid, token) for sid, token in bots))
+        return done["ok"], done["fail"]
+
 MANAGER = BotManager()
 
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {
+        "users": _USER_CACHE.stats(),
+        "shop_members": _SHOP_MEMBERS.stats(),
+        "shop_settings": _SETTINGS_CACHE.stats(),
+        "sellers": _SELLER_CACHE.stats(),
+        "welcome": _welcome_from.cache_info()._asdict(),
+        "lang": _LANG_CACHE.stats(),
+        "keyboards": _KB_CACHE.stats(),
+        "catalog": _CATALOG_CACHE.stats(),
+        "bans": _BAN_CACHE.stats(),
+    }
+
+EXPIRY_MAX_SLEEP = 3600  # full re-sweep at least hourly, in case a write bypassed wake()
+
+class ExpiryScheduler:
+    """Stops seller bots when their subscription ends or the shop gets banned/restricted.
+
+    Keeps a min-heap of (deadline, seller_id) built from sub_until / restricted_until and sleeps
+    until the earliest one. Seller writes call wake(seller_id) (from any thread) so changed
+    deadlines are picked up immediately instead of on a polling tick. _next holds each seller's
+    current deadline; heap entries that no longer match it are stale and skipped on pop."""
+    def __init__(self):
+        self._heap: List[Tuple[int, int]] = []
+        self._next: Dict[int, int] = {}
+        self._dirty: set = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+
+    def wake(self, seller_id: int):
+        with self._lock:
+            self._dirty.add(int(seller_id))
+        loop, event = self._loop, self._event
+        if loop and event and not loop.is_closed():
+            loop.call_soon_threadsafe(event.set)
+
+    async def _stop(self, seller_id: int):
+        await run_db(disable_seller_bot, seller_id)
+        await MANAGER.stop_seller_bot(seller_id)
+        log.info("Seller bot %s stopped: subscription ended or shop restricted", seller_id)
+
+    async def _sweep(self):
+        """Full pass: one indexed query for bots to stop, then rebuild the deadline heap."""
+        for sid in await run_db(list_expired_seller_bots):
+            await self._stop(sid)
+        nxt: Dict[int, int] = {}
+        for t, sid in await run_db(seller_bot_deadlines):
+            if t < nxt.get(sid, t + 1):
+                nxt[sid] = t
+        self._next = nxt
+        self._heap = [(t, sid) for sid, t in nxt.items()]
+        heapq.heapify(self._heap)
+
+    def _schedule(self, sid: int, t: int, old: Optional[int]):
+        # `old` is the deadline already in the heap (if any); an unchanged one is not pushed again
+        self._next[sid] = t
+        if t != old:
+            heapq.heappush(self._heap, (t, sid))
+
+    def _drop_stale(self):
+        while self._heap and self._next.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    async def _check(self, seller_ids: set):
+        for sid in seller_ids:
+            if is_super(sid):
+                continue
+            old = self._next.pop(sid, None)
+            sb = await run_db(get_seller_bot, sid)
+            if not sb or int(sb["enabled"] or 0) != 1:
+                continue
+            if not await run_db(seller_bot_startable, sid):
+                await self._stop(sid)
+                continue
+            r = await run_db(seller_row, sid)
+            future = [t for t in (int(r["sub_until"] or 0), int(r["restricted_until"] or 0)) if t > ts()]
+            if future:
+                self._schedule(sid, min(future), old)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        last_sweep = -float(EXPIRY_MAX_SLEEP)
+        while True:
+            self._event.clear()
+            try:
+                if time.monotonic() - last_sweep >= EXPIRY_MAX_SLEEP:
+                    with self._lock:
+                        self._dirty.clear()
+                    await self._sweep()
+                    last_sweep = time.monotonic()
+                else:
+                    now = ts()
+                    with self._lock:
+                        due, self._dirty = self._dirty, set()
+                    self._drop_stale()
+                    while self._heap and self._heap[0][0] <= now:
+                        t, sid = heapq.heappop(self._heap)
+                        if self._next.get(sid) == t:
+                            due.add(sid)
+                        self._drop_stale()
+                    if due:
+                        await self._check(due)
+            except Exception:
+                log.exception("expiry scheduler")
+            delay = EXPIRY_MAX_SLEEP - (time.monotonic() - last_sweep)
+            self._drop_stale()
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - ts())
+            try:
+                await asyncio.wait_for(self._event.wait(), max(0.5, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"deadlines": len(self._next), "heap": len(self._heap),
+                "next_in": (self._heap[0][0] - ts()) if self._heap else -1}
+
+EXPIRY = ExpiryScheduler()
+
+# ---------------- BROADCAST ENGINE ----------------
+# pacing, per-chat spacing and RetryAfter waits come from the bot's OutboundScheduler (bulk class)
+BROADCAST_WORKERS = int((os.getenv("BROADCAST_WORKERS") or "8").strip() or "8")
+BROADCAST_PAGE = 200
+BROADCAST_PROGRESS_SECONDS = 5.0
+BROADCAST_RETRIES = 4
+
+class BroadcastEngine:
+    """Runs broadcast_jobs rows: recipients are paged in user_id order, sent by a few workers
+    as bulk traffic through the bot's OutboundScheduler, and the cursor is persisted after every page so a restart
+    resumes where it stopped (at most one page is re-sent). The watchdog calls resume() every
+    minute, so a job whose bot was down or whose run crashed is picked up again without a restart."""
+    def __init__(self):
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._parked: Set[int] = set()  # running jobs whose bot is not up; warned about once
+
+    def start(self, job_id: int):
+        if job_id not in self.tasks:
+            self.tasks[job_id] = spawn(self._run(job_id), name=f"broadcast:{job_id}")
+
+    async def resume(self):
+        for job in await run_db(list_running_broadcasts):
+            job_id = int(job["id"])
+            if job_id not in self.tasks and job_id not in self._parked:
+                log.info("Resuming broadcast job %s at user_id>%s", job_id, job["last_user_id"])
+            self.start(job_id)
+
+    async def _send(self, bot, job: sqlite3.Row, uid: int) -> bool:
+        file_id, ftype, text = job["file_id"] or "", job["file_type"] or "", job["text"] or ""
+        for attempt in range(BROADCAST_RETRIES):
+            try:
+                if file_id and ftype == "photo":
+                    await bot.send_photo(uid, photo=file_id, caption=text or None, rate_limit_args=OUTBOUND_BULK)
+                elif file_id and ftype == "video":
+                    await bot.send_video(uid, video=file_id, caption=text or None, rate_limit_args=OUTBOUND_BULK)
+                else:
+                    await bot.send_message(uid, text or " ", rate_limit_args=OUTBOUND_BULK)
+                return True
+            except RetryAfter:
+                pass  # the scheduler already waited out its retries; the bucket stays paused
+            except (Forbidden, BadRequest):
+                return False
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(1 + 2 * attempt)
+            except Exception:
+                log.exception("broadcast send failed job=%s user=%s", job["id"], uid)
+                return False
+        return False
+
+    async def _report(self, bot, job: sqlite3.Row, sent: int, failed: int, status: str):
+        if not int(job["chat_id"] or 0) or not int(job["message_id"] or 0):
+            return
+        if status == "running":
+            txt = f"📢 Broadcasting… <b>{sent + failed}</b>/<b>{int(job['total'])}</b>\nSent: <b>{sent}</b>\nFailed: <b>{failed}</b>"
+            markup = kb([[InlineKeyboardButton("⏹ Stop", callback_data=f"b:stop:{job['id']}")]])
+        elif status == "paused":
+            txt = f"⏸ Broadcast paused, retrying shortly…\nSent: <b>{sent}</b>\nFailed: <b>{failed}</b>"
+            markup = kb([[InlineKeyboardButton("⏹ Stop", callback_data=f"b:stop:{job['id']}")]])
+        else:
+            head = "✅ Broadcast done." if status == "done" else "⏹ Broadcast stopped."
+            txt = f"{head}\nSent: <b>{sent}</b>\nFailed: <b>{failed}</b>"
+            markup = None
+        try:
+            await bot.edit_message_text(txt, chat_id=int(job["chat_id"]), message_id=int(job["message_id"]),
+                                        parse_mode=ParseMode.HTML, reply_markup=markup)
+        except Exception:
+            pass
+
+    async def _run(self, job_id: int):
+        job, app, sent, failed = None, None, 0, 0
+        try:
+            job = await run_db(broadcast_get, job_id)
+            if not job or job["status"] != "running":
+                self._parked.discard(job_id)
+                return
+            bot_key = int(job["bot_key"])
+            app = MANAGER.app_for(bot_key)
+            if app is None:
+                if job_id not in self._parked:
+                    self._parked.add(job_id)
+                    log.warning("Broadcast job %s: bot %s is not running, waiting for it", job_id, bot_key)
+                return
+            self._parked.discard(job_id)
+            sid = int(job["shop_owner_id"])
+            cursor, sent, failed = int(job["last_user_id"] or 0), int(job["sent"] or 0), int(job["failed"] or 0)
+            sem = asyncio.Semaphore(max(1, BROADCAST_WORKERS))
+            last_report = 0.0
+            status = "running"
+
+            async def one(uid: int) -> bool:
+                async with sem:
+                    return await self._send(app.bot, job, uid)
+
+            while status == "running":
+                ids = await run_db(broadcast_recipients, sid, cursor, BROADCAST_PAGE)
+                if not ids:
+                    status = "done" if await run_db(broadcast_finish, job_id, "done") else "cancelled"
+                    break
+                if not int(job["message_id"] or 0):
+                    # picked up by the watchdog before broadcast_done stored the status message
+                    job = await run_db(broadcast_get, job_id) or job
+                ok = sum(await asyncio.gather(*(one(uid) for uid in ids)))
+                sent, failed, cursor = sent + ok, failed + len(ids) - ok, ids[-1]
+                status = await run_db(broadcast_progress, job_id, cursor, sent, failed)
+                if status == "running" and time.monotonic() - last_report >= BROADCAST_PROGRESS_SECONDS:
+                    last_report = time.monotonic()
+                    await self._report(app.bot, job, sent, failed, status)
+            await self._report(app.bot, job, sent, failed, status)
+            log.info("Broadcast job %s %s: sent=%s failed=%s", job_id, status, sent, failed)
+        except Exception:
+            log.exception("broadcast job %s crashed; the watchdog retries it", job_id)
+            if app is not None and job is not None:
+                await self._report(app.bot, job, sent, failed, "paused")
+        finally:
+            self.tasks.pop(job_id, None)
+
+BROADCASTS = BroadcastEngine()
+
 async def watchdog():
     while True:
         try:
-            for r in list_enabled_seller_bots():
-                sid = int(r["seller_id"])
-                if not seller_active(sid) or int(seller_row(sid)["banned_shop"] or 0) == 1:
-                    disable_seller_bot(sid)
-                    await MANAGER.stop_seller_bot(sid)
+            await MANAGER.tune_polling()
+            await BROADCASTS.resume()
+            log.info("cache stats %s", cache_stats())
+            log.info("polling %s expiry %s outbound %s state %s", MANAGER.polling_stats(), EXPIRY.stats(), OutboundScheduler.totals, STATE.stats())
+            log.info("callback routes %s", ROUTE_STATS.snapshot())
             await asyncio.sleep(60)
         except Exception:
             log.exception("watchdog loop")
             await asyncio.sleep(60)
 
+STOCK_RECONCILE_MINUTES = int((os.getenv("STOCK_RECONCILE_MINUTES") or "60").strip() or "60")
+
+async def stock_reconciler():
+    # first pass right after boot, then every STOCK_RECONCILE_MINUTES
+    while True:
+        try:
+            fixed = await run_db(reconcile_stock)
+            if fixed:
+                log.warning("reconcile_stock fixed %s product(s)", len(fixed))
+        except Exception:
+            log.exception("stock reconcile loop")
+        await asyncio.sleep(max(1, STOCK_RECONCILE_MINUTES) * 60)
+
 # ---------------- STATE HELPERS ----------------
+STATE_FLUSH_SECONDS = float((os.getenv("STATE_FLUSH_SECONDS") or "2").strip() or "2")
+STATE_MAX_AGE = int((os.getenv("STATE_MAX_AGE_DAYS") or "7").strip() or "7") * 86400
+
+def _json_roundtrips(v: Any) -> bool:
+    # only values that reload with the same type: tuples, sets, datetimes etc. would not
+    if v is None or isinstance(v, (str, bool, int, float)):
+        return True
+    if isinstance(v, list):
+        return all(_json_roundtrips(x) for x in v)
+    if isinstance(v, dict):
+        return all(isinstance(k, str) and _json_roundtrips(x) for k, x in v.items())
+    return False
+
+class StateStore:
+    """Write-behind persistence for context.user_data. A user's saved data is loaded once per
+    process (first update from them), writes only mark the dict dirty, and run() flushes all
+    dirty users in one batched write. Keys starting with "__" stay in memory only.
+
+    "__key" is only set once the load succeeded: until then mark() is a no-op, so a failed load
+    can never flush an empty dict over the saved row, and the next update retries it."""
+    def __init__(self):
+        self._dirty: Dict[Tuple[int, int], dict] = {}
+        self._loading: Dict[Tuple[int, int], List[Any]] = {}  # key -> [asyncio.Lock, waiters]
+        self.flushed = 0
+        self.skipped = 0
+
+    async def load(self, user_data: dict, bot_key: int, user_id: int):
+        if "__key" in user_data:
+            return
+        key = (bot_key, user_id)
+        slot = self._loading.get(key)
+        if slot is None:
+            slot = self._loading[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                if "__key" in user_data:  # loaded by the update we waited behind
+                    return
+                saved = await run_db(user_state_load, bot_key, user_id, STATE_MAX_AGE)
+                for k, v in saved.items():
+                    user_data.setdefault(k, v)
+                user_data["__key"] = key
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._loading[key]
+
+    def mark(self, context: ContextTypes.DEFAULT_TYPE):
+        ud = context.user_data
+        key = ud.get("__key") if ud is not None else None
+        if key:
+            self._dirty[key] = ud
+
+    async def flush(self) -> int:
+        if not self._dirty:
+            return 0
+        batch, self._dirty = self._dirty, {}
+        rows = []
+        for (bot_key, uid), ud in batch.items():
+            data = {}
+            for k, v in ud.items():
+                if str(k).startswith("__"):
+                    continue
+                if not isinstance(k, str) or not _json_roundtrips(v):
+                    self.skipped += 1
+                    log.warning("user_data %r of user %s (bot %s) is not JSON-safe (%s); not persisted",
+                                k, uid, bot_key, type(v).__name__)
+                    continue
+                data[k] = v
+            rows.append((bot_key, uid, json.dumps(data, separators=(",", ":"))))
+        try:
+            await run_db(user_state_save, rows)
+        except Exception:
+            for k, v in batch.items():
+                self._dirty.setdefault(k, v)
+            raise
+        self.flushed += len(rows)
+        return len(rows)
+
+    async def run(self):
+        last_purge = 0.0
+        while True:
+            await asyncio.sleep(STATE_FLUSH_SECONDS)
+            try:
+                await self.flush()
+                if time.monotonic() - last_purge >= 3600:
+                    last_purge = time.monotonic()
+                    await run_db(user_state_purge, STATE_MAX_AGE)
+            except Exception:
+                log.exception("user state flush")
+
+    def stats(self) -> Dict[str, int]:
+        return {"dirty": len(self._dirty), "flushed": self.flushed, "skipped": self.skipped}
+
+STATE = StateStore()
+
 def set_state(context: ContextTypes.DEFAULT_TYPE, key: str, data: Dict[str, Any]):
     context.user_data["state"] = key
     context.user_data["state_data"] = data
+    STATE.mark(context)
 
 def get_state(context: ContextTypes.DEFAULT_TYPE) -> Tuple[Optional[str], Dict[str, Any]]:
     return context.user_data.get("state"), (context.user_data.get("state_data") or {})
@@ -1441,2431 +3195,2442 @@ def get_state(context: ContextTypes.DEFAULT_TYPE) -> Tuple[Optional[str], Dict[s
 def clear_state(context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("state", None)
     context.user_data.pop("state_data", None)
+    STATE.mark(context)
 
-# ---------------- HANDLERS (REGISTER PER BOT) ----------------
-def register_handlers(app: Application, shop_owner_id: int, bot_kind: str):
-    # bot_kind: master / seller
-
-    def current_shop_id() -> int:
-        return shop_owner_id if bot_kind == "seller" else SUPER_ADMIN_ID
-
-    async def show_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        uid = update.effective_user.id
-        sid = current_shop_id()
-        ensure_balance(sid, uid)
-
-        s = get_shop_settings(sid)
-        file_id = (s["welcome_file_id"] or "").strip()
-        ftype = (s["welcome_file_type"] or "").strip()
-
-        if bot_kind == "seller":
-            title = f"🏬 <b>{esc(user_display(sid))} Shop</b>\n\n"
-            menu = seller_menu(uid, sid)
-        else:
-            title = f"🏬 <b>{esc(STORE_NAME)}</b>\n\n"
-            menu = master_menu(uid)
-
-        text = render_welcome_text(sid)
-        caption = title + (text or "")
-
-        if file_id and ftype == "photo":
-            await _send_photo_safe(context.bot, update.effective_chat.id, photo=file_id, caption=caption, reply_markup=menu)
-        elif file_id and ftype == "video":
-            await _send_video_safe(context.bot, update.effective_chat.id, video=file_id, caption=caption, reply_markup=menu)
-        else:
-            await _send_html_safe(context.bot, update.effective_chat.id, caption, reply_markup=menu)
+# ---------------- CALLBACK ROUTER ----------------
+_ARG_TYPES: Dict[str, Callable[[str], Any]] = {"str": str, "int": int}
+_ROUTE_SEG = re.compile(r"\{[^{}]*\}|[^:{}]+")
 
-    async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        log.info("✅ /start received | bot_kind=%s | user_id=%s", bot_kind, update.effective_user.id)
-        upsert_user(update.effective_user)
-        uid = update.effective_user.id
+class RouteStats:
+    """Per-route hit count and handler latency, shared by every bot's router."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, List[float]] = {}  # pattern -> [hits, errors, total_s, max_s]
+
+    def record(self, pattern: str, elapsed: float, ok: bool):
+        with self._lock:
+            s = self._data.get(pattern)
+            if s is None:
+                s = self._data[pattern] = [0, 0, 0.0, 0.0]
+            s[0] += 1
+            if not ok:
+                s[1] += 1
+            s[2] += elapsed
+            s[3] = max(s[3], elapsed)
+
+    def snapshot(self, top: int = 15) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            items = sorted(self._data.items(), key=lambda kv: kv[1][0], reverse=True)[:top]
+        return {
+            p: {"hits": int(h), "errors": int(e), "avg_ms": round(t * 1000 / h, 1), "max_ms": round(m * 1000, 1)}
+            for p, (h, e, t, m) in items
+        }
+
+ROUTE_STATS = RouteStats()
+
+class CallbackRouter:
+    """Maps callback_data to handlers by longest literal prefix.
+
+    Patterns are colon separated: literal segments first, then typed arguments
+    `{name}`, `{name:int}` or a trailing `{name:rest}` that keeps the remaining
+    colons. Arguments are parsed once and passed to the handler as keywords,
+    together with any fixed keywords given to add()."""
+    def __init__(self, stats: Optional[RouteStats] = None):
+        self.stats = stats or ROUTE_STATS
+        self._routes: Dict[str, List[Tuple[str, List[Tuple[str, str]], Callable, Dict[str, Any]]]] = {}
+        self._depths: List[int] = []
+
+    def add(self, pattern: str, handler: Callable, **fixed):
+        lits: List[str] = []
+        args: List[Tuple[str, str]] = []
+        for seg in _ROUTE_SEG.findall(pattern):
+            if seg.startswith("{"):
+                name, _, typ = seg[1:-1].partition(":")
+                typ = typ or "str"
+                if typ != "rest" and typ not in _ARG_TYPES:
+                    raise ValueError(f"unknown argument type in {pattern!r}")
+                args.append((name, typ))
+            elif args:
+                raise ValueError(f"literal after argument in {pattern!r}")
+            else:
+                lits.append(seg)
+        if any(typ == "rest" for _, typ in args[:-1]):
+            raise ValueError(f"rest argument must be last in {pattern!r}")
+        prefix = ":".join(lits)
+        self._routes.setdefault(prefix, []).append((pattern, args, handler, fixed))
+        if len(lits) not in self._depths:
+            self._depths.append(len(lits))
+            self._depths.sort(reverse=True)
+
+    @staticmethod
+    def _parse(args: List[Tuple[str, str]], rest: List[str]) -> Optional[Dict[str, Any]]:
+        if args and args[-1][1] == "rest":
+            if len(rest) < len(args):
+                return None
+            rest = rest[:len(args) - 1] + [":".join(rest[len(args) - 1:])]
+        elif len(rest) != len(args):
+            return None
+        out: Dict[str, Any] = {}
+        for (name, typ), raw in zip(args, rest):
+            try:
+                out[name] = raw if typ == "rest" else _ARG_TYPES[typ](raw)
+            except ValueError:
+                return None
+        return out
+
+    def match(self, data: str) -> Optional[Tuple[str, Callable, Dict[str, Any]]]:
+        parts = (data or "").split(":")
+        for depth in self._depths:
+            if depth > len(parts):
+                continue
+            for pattern, args, handler, fixed in self._routes.get(":".join(parts[:depth]), ()):
+                kwargs = self._parse(args, parts[depth:])
+                if kwargs is not None:
+                    return pattern, handler, {**fixed, **kwargs}
+        return None
 
-        if bot_kind == "seller":
-            await show_welcome(update, context)
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        hit = self.match(q.data)
+        if hit is None:
+            await q.answer()
             return
-
-        # master session always master shop
-        set_session(uid, SUPER_ADMIN_ID, 0)
+        pattern, handler, kwargs = hit
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            await handler(update, context, **kwargs)
+            ok = True
+        finally:
+            self.stats.record(pattern, time.perf_counter() - t0, ok)
+
+# ---------------- HANDLERS ----------------
+def shop_owner_of(context: ContextTypes.DEFAULT_TYPE) -> int:
+    return int(context.bot_data["shop_owner_id"])
+
+def bot_kind_of(context: ContextTypes.DEFAULT_TYPE) -> str:
+    # master / seller
+    return context.bot_data["bot_kind"]
+
+def bot_key_of(context: ContextTypes.DEFAULT_TYPE) -> int:
+    # key of this bot in BotManager / webhook paths
+    return shop_owner_of(context) if bot_kind_of(context) == "seller" else MASTER_BOT_KEY
+
+def current_shop_id(context: ContextTypes.DEFAULT_TYPE) -> int:
+    return shop_owner_of(context) if bot_kind_of(context) == "seller" else SUPER_ADMIN_ID
+
+async def note_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # feeds BotManager's per-bot update rate; an idle/parked seller bot switches back to active polling
+    if bot_kind_of(context) == "seller":
+        MANAGER.note_update(shop_owner_of(context))
+
+async def warm_user_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # load the language and saved user_data off-loop once, so the real handler is memory-only
+    u = update.effective_user
+    if u and not user_lang_cached(u.id):
+        await run_db(get_user_lang, u.id)
+    if u and context.user_data is not None:
+        await STATE.load(context.user_data, bot_key_of(context), u.id)
+
+async def welcome_screen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Tuple[str, InlineKeyboardMarkup, str, str]:
+    """(caption, menu, file_id, file_type) of this shop's welcome."""
+    uid = update.effective_user.id
+    sid = current_shop_id(context)
+    await run_db(register_shop_user, sid, uid)
+
+    s = await run_db(get_shop_settings, sid)
+    file_id = (s["welcome_file_id"] or "").strip()
+    ftype = (s["welcome_file_type"] or "").strip()
+
+    if bot_kind_of(context) == "seller":
+        title = f"🏬 <b>{esc(await run_db(user_display, sid))} Shop</b>\n\n"
+        menu = seller_menu(uid, sid)
+    else:
+        title = f"🏬 <b>{esc(STORE_NAME)}</b>\n\n"
+        menu = master_menu(uid)
+
+    text = await run_db(render_welcome_text, sid)
+    return title + (text or ""), menu, file_id, ftype
+
+async def show_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    caption, menu, file_id, ftype = await welcome_screen(update, context)
+    msg = await _nav_send(context.bot, update.effective_chat.id, caption, menu, file_id, ftype)
+    if msg is not None and context.chat_data is not None:
+        context.chat_data["nav_id"] = msg.message_id
+
+async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log.info("✅ /start received | bot_kind=%s | user_id=%s", bot_kind_of(context), update.effective_user.id)
+    prof = user_profile_stale(update.effective_user)
+    if prof is not None:
+        await run_db(upsert_user, update.effective_user, prof)
+    uid = update.effective_user.id
+
+    if bot_kind_of(context) == "seller":
         await show_welcome(update, context)
+        return
 
-        arg = context.args[0] if context.args else ""
-        if arg == "extend":
-            await show_extend_master(update, context, uid)
-
-    async def menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        # Make menu clean: delete the callback message if possible, then show buttons only.
-        q = update.callback_query
-        if q:
-            await q.answer()
-            # cancel current state and delete previous command message
-            clear_state(context)
-            try:
-                await safe_delete(context.bot, q.message.chat_id, q.message.message_id)
-            except Exception:
-                pass
+    # master session always master shop
+    await run_db(set_session, uid, SUPER_ADMIN_ID, 0)
+    await show_welcome(update, context)
 
-        uid = update.effective_user.id
-        await show_welcome(update, context)
+    arg = context.args[0] if context.args else ""
+    if arg == "extend":
+        await show_extend_master(update, context, uid)
 
-    # ---------- Products (Category -> Sub -> Product) ----------
-    async def products_root(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
+async def menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Make menu clean: delete the callback message if possible, then show buttons only.
+    q = update.callback_query
+    if q and NAV_MODE == "edit" and is_nav_message(context, q.message):
+        await q.answer()
+        clear_state(context)
+        caption, menu, file_id, ftype = await welcome_screen(update, context)
+        await nav_show(update, context, caption, menu, file_id, ftype)
+        return
+    if q:
+        await q.answer()
+        # cancel current state and delete previous command message
+        clear_state(context)
+        try:
+            await safe_delete(context.bot, q.message.chat_id, q.message.message_id)
+        except Exception:
+            pass
 
-        cats = cat_list(sid)
-        if not cats:
-            await update.callback_query.message.reply_text("No categories yet.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
-            return
+    uid = update.effective_user.id
+    await show_welcome(update, context)
+
+# ---------- Navigation (one message per chat, edited in place) ----------
+NAV_MODE = (os.getenv("NAV_MODE") or "edit").strip().lower()
+
+async def _nav_send(bot, chat_id: int, text: str, markup, file_id: str = "", ftype: str = ""):
+    if file_id and ftype == "photo":
+        return await _send_photo_safe(bot, chat_id, photo=file_id, caption=text, reply_markup=markup)
+    if file_id and ftype == "video":
+        return await _send_video_safe(bot, chat_id, video=file_id, caption=text, reply_markup=markup)
+    return await _send_html_safe(bot, chat_id, text, reply_markup=markup)
+
+def is_nav_message(context: ContextTypes.DEFAULT_TYPE, message) -> bool:
+    # only the message we last navigated with is edited; receipts, keys etc. are never overwritten
+    return message is not None and context.chat_data is not None and context.chat_data.get("nav_id") == message.message_id
+
+async def nav_show(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, markup,
+                   file_id: str = "", ftype: str = ""):
+    """Show a catalog screen. The chat's navigation message is edited in place when the
+    media kind allows it (media -> media, text -> text); otherwise the screen is sent anew
+    and the old navigation message removed, so the chat keeps one."""
+    m = update.callback_query.message
+    bot = context.bot
+    media = ftype if file_id and ftype in ("photo", "video") else ""
+    was_nav = is_nav_message(context, m)
+    if was_nav:
+        try:
+            if media and (m.photo or m.video):
+                im = (InputMediaPhoto(file_id, caption=text, parse_mode=ParseMode.HTML) if media == "photo"
+                      else InputMediaVideo(file_id, caption=text, parse_mode=ParseMode.HTML))
+                await bot.edit_message_media(im, chat_id=m.chat_id, message_id=m.message_id, reply_markup=markup)
+                return
+            if not media and m.text is not None:
+                await bot.edit_message_text(text, chat_id=m.chat_id, message_id=m.message_id, parse_mode=ParseMode.HTML,
+                                            reply_markup=markup, disable_web_page_preview=True)
+                return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            log.debug("nav edit failed, sending anew: %s", e)
+    msg = await _nav_send(bot, m.chat_id, text, markup, file_id, media)
+    if was_nav:
+        await safe_delete(bot, m.chat_id, m.message_id)
+    if msg is not None and context.chat_data is not None:
+        context.chat_data["nav_id"] = msg.message_id
+
+def _crumb_text(crumbs: List[str], desc: str, prompt: str) -> str:
+    return " › ".join(crumbs) + (f"\n\n{esc(desc)}" if desc else "") + f"\n\n{prompt}"
+
+# ---------- Products (Category -> Sub -> Product) ----------
+async def products_root(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
 
+    cats = await run_db(cat_list, sid)
+    if not cats:
+        prompt = "No categories yet."
+        rows = [[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]
+    else:
+        prompt = "Select Category:"
         rows = [[InlineKeyboardButton(c["name"], callback_data=f"p:cat:{c['id']}")] for c in cats[:50]]
         rows.append([InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")])
-        await update.callback_query.message.reply_text("Select Category:", reply_markup=kb(rows))
-
-    async def products_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
-        cat_id = int(update.callback_query.data.split(":")[2])
-
-        c = cat_get(sid, cat_id)
-        if c:
-            c_desc = (c["description"] or "").strip()
-            c_file_id = (c["file_id"] or "").strip()
-            c_ftype = (c["file_type"] or "").strip()
-            c_caption = f"📁 <b>{esc(c['name'])}</b>" + (f"\n\n{esc(c_desc)}" if c_desc else "")
-            if c_file_id and c_ftype == "photo":
-                await update.callback_query.message.reply_photo(photo=c_file_id, caption=c_caption, parse_mode=ParseMode.HTML)
-            elif c_file_id and c_ftype == "video":
-                await update.callback_query.message.reply_video(video=c_file_id, caption=c_caption, parse_mode=ParseMode.HTML)
-            elif c_desc:
-                await update.callback_query.message.reply_text(c_caption, parse_mode=ParseMode.HTML)
-        subs = cocat_list(sid, cat_id)
-        if not subs:
-            await update.callback_query.message.reply_text("No sub-categories yet.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:products")],[InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]]))
-            return
+    if NAV_MODE == "edit":
+        await nav_show(update, context, _crumb_text(["🛍 <b>Products</b>"], "", prompt), kb(rows))
+        return
+    await update.callback_query.message.reply_text(prompt, reply_markup=kb(rows))
+
+async def products_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
+
+    c = await run_db(cat_get, sid, cat_id)
+    subs = await run_db(cocat_list, sid, cat_id)
+    if not subs:
+        prompt = "No sub-categories yet."
+        rows = [[InlineKeyboardButton("⬅️ Back", callback_data="m:products")],[InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]]
+    else:
+        prompt = "Select Sub-Category:"
         rows = [[InlineKeyboardButton(sc["name"], callback_data=f"p:sub:{cat_id}:{sc['id']}")] for sc in subs[:50]]
         rows.append([InlineKeyboardButton("⬅️ Back", callback_data="m:products"), InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
-        await update.callback_query.message.reply_text("Select Sub-Category:", reply_markup=kb(rows))
-
-    async def products_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
-        _, _, cat_s, sub_s = update.callback_query.data.split(":")
-        cat_id = int(cat_s); sub_id = int(sub_s)
-
-        sc = cocat_get(sid, sub_id)
-        if sc:
-            sc_desc = (sc["description"] or "").strip()
-            sc_file_id = (sc["file_id"] or "").strip()
-            sc_ftype = (sc["file_type"] or "").strip()
-            sc_caption = f"📂 <b>{esc(sc['name'])}</b>" + (f"\n\n{esc(sc_desc)}" if sc_desc else "")
-            if sc_file_id and sc_ftype == "photo":
-                await update.callback_query.message.reply_photo(photo=sc_file_id, caption=sc_caption, parse_mode=ParseMode.HTML)
-            elif sc_file_id and sc_ftype == "video":
-                await update.callback_query.message.reply_video(video=sc_file_id, caption=sc_caption, parse_mode=ParseMode.HTML)
-            elif sc_desc:
-                await update.callback_query.message.reply_text(sc_caption, parse_mode=ParseMode.HTML)
-        prods = prod_list(sid, cat_id, sub_id)
-        if not prods:
-            await update.callback_query.message.reply_text("No products yet.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"p:cat:{cat_id}")],[InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]]))
-            return
+    if NAV_MODE == "edit":
+        crumbs = ["🛍 Products"] + ([f"📁 <b>{esc(c['name'])}</b>"] if c else [])
+        desc = (c["description"] or "").strip() if c else ""
+        await nav_show(update, context, _crumb_text(crumbs, desc, prompt), kb(rows),
+                       (c["file_id"] or "").strip() if c else "", (c["file_type"] or "").strip() if c else "")
+        return
+
+    if c:
+        c_desc = (c["description"] or "").strip()
+        c_file_id = (c["file_id"] or "").strip()
+        c_ftype = (c["file_type"] or "").strip()
+        c_caption = f"📁 <b>{esc(c['name'])}</b>" + (f"\n\n{esc(c_desc)}" if c_desc else "")
+        if c_file_id and c_ftype == "photo":
+            await update.callback_query.message.reply_photo(photo=c_file_id, caption=c_caption, parse_mode=ParseMode.HTML)
+        elif c_file_id and c_ftype == "video":
+            await update.callback_query.message.reply_video(video=c_file_id, caption=c_caption, parse_mode=ParseMode.HTML)
+        elif c_desc:
+            await update.callback_query.message.reply_text(c_caption, parse_mode=ParseMode.HTML)
+    await update.callback_query.message.reply_text(prompt, reply_markup=kb(rows))
+
+async def products_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int, sub_id: int):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
+
+    sc = await run_db(cocat_get, sid, sub_id)
+    prods = await run_db(prod_list, sid, cat_id, sub_id)
+    if not prods:
+        prompt = "No products yet."
+        rows = [[InlineKeyboardButton("⬅️ Back", callback_data=f"p:cat:{cat_id}")],[InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]]
+    else:
+        prompt = "Select Product:"
         rows = [[InlineKeyboardButton(p["name"], callback_data=f"p:prod:{p['id']}")] for p in prods[:50]]
         rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"p:cat:{cat_id}"), InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
-        await update.callback_query.message.reply_text("Select Product:", reply_markup=kb(rows))
+    if NAV_MODE == "edit":
+        c = await run_db(cat_get, sid, cat_id)
+        crumbs = ["🛍 Products"] + ([f"📁 {esc(c['name'])}"] if c else []) + ([f"📂 <b>{esc(sc['name'])}</b>"] if sc else [])
+        desc = (sc["description"] or "").strip() if sc else ""
+        await nav_show(update, context, _crumb_text(crumbs, desc, prompt), kb(rows),
+                       (sc["file_id"] or "").strip() if sc else "", (sc["file_type"] or "").strip() if sc else "")
+        return
 
-    async def product_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        pid = int(update.callback_query.data.split(":")[2])
-        p = prod_get(sid, pid)
-        if not p:
-            await update.callback_query.message.reply_text("Product not found.")
-            return
+    if sc:
+        sc_desc = (sc["description"] or "").strip()
+        sc_file_id = (sc["file_id"] or "").strip()
+        sc_ftype = (sc["file_type"] or "").strip()
+        sc_caption = f"📂 <b>{esc(sc['name'])}</b>" + (f"\n\n{esc(sc_desc)}" if sc_desc else "")
+        if sc_file_id and sc_ftype == "photo":
+            await update.callback_query.message.reply_photo(photo=sc_file_id, caption=sc_caption, parse_mode=ParseMode.HTML)
+        elif sc_file_id and sc_ftype == "video":
+            await update.callback_query.message.reply_video(video=sc_file_id, caption=sc_caption, parse_mode=ParseMode.HTML)
+        elif sc_desc:
+            await update.callback_query.message.reply_text(sc_caption, parse_mode=ParseMode.HTML)
+    await update.callback_query.message.reply_text(prompt, reply_markup=kb(rows))
+
+QTY_PRESETS = (5, 10)
+
+def product_card(p: Product, stock: int, qty: int) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    # the chosen quantity lives in the buttons' callback data, so stepping needs no user_data
+    pid = int(p["id"])
+    price = float(p["price"])
+    total = price * qty
+
+    desc = (p["description"] or "").strip()
+    text = (
+        f"<b>{esc(p['name'])}</b>\n\n"
+        f"Price: <b>{money(price)} {esc(CURRENCY)}</b>\n"
+        f"Stock: <b>{stock}</b>\n"
+        f"Qty: <b>{qty}</b>\n"
+        f"Total: <b>{money(total)} {esc(CURRENCY)}</b>"
+    )
+    if desc:
+        text += f"\n\n{esc(desc)}"
+
+    rows = [
+        [InlineKeyboardButton("➖", callback_data=f"p:q:{pid}:{max(1, qty - 1)}"),
+         InlineKeyboardButton(f"✏️ {qty}", callback_data=f"p:qty:{pid}:{qty}"),
+         InlineKeyboardButton("➕", callback_data=f"p:q:{pid}:{qty + 1}")],
+        [InlineKeyboardButton(f"×{n}", callback_data=f"p:q:{pid}:{n}") for n in QTY_PRESETS],
+        [InlineKeyboardButton("✅ Buy", callback_data=f"p:buy:{pid}:{qty}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=f"p:sub:{p['category_id']}:{p['cocategory_id']}")],
+        [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
+    ]
+    return text, rows
+
+def clamp_qty(qty: int, stock: int) -> int:
+    # callers answer "out of stock" themselves when stock <= 0
+    return max(1, min(int(qty), stock))
+
+async def product_view(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.callback_query.message.reply_text("Product not found.")
+        return
 
-        stock = stock_count(sid, pid)
-        price = float(p["price"])
-        qty_key = f"qty_{sid}_{pid}"
-        qty = int(context.user_data.get(qty_key, 1))
-        qty = max(1, qty)
-        total = price * qty
-
-        desc = (p["description"] or "").strip()
-        text = (
-            f"<b>{esc(p['name'])}</b>\n\n"
-            f"Price: <b>{money(price)} {esc(CURRENCY)}</b>\n"
-            f"Stock: <b>{stock}</b>\n"
-            f"Qty: <b>{qty}</b>\n"
-            f"Total: <b>{money(total)} {esc(CURRENCY)}</b>"
-        )
-        if desc:
-            text += f"\n\n{esc(desc)}"
-
-        rows = [
-            [InlineKeyboardButton("➖", callback_data=f"p:q:-:{pid}"),
-             InlineKeyboardButton("➕", callback_data=f"p:q:+:{pid}"),
-             InlineKeyboardButton("✅ Buy", callback_data=f"p:buy:{pid}")],
-            [InlineKeyboardButton("⬅️ Back", callback_data=f"p:sub:{p['category_id']}:{p['cocategory_id']}")],
-            [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
-        ]
+    stock = await run_db(stock_count, sid, pid)
+    text, rows = product_card(p, stock, 1)
 
-        file_id = (p["file_id"] or "").strip()
-        ftype = (p["file_type"] or "").strip()
-        if file_id and ftype == "photo":
-            await update.callback_query.message.reply_photo(photo=file_id, caption=text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-        elif file_id and ftype == "video":
-            await update.callback_query.message.reply_video(video=file_id, caption=text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-        else:
-            await update.callback_query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def product_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        _, _, sign, pid_s = update.callback_query.data.split(":")
-        pid = int(pid_s)
-        key = f"qty_{sid}_{pid}"
-        cur = int(context.user_data.get(key, 1))
-        if sign == "+":
-            cur += 1
+    file_id = (p["file_id"] or "").strip()
+    ftype = (p["file_type"] or "").strip()
+    if NAV_MODE == "edit":
+        await nav_show(update, context, text, kb(rows), file_id, ftype)
+        return
+    if file_id and ftype == "photo":
+        await update.callback_query.message.reply_photo(photo=file_id, caption=text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    elif file_id and ftype == "video":
+        await update.callback_query.message.reply_video(video=file_id, caption=text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    else:
+        await update.callback_query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def _edit_product_card(bot, chat_id: int, message_id: int, media: bool, text: str, rows):
+    try:
+        if media:
+            await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text,
+                                           parse_mode=ParseMode.HTML, reply_markup=kb(rows))
         else:
-            cur = max(1, cur - 1)
-        context.user_data[key] = cur
-        await update.callback_query.message.reply_text("✅ Quantity updated.", reply_markup=kb([[InlineKeyboardButton("🔄 Refresh", callback_data=f"p:prod:{pid}")]]))
-
-    async def product_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
 
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
+async def product_qty(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int, qty: int):
+    # edit the product card in place: no new message, no media re-send
+    q = update.callback_query
+    sid = current_shop_id(context)
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await q.answer("Product not found.")
+        return
+    stock = await run_db(stock_count, sid, pid)
+    if stock <= 0:
+        await q.answer("❌ Out of stock.", show_alert=True)
+        return
+    want = qty
+    qty = clamp_qty(qty, stock)
+    await q.answer(f"Only {stock} in stock." if want > qty else None)
+    text, rows = product_card(p, stock, qty)
+    m = q.message
+    await _edit_product_card(context.bot, m.chat_id, m.message_id, bool(m.photo or m.video), text, rows)
+
+async def product_legacy_card(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int, step: int = 0):
+    # cards sent before the quantity moved into callback data kept it in user_data: re-render them
+    # with the current stepper (Buy included) instead of acting on the stale buttons
+    sid = current_shop_id(context)
+    qty = int(context.user_data.pop(f"qty_{sid}_{pid}", 1) or 1)
+    STATE.mark(context)
+    await product_qty(update, context, pid, max(1, qty + step))
+
+async def product_qty_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int, qty: int):
+    q = update.callback_query
+    await q.answer()
+    m = q.message
+    prompt = await m.reply_text(f"Send the quantity you want (current: {qty}).")
+    set_state(context, "qty_input", {"shop_id": current_shop_id(context), "pid": pid, "chat_id": m.chat_id,
+                                     "message_id": m.message_id, "media": bool(m.photo or m.video),
+                                     "prompt_id": prompt.message_id})
+
+async def product_qty_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _, data = get_state(context)
+    raw = (update.message.text or "").strip()
+    if not raw.isdigit() or int(raw) < 1:
+        await update.message.reply_text("Send a whole number, e.g. 3.")
+        return
+    clear_state(context)
+    sid, pid = int(data["shop_id"]), int(data["pid"])
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.message.reply_text("Product not found.")
+        return
+    stock = await run_db(stock_count, sid, pid)
+    if stock <= 0:
+        await update.message.reply_text("❌ Out of stock.")
+        return
+    qty = clamp_qty(int(raw), stock)
+    text, rows = product_card(p, stock, qty)
+    try:
+        await _edit_product_card(context.bot, int(data["chat_id"]), int(data["message_id"]), bool(data.get("media")), text, rows)
+    except BadRequest:
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+        return
+    # the card above now shows the new quantity; drop the prompt and the typed number
+    for mid in (int(data.get("prompt_id") or 0), update.message.message_id):
+        if mid:
+            try:
+                await context.bot.delete_message(update.effective_chat.id, mid)
+            except Exception:
+                pass
+    if int(raw) > qty:
+        await update.message.reply_text(f"Only {stock} in stock, quantity set to {qty}.")
 
-        pid = int(update.callback_query.data.split(":")[2])
-        p = prod_get(sid, pid)
-        if not p:
-            await update.callback_query.message.reply_text("Product not found.")
-            return
+async def product_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int, qty: int):
 
-        qty = int(context.user_data.get(f"qty_{sid}_{pid}", 1))
-        qty = max(1, qty)
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
 
-        stock = stock_count(sid, pid)
-        if stock < qty:
-            await update.callback_query.message.reply_text("❌ Out of stock / not enough stock.")
-            return
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.callback_query.message.reply_text("Product not found.")
+        return
 
-        price = float(p["price"])
-        total = price * qty
-        bal = get_balance(sid, uid)
-        if bal < total:
-            await update.callback_query.message.reply_text(
-                f"❌ Not enough balance.\nBalance: {money(bal)} {esc(CURRENCY)}",
-                parse_mode=ParseMode.HTML,
-            )
-            return
+    qty = max(1, qty)
 
-        set_balance(sid, uid, bal - total)
-        keys = pop_keys(sid, pid, uid, qty)
-
-        # Create order + history
-        order_id = gen_order_id(10)
-        try:
-            order_id = create_order(sid, uid, pid, p["name"], qty, total, keys)
-        except Exception:
-            # don't block delivery
-            pass
-
-        # Always log purchase in history
-        log_tx(sid, uid, "purchase", -total, f"{p['name']} | {order_id}", qty)
-
-        link = (p["tg_link"] or "").strip()
-
-        msg = (
-            f"✅ <b>Purchase Successful</b>\n\n"
-            f"Order ID: <b>{esc(order_id)}</b>\n"
-            f"Product: <b>{esc(p['name'])}</b>\n"
-            f"Qty: <b>{qty}</b>\n"
-            f"Paid: <b>{money(total)} {esc(CURRENCY)}</b>\n\n"
-            f"<b>Key(s):</b>\n"
-            + ("\n".join([f"<code>{esc(k)}</code>" for k in (keys or [])]) or "<i>No key delivered.</i>")
+    try:
+        res = await run_db(purchase, sid, uid, pid, qty)
+    except Exception:
+        log.exception("purchase failed shop=%s user=%s product=%s", sid, uid, pid)
+        await update.callback_query.message.reply_text("❌ Purchase failed, please try again.")
+        return
+    if res["status"] == "missing":
+        await update.callback_query.message.reply_text("Product not found.")
+        return
+    if res["status"] == "stock":
+        await update.callback_query.message.reply_text("❌ Out of stock / not enough stock.")
+        return
+    if res["status"] == "balance":
+        await update.callback_query.message.reply_text(
+            f"❌ Not enough balance.\nBalance: {money(res['balance'])} {esc(CURRENCY)}",
+            parse_mode=ParseMode.HTML,
         )
+        return
+    order_id, keys, total = res["order_id"], res["keys"], res["total"]
+
+    link = (p["tg_link"] or "").strip()
+
+    msg = (
+        f"✅ <b>Purchase Successful</b>\n\n"
+        f"Order ID: <b>{esc(order_id)}</b>\n"
+        f"Product: <b>{esc(p['name'])}</b>\n"
+        f"Qty: <b>{qty}</b>\n"
+        f"Paid: <b>{money(total)} {esc(CURRENCY)}</b>\n\n"
+        f"<b>Key(s):</b>\n"
+        + ("\n".join([f"<code>{esc(k)}</code>" for k in (keys or [])]) or "<i>No key delivered.</i>")
+    )
 
-        rows = []
-        if link:
-            rows.append([InlineKeyboardButton("📦 Get File", callback_data=f"p:file:{pid}")])
-        rows.append([InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
+    rows = []
+    if link:
+        rows.append([InlineKeyboardButton("📦 Get File", callback_data=f"p:file:{pid}")])
+    rows.append([InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
 
-        await update.callback_query.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    await update.callback_query.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
 
-        try:
-            keys_block = "\n".join(keys) if keys else "-"
-            await context.bot.send_message(
-                SUPER_ADMIN_ID,
-                f"🔔 Order\nOrder ID: {order_id}\nShop: {user_display(shop_owner_id) if bot_kind=='seller' else 'Main'}\nUser: {user_display(uid)}\nProduct: {p['name']}\nQty: {qty}\nTotal: {money(total)} {CURRENCY}\n\nKeys:\n{keys_block}",
-            )
-        except Exception:
-            pass
-    async def _extract_channel_username(link: str) -> Optional[str]:
-        link = (link or "").strip()
-        if not link:
-            return None
-        # Accept formats: @channel, t.me/channel, https://t.me/channel
-        if link.startswith("@"):
-            return re.sub(r"[^A-Za-z0-9_]", "", link[1:])
-        m = re.search(r"t\.me/([A-Za-z0-9_]{5,})", link)
-        if m:
-            return m.group(1)
+    try:
+        keys_block = "\n".join(keys) if keys else "-"
+        await context.bot.send_message(
+            SUPER_ADMIN_ID,
+            f"🔔 Order\nOrder ID: {order_id}\nShop: {await run_db(user_display, sid) if bot_kind_of(context)=='seller' else 'Main'}\nUser: {await run_db(user_display, uid)}\nProduct: {p['name']}\nQty: {qty}\nTotal: {money(total)} {CURRENCY}\n\nKeys:\n{keys_block}",
+        )
+    except Exception:
+        pass
+async def _extract_channel_username(link: str) -> Optional[str]:
+    link = (link or "").strip()
+    if not link:
         return None
+    # Accept formats: @channel, t.me/channel, https://t.me/channel
+    if link.startswith("@"):
+        return re.sub(r"[^A-Za-z0-9_]", "", link[1:])
+    m = re.search(r"t\.me/([A-Za-z0-9_]{5,})", link)
+    if m:
+        return m.group(1)
+    return None
+
+async def _need_join_message(chat_username: str) -> InlineKeyboardMarkup:
+    url = f"https://t.me/{chat_username}"
+    return kb([
+        [InlineKeyboardButton("✅ Join Channel", url=url)],
+        [InlineKeyboardButton("🔄 I Joined", callback_data="p:filecheck")],
+        [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
+    ])
+
+async def product_file(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.callback_query.message.reply_text("Not found.")
+        return
+    link = (p["tg_link"] or "").strip()
+    if not link:
+        await update.callback_query.message.reply_text("No channel set for this product.")
+        return
 
-    async def _need_join_message(chat_username: str) -> InlineKeyboardMarkup:
-        url = f"https://t.me/{chat_username}"
-        return kb([
-            [InlineKeyboardButton("✅ Join Channel", url=url)],
-            [InlineKeyboardButton("🔄 I Joined", callback_data="p:filecheck")],
-            [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
-        ])
-
-    async def product_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        pid = int(update.callback_query.data.split(":")[2])
-        p = prod_get(sid, pid)
-        if not p:
-            await update.callback_query.message.reply_text("Not found.")
-            return
-        link = (p["tg_link"] or "").strip()
-        if not link:
-            await update.callback_query.message.reply_text("No channel set for this product.")
-            return
-
-        # We gate access by requiring the user to join the channel.
-        # We do NOT show any private link. We only direct them to the channel.
-        chat_username = await _extract_channel_username(link)
-
-        if not chat_username:
-            # Can't verify membership (invite links/private). Still show join button only.
-            await update.callback_query.message.reply_text(
-                "📦 <b>Get File</b>\n\nPlease join the channel to access the files.",
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb([
-                    [InlineKeyboardButton("✅ Join Channel", url=link)],
-                    [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
-                ])
-            )
-            return
-
-        # Check membership (bot must be able to see the channel & have access to getChatMember).
-        try:
-            member = await context.bot.get_chat_member(chat_id=f"@{chat_username}", user_id=update.effective_user.id)
-            status = getattr(member, "status", "") or ""
-            joined = status not in ("left", "kicked")
-        except Exception:
-            joined = False
-
-        if not joined:
-            await update.callback_query.message.reply_text(
-                "📦 <b>Get File</b>\n\nYou must join the channel first.\nAfter joining, tap <b>I Joined</b>.",
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb([
-                    [InlineKeyboardButton("✅ Join Channel", url=f"https://t.me/{chat_username}")],
-                    [InlineKeyboardButton("🔄 I Joined", callback_data=f"p:filecheck:{pid}")],
-                    [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
-                ])
-            )
-            return
+    # We gate access by requiring the user to join the channel.
+    # We do NOT show any private link. We only direct them to the channel.
+    chat_username = await _extract_channel_username(link)
 
-        # Joined: we still do NOT show private link.
+    if not chat_username:
+        # Can't verify membership (invite links/private). Still show join button only.
         await update.callback_query.message.reply_text(
-            "✅ <b>Access Granted</b>\n\nOpen the channel to download your file(s).",
+            "📦 <b>Get File</b>\n\nPlease join the channel to access the files.",
             parse_mode=ParseMode.HTML,
             reply_markup=kb([
-                [InlineKeyboardButton("📦 Open Channel", url=f"https://t.me/{chat_username}")],
+                [InlineKeyboardButton("✅ Join Channel", url=link)],
                 [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
             ])
         )
+        return
 
+    # Check membership (bot must be able to see the channel & have access to getChatMember).
+    try:
+        member = await context.bot.get_chat_member(chat_id=f"@{chat_username}", user_id=update.effective_user.id)
+        status = getattr(member, "status", "") or ""
+        joined = status not in ("left", "kicked")
+    except Exception:
+        joined = False
 
-
-    # ---------- Wallet / Deposit ----------
-    async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
-        s = get_shop_settings(sid)
-        bal = get_balance(sid, uid)
-        wmsg = (s["wallet_message"] or "").strip()
-        text = f"💰 <b>Wallet</b>\n\nBalance: <b>{money(bal)} {esc(CURRENCY)}</b>\n\n{esc(wmsg)}"
+    if not joined:
         await update.callback_query.message.reply_text(
-            text, parse_mode=ParseMode.HTML,
+            "📦 <b>Get File</b>\n\nYou must join the channel first.\nAfter joining, tap <b>I Joined</b>.",
+            parse_mode=ParseMode.HTML,
             reply_markup=kb([
-                [InlineKeyboardButton("➕ Deposit", callback_data="w:deposit")],
-                [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
+                [InlineKeyboardButton("✅ Join Channel", url=f"https://t.me/{chat_username}")],
+                [InlineKeyboardButton("🔄 I Joined", callback_data=f"p:filecheck:{pid}")],
+                [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
             ])
         )
+        return
 
-    async def deposit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        methods = build_deposit_methods(sid)
-        if not methods:
-            set_state(context, "deposit_amount", {"shop_id": sid, "pm_id": "0", "pm_name": "Deposit"})
-            await update.callback_query.message.reply_text("Send deposit amount (example: 10):", reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")]]))
-            return
-        rows = [[InlineKeyboardButton(m["name"], callback_data=f"w:method:{m['id']}")] for m in methods[:20]]
-        rows.append([InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")])
-        await update.callback_query.message.reply_text("Choose deposit method:", reply_markup=kb(rows))
-
-    
-    async def deposit_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        parts = update.callback_query.data.split(":")
-        pm_id = parts[2] if len(parts) > 2 else "0"
-        methods = build_deposit_methods(sid)
-        chosen = None
-        for m in methods:
-            if m["id"] == pm_id:
-                chosen = m
-                break
-        if not chosen:
-            await update.callback_query.message.reply_text("❌ Payment method not found.", reply_markup=kb([[InlineKeyboardButton("⬅️ Wallet", callback_data="m:wallet")]]))
-            return
-        # Store method for the deposit flow
-        set_state(context, "deposit_amount", {"shop_id": sid, "pm_id": chosen["id"], "pm_name": chosen["name"]})
-        txt = f"💳 <b>Deposit Method</b>: <b>{esc(chosen['name'])}</b>\n\n{esc(chosen['text'])}\n\nSend deposit amount (example: 10):"
-        await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")]]))
-
-    async def deposit_amount_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "deposit_amount":
-            return
-        amt = parse_float(update.message.text or "")
-        if amt is None or amt <= 0:
-            await update.message.reply_text("❌ Invalid amount. Send a number (example: 10).")
-            return
-        set_state(context, "deposit_proof", {"shop_id": int(data["shop_id"]), "amount": float(amt), "method_name": data.get("method_name","")})
-        await update.message.reply_text("Now send a PHOTO proof of payment.")
-
-    async def deposit_proof_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "deposit_proof":
-            return
-        if not update.message.photo:
-            await update.message.reply_text("❌ Please send a PHOTO proof.")
-            return
-        sid = int(data["shop_id"])
-        uid = update.effective_user.id
-        amt = float(data["amount"])
-        method_name = (data.get("method_name") or "").strip()
-        method_disp = method_name if method_name else "TRC-20"
-        file_id = update.message.photo[-1].file_id
+    # Joined: we still do NOT show private link.
+    await update.callback_query.message.reply_text(
+        "✅ <b>Access Granted</b>\n\nOpen the channel to download your file(s).",
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb([
+            [InlineKeyboardButton("📦 Open Channel", url=f"https://t.me/{chat_username}")],
+            [InlineKeyboardButton("🏠 Menu", callback_data="m:menu")]
+        ])
+    )
 
-        conn = db(); cur = conn.cursor()
-        pm_id = str(data.get("pm_id","0"))
-        pm_name = str(data.get("pm_name","Deposit"))
 
-        cur.execute("""INSERT INTO deposit_requests(shop_owner_id,user_id,amount,proof_file_id,status,created_at,method_id,method_name)
-                       VALUES(?,?,?,?,?,?,?,?)""",
-                    (sid, uid, amt, file_id, "pending", ts(), pm_id, pm_name))
-        req_id = int(cur.lastrowid)
-        conn.commit(); conn.close()
 
-        clear_state(context)
-        await update.message.reply_text("✅ Deposit submitted. Waiting for approval.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+# ---------- Wallet / Deposit ----------
+async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
+    s = await run_db(get_shop_settings, sid)
+    bal = await run_db(get_balance, sid, uid)
+    wmsg = (s["wallet_message"] or "").strip()
+    text = f"💰 <b>Wallet</b>\n\nBalance: <b>{money(bal)} {esc(CURRENCY)}</b>\n\n{esc(wmsg)}"
+    await update.callback_query.message.reply_text(
+        text, parse_mode=ParseMode.HTML,
+        reply_markup=kb([
+            [InlineKeyboardButton("➕ Deposit", callback_data="w:deposit")],
+            [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
+        ])
+    )
 
-        # send to shop owner (master -> super; seller -> seller owner)
-        owner_chat = sid if sid != SUPER_ADMIN_ID else SUPER_ADMIN_ID
-        try:
-            m = await context.bot.send_photo(
-                chat_id=owner_chat,
-                photo=file_id,
-                caption=f"💳 <b>Deposit Request</b>\n\nUser: {esc(user_display(uid))}\nMethod: <b>{esc(method_disp)}</b>\nAmount: <b>{money(amt)} {esc(CURRENCY)}</b>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb([[
-                    InlineKeyboardButton("✅ Approve", callback_data=f"d:ok:{req_id}"),
-                    InlineKeyboardButton("❌ Reject", callback_data=f"d:no:{req_id}")
-                ]])
-            )
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE deposit_requests SET admin_chat_id=?, admin_msg_id=? WHERE id=?", (owner_chat, m.message_id, req_id))
-            conn.commit(); conn.close()
-        except Exception:
-            pass
+async def deposit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    methods = await run_db(build_deposit_methods, sid)
+    if not methods:
+        set_state(context, "deposit_amount", {"shop_id": sid, "pm_id": "0", "pm_name": "Deposit"})
+        await update.callback_query.message.reply_text("Send deposit amount (example: 10):", reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")]]))
+        return
+    rows = [[InlineKeyboardButton(m["name"], callback_data=f"w:method:{m['id']}")] for m in methods[:20]]
+    rows.append([InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")])
+    await update.callback_query.message.reply_text("Choose deposit method:", reply_markup=kb(rows))
+
+
+async def deposit_method(update: Update, context: ContextTypes.DEFAULT_TYPE, pm_id: str):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    methods = await run_db(build_deposit_methods, sid)
+    chosen = None
+    for m in methods:
+        if m["id"] == pm_id:
+            chosen = m
+            break
+    if not chosen:
+        await update.callback_query.message.reply_text("❌ Payment method not found.", reply_markup=kb([[InlineKeyboardButton("⬅️ Wallet", callback_data="m:wallet")]]))
+        return
+    # Store method for the deposit flow
+    set_state(context, "deposit_amount", {"shop_id": sid, "pm_id": chosen["id"], "pm_name": chosen["name"]})
+    txt = f"💳 <b>Deposit Method</b>: <b>{esc(chosen['name'])}</b>\n\n{esc(chosen['text'])}\n\nSend deposit amount (example: 10):"
+    await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:menu")]]))
+
+async def deposit_amount_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "deposit_amount":
+        return
+    amt = parse_float(update.message.text or "")
+    if amt is None or amt <= 0:
+        await update.message.reply_text("❌ Invalid amount. Send a number (example: 10).")
+        return
+    set_state(context, "deposit_proof", {"shop_id": int(data["shop_id"]), "amount": float(amt), "method_name": data.get("method_name","")})
+    await update.message.reply_text("Now send a PHOTO proof of payment.")
 
-    async def deposit_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, decision, rid_s = update.callback_query.data.split(":")
-        rid = int(rid_s)
+async def deposit_proof_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "deposit_proof":
+        return
+    if not update.message.photo:
+        await update.message.reply_text("❌ Please send a PHOTO proof.")
+        return
+    sid = int(data["shop_id"])
+    uid = update.effective_user.id
+    amt = float(data["amount"])
+    method_name = (data.get("method_name") or "").strip()
+    method_disp = method_name if method_name else "TRC-20"
+    file_id = update.message.photo[-1].file_id
 
-        conn = db(); cur = conn.cursor()
-        cur.execute("SELECT * FROM deposit_requests WHERE id=?", (rid,))
-        r = cur.fetchone()
-        if not r:
-            conn.close()
-            await update.callback_query.message.reply_text("Request not found.")
-            return
+    pm_id = str(data.get("pm_id","0"))
+    pm_name = str(data.get("pm_name","Deposit"))
 
-        sid = int(r["shop_owner_id"])
-        me = update.effective_user.id
+    req_id = await run_db(deposit_create, sid, uid, amt, file_id, pm_id, pm_name)
 
-        # master shop deposits -> super admin only
-        # seller shop deposits -> seller owner only
-        if not ((me == sid) or (sid == SUPER_ADMIN_ID and is_super(me))):
-            conn.close()
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
+    clear_state(context)
+    await update.message.reply_text("✅ Deposit submitted. Waiting for approval.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
 
-        if r["status"] != "pending":
-            conn.close()
-            await update.callback_query.message.reply_text("Already handled.")
-            return
+    # send to shop owner (master -> super; seller -> seller owner)
+    owner_chat = sid if sid != SUPER_ADMIN_ID else SUPER_ADMIN_ID
+    try:
+        m = await context.bot.send_photo(
+            chat_id=owner_chat,
+            photo=file_id,
+            caption=f"💳 <b>Deposit Request</b>\n\nUser: {esc(await run_db(user_display, uid))}\nMethod: <b>{esc(method_disp)}</b>\nAmount: <b>{money(amt)} {esc(CURRENCY)}</b>",
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb([[
+                InlineKeyboardButton("✅ Approve", callback_data=f"d:ok:{req_id}"),
+                InlineKeyboardButton("❌ Reject", callback_data=f"d:no:{req_id}")
+            ]])
+        )
+        await run_db(deposit_set_admin_msg, req_id, owner_chat, m.message_id)
+    except Exception:
+        pass
 
-        user_id = int(r["user_id"])
-        amt = float(r["amount"])
+async def deposit_decision(update: Update, context: ContextTypes.DEFAULT_TYPE, decision: str, rid: int):
+    await update.callback_query.answer()
 
-        notified = False
-        status_word = "APPROVED" if decision == "ok" else "REJECTED"
+    r = await run_db(deposit_get, rid)
+    if not r:
+        await update.callback_query.message.reply_text("Request not found.")
+        return
 
-        if decision == "ok":
-            add_balance(sid, user_id, amt)
-            log_tx(sid, user_id, "deposit", amt, "")
-            cur.execute("UPDATE deposit_requests SET status='approved', handled_by=?, handled_at=? WHERE id=?",
-                        (me, ts(), rid))
-            conn.commit(); conn.close()
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    f"✅ Deposit Approved\nAmount: {money(amt)} {CURRENCY}\nTotal Balance: {money(get_balance(sid, user_id))} {CURRENCY}"
-                )
-                notified = True
-            except Exception:
-                notified = False
-        else:
-            cur.execute("UPDATE deposit_requests SET status='rejected', handled_by=?, handled_at=? WHERE id=?",
-                        (me, ts(), rid))
-            conn.commit(); conn.close()
-            try:
-                await context.bot.send_message(user_id, f"❌ Deposit Rejected\nAmount: {money(amt)} {CURRENCY}")
-                notified = True
-            except Exception:
-                notified = False
+    sid = int(r["shop_owner_id"])
+    me = update.effective_user.id
 
-        # Update the admin request message so it visibly shows it was handled
-        try:
-            q = update.callback_query
-            base_caption = (q.message.caption or "").strip() if q.message else ""
-            base_text = (q.message.text or "").strip() if q.message else ""
-            suffix = f"\n\n✅ Status: <b>{status_word}</b>\nHandled by: <b>{esc(user_display(me))}</b>\nUser notified: <b>{'YES' if notified else 'NO'}</b>"
-            if q.message and q.message.photo:
-                await q.edit_message_caption(
-                    caption=(base_caption + suffix).strip(),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=None
-                )
-            else:
-                await q.edit_message_text(
-                    text=(base_text + suffix).strip(),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=None
-                )
-        except Exception:
-            pass
+    # master shop deposits -> super admin only
+    # seller shop deposits -> seller owner only
+    if not ((me == sid) or (sid == SUPER_ADMIN_ID and is_super(me))):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
 
-    # ---------- History ----------
+    if r["status"] != "pending" or not await run_db(deposit_handle, rid, decision == "ok", me):
+        await update.callback_query.message.reply_text("Already handled.")
+        return
 
-    async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = int(r["user_id"])
+    amt = float(r["amount"])
 
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
+    notified = False
+    status_word = "APPROVED" if decision == "ok" else "REJECTED"
 
-        conn = db(); cur = conn.cursor()
-        cur.execute("SELECT * FROM transactions WHERE shop_owner_id=? AND user_id=? ORDER BY id DESC LIMIT 30", (sid, uid))
-        rows = cur.fetchall(); conn.close()
-        bal = get_balance(sid, uid)
+    if decision == "ok":
+        try:
+            await context.bot.send_message(
+                user_id,
+                f"✅ Deposit Approved\nAmount: {money(amt)} {CURRENCY}\nTotal Balance: {money(await run_db(get_balance, sid, user_id))} {CURRENCY}"
+            )
+            notified = True
+        except Exception:
+            notified = False
+    else:
+        try:
+            await context.bot.send_message(user_id, f"❌ Deposit Rejected\nAmount: {money(amt)} {CURRENCY}")
+            notified = True
+        except Exception:
+            notified = False
 
-        lines = ["📜 <b>History</b>\n"]
-        if not rows:
-            lines.append("No history yet.")
+    # Update the admin request message so it visibly shows it was handled
+    try:
+        q = update.callback_query
+        base_caption = (q.message.caption or "").strip() if q.message else ""
+        base_text = (q.message.text or "").strip() if q.message else ""
+        suffix = f"\n\n✅ Status: <b>{status_word}</b>\nHandled by: <b>{esc(await run_db(user_display, me))}</b>\nUser notified: <b>{'YES' if notified else 'NO'}</b>"
+        if q.message and q.message.photo:
+            await q.edit_message_caption(
+                caption=(base_caption + suffix).strip(),
+                parse_mode=ParseMode.HTML,
+                reply_markup=None
+            )
         else:
-            for r in rows:
-                kind = r["kind"]
-                amt = float(r["amount"] or 0)
-                note = (r["note"] or "").strip()
-                qty = int(r["qty"] or 1)
-                dt = datetime.datetime.fromtimestamp(int(r["created_at"] or 0)).strftime("%Y-%m-%d %H:%M")
-
-                if kind == "purchase":
-                    pname, oid = note, ""
-                    if " | " in note:
-                        pname, oid = [x.strip() for x in note.split(" | ", 1)]
-                    extra = f"\nOrder ID: <b>{esc(oid)}</b>" if oid else ""
-                    lines.append(f"🛒 Purchased: <b>{esc(pname)}</b> (x{qty}) — <b>{money(abs(amt))} {esc(CURRENCY)}</b>{extra}\nDate: <b>{dt}</b>")
-                else:
-                    lines.append(f"{esc(kind)}: <b>{money(amt)} {esc(CURRENCY)}</b>\nDate: <b>{dt}</b>")
-
-        lines.append(f"\nTotal Balance: <b>{money(bal)} {esc(CURRENCY)}</b>")
-        await update.callback_query.message.reply_text("\n\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
-    # ---------- Support (draft -> DONE) ----------
-    async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = current_shop_id()
-        uid = update.effective_user.id
-        if is_banned_user(sid, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
-            return
-        set_state(context, "support_draft", {"shop_id": sid, "items": []})
-        await update.callback_query.message.reply_text(
-            "Send your support / feedback (TEXT, PHOTO, or VIDEO). Press DONE when finished.",
-            reply_markup=kb([
-                [InlineKeyboardButton("✅ DONE", callback_data="s:done")],
-                [InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]
-            ])
-        )
-
-    async def support_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "support_draft":
-            return
-        msg = update.message
-        items = data.get("items") or []
-        if len(items) >= 5:
-            await msg.reply_text("❌ Max 5 messages per ticket. Press DONE.")
-            return
+            await q.edit_message_text(
+                text=(base_text + suffix).strip(),
+                parse_mode=ParseMode.HTML,
+                reply_markup=None
+            )
+    except Exception:
+        pass
 
-        file_id = ""
-        ftype = ""
-        text = ""
-        if msg.photo:
-            file_id = msg.photo[-1].file_id
-            ftype = "photo"
-            text = (msg.caption or "").strip() or "[photo]"
-        elif msg.video:
-            file_id = msg.video.file_id
-            ftype = "video"
-            text = (msg.caption or "").strip() or "[video]"
-        else:
-            text = (msg.text or "").strip()
+# ---------- History ----------
 
-        if not (text or file_id):
-            return
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-        items.append({"text": text[:3500], "file_id": file_id, "file_type": ftype})
-        data["items"] = items
-        set_state(context, "support_draft", data)
-        await msg.reply_text("✅ Added. Press DONE.", reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="s:done")]]))
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
 
-    async def support_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        state, data = get_state(context)
-        if state != "support_draft":
-            await update.callback_query.message.reply_text("No draft.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
-            return
-        sid = int(data["shop_id"])
-        uid = update.effective_user.id
-        items = data.get("items") or []
-        if not items:
-            await update.callback_query.message.reply_text("Send a message first.")
-            return
-        clear_state(context)
+    rows = await run_db(list_tx, sid, uid, 30)
+    bal = await run_db(get_balance, sid, uid)
+
+    lines = ["📜 <b>History</b>\n"]
+    if not rows:
+        lines.append("No history yet.")
+    else:
+        for r in rows:
+            kind = r["kind"]
+            amt = float(r["amount"] or 0)
+            note = (r["note"] or "").strip()
+            qty = int(r["qty"] or 1)
+            dt = datetime.datetime.fromtimestamp(int(r["created_at"] or 0)).strftime("%Y-%m-%d %H:%M")
+
+            if kind == "purchase":
+                pname, oid = note, ""
+                if " | " in note:
+                    pname, oid = [x.strip() for x in note.split(" | ", 1)]
+                extra = f"\nOrder ID: <b>{esc(oid)}</b>" if oid else ""
+                lines.append(f"🛒 Purchased: <b>{esc(pname)}</b> (x{qty}) — <b>{money(abs(amt))} {esc(CURRENCY)}</b>{extra}\nDate: <b>{dt}</b>")
+            else:
+                lines.append(f"{esc(kind)}: <b>{money(amt)} {esc(CURRENCY)}</b>\nDate: <b>{dt}</b>")
+
+    lines.append(f"\nTotal Balance: <b>{money(bal)} {esc(CURRENCY)}</b>")
+    await update.callback_query.message.reply_text("\n\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+# ---------- Support (draft -> DONE) ----------
+async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    sid = current_shop_id(context)
+    uid = update.effective_user.id
+    if await run_db(is_banned_user, sid, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from this shop.")
+        return
+    set_state(context, "support_draft", {"shop_id": sid, "items": []})
+    await update.callback_query.message.reply_text(
+        "Send your support / feedback (TEXT, PHOTO, or VIDEO). Press DONE when finished.",
+        reply_markup=kb([
+            [InlineKeyboardButton("✅ DONE", callback_data="s:done")],
+            [InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]
+        ])
+    )
 
-        tid = get_open_ticket(sid, uid) or create_ticket(sid, uid)
-        for it in items:
-            add_ticket_msg(tid, uid, (it.get('text') or '').strip() or '[attachment]', it.get('file_id') or '', it.get('file_type') or '')
+async def support_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "support_draft":
+        return
+    msg = update.message
+    items = data.get("items") or []
+    if len(items) >= 5:
+        await msg.reply_text("❌ Max 5 messages per ticket. Press DONE.")
+        return
 
-        await update.callback_query.message.reply_text("✅ Sent to support.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+    file_id = ""
+    ftype = ""
+    text = ""
+    if msg.photo:
+        file_id = msg.photo[-1].file_id
+        ftype = "photo"
+        text = (msg.caption or "").strip() or "[photo]"
+    elif msg.video:
+        file_id = msg.video.file_id
+        ftype = "video"
+        text = (msg.caption or "").strip() or "[video]"
+    else:
+        text = (msg.text or "").strip()
+
+    if not (text or file_id):
+        return
 
-        owner = sid if sid != SUPER_ADMIN_ID else SUPER_ADMIN_ID
-        try:
-            header = f"🆘 <b>Support Ticket</b>\nShop: <b>{esc(user_display(sid) if sid!=SUPER_ADMIN_ID else STORE_NAME)}</b>\nUser: {esc(user_display(uid))}"
-            await context.bot.send_message(
-                owner, header, parse_mode=ParseMode.HTML,
-                reply_markup=kb([[InlineKeyboardButton("↩️ Reply", callback_data=f"a:reply:{uid}:{sid}")]])
-            )
-            for it in items:
-                t = (it.get('text') or '').strip()
-                fid = (it.get('file_id') or '').strip()
-                ftype = (it.get('file_type') or '').strip()
-                if fid and ftype == 'photo':
-                    await context.bot.send_photo(owner, photo=fid, caption=t or None)
-                elif fid and ftype == 'video':
-                    await context.bot.send_video(owner, video=fid, caption=t or None)
-                else:
-                    await context.bot.send_message(owner, t or ' ')
-        except Exception:
-            pass
+    items.append({"text": text[:3500], "file_id": file_id, "file_type": ftype})
+    data["items"] = items
+    set_state(context, "support_draft", data)
+    await msg.reply_text("✅ Added. Press DONE.", reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="s:done")]]))
 
-    async def admin_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, uid_s, sid_s = update.callback_query.data.split(":")
-        target_uid = int(uid_s)
-        sid = int(sid_s)
-        me = update.effective_user.id
-        if not ((me == sid) or (sid == SUPER_ADMIN_ID and is_super(me))):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        set_state(context, "admin_reply", {"target_uid": target_uid, "shop_id": sid})
-        await update.callback_query.message.reply_text(f"Reply to {user_display(target_uid)} (send text):", reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]]))
+async def support_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    state, data = get_state(context)
+    if state != "support_draft":
+        await update.callback_query.message.reply_text("No draft.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+        return
+    sid = int(data["shop_id"])
+    uid = update.effective_user.id
+    items = data.get("items") or []
+    if not items:
+        await update.callback_query.message.reply_text("Send a message first.")
+        return
+    clear_state(context)
 
-    async def admin_reply_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "admin_reply":
-            return
-        target_uid = int(data["target_uid"])
-        sid = int(data["shop_id"])
-        text = (update.message.text or "").strip()
-        if not text:
-            return
-        clear_state(context)
-        try:
-            await context.bot.send_message(target_uid, f"✅ Support Reply:\n\n{text}")
-        except Exception:
-            pass
-        # log in ticket
-        tid = get_open_ticket(sid, target_uid) or create_ticket(sid, target_uid)
-        add_ticket_msg(tid, update.effective_user.id, text)
-        await update.message.reply_text("✅ Replied.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
-
-    # ---------- Connect Bot (master only) ----------
-    async def connect_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if bot_kind != "master":
-            await update.callback_query.message.reply_text(
-                "This is only available in Main Shop.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
-            )
-            return
+    tid = await run_db(get_open_ticket, sid, uid) or await run_db(create_ticket, sid, uid)
+    for it in items:
+        await run_db(add_ticket_msg, tid, uid, (it.get('text') or '').strip() or '[attachment]', it.get('file_id') or '', it.get('file_type') or '')
 
-        uid = update.effective_user.id
-        ensure_seller(uid)
+    await update.callback_query.message.reply_text("✅ Sent to support.", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
 
-        # If user is banned/restricted from Main Shop, block connect & plans
-        if is_banned_user(SUPER_ADMIN_ID, uid):
-            await update.callback_query.message.reply_text(
-                "❌ You are restricted from Main Shop.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
-            )
-            return
+    owner = sid if sid != SUPER_ADMIN_ID else SUPER_ADMIN_ID
+    try:
+        header = f"🆘 <b>Support Ticket</b>\nShop: <b>{esc(await run_db(user_display, sid) if sid!=SUPER_ADMIN_ID else STORE_NAME)}</b>\nUser: {esc(await run_db(user_display, uid))}"
+        await context.bot.send_message(
+            owner, header, parse_mode=ParseMode.HTML,
+            reply_markup=kb([[InlineKeyboardButton("↩️ Reply", callback_data=f"a:reply:{uid}:{sid}")]])
+        )
+        for it in items:
+            t = (it.get('text') or '').strip()
+            fid = (it.get('file_id') or '').strip()
+            ftype = (it.get('file_type') or '').strip()
+            if fid and ftype == 'photo':
+                await context.bot.send_photo(owner, photo=fid, caption=t or None)
+            elif fid and ftype == 'video':
+                await context.bot.send_video(owner, video=fid, caption=t or None)
+            else:
+                await context.bot.send_message(owner, t or ' ')
+    except Exception:
+        pass
 
-        sr = seller_row(uid)
-        if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
-            await update.callback_query.message.reply_text(
-                "❌ Your seller account is restricted/banned.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
-            )
-            return
+async def admin_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE, target_uid: int, sid: int):
+    await update.callback_query.answer()
+    me = update.effective_user.id
+    if not ((me == sid) or (sid == SUPER_ADMIN_ID and is_super(me))):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    set_state(context, "admin_reply", {"target_uid": target_uid, "shop_id": sid})
+    await update.callback_query.message.reply_text(f"Reply to {await run_db(user_display, target_uid)} (send text):", reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]]))
 
-        s = dict(get_shop_settings(SUPER_ADMIN_ID))
-        desc = (s["connect_desc"] or "").strip()
-        bal = get_balance(SUPER_ADMIN_ID, uid)
-        cur_plan = seller_plan(uid)
-        days_left = seller_days_left(uid)
-
-        free_title = (s["connect_free_title"] or "🆓 Free to Use").strip()
-        free_desc  = (s["connect_free_desc"] or "Use the panel for free with branding enabled.").strip()
-        prem_title = (s["connect_premium_title"] or f"💎 Premium — {money(PLAN_A_PRICE)} {esc(CURRENCY)} / {PLAN_DAYS} days").strip()
-        prem_desc  = (s["connect_premium_desc"] or "Remove branding and run White-Label.").strip()
-
-        txt = (
-            f"{desc}\n\n"
-            f"Your Main Shop balance: <b>{money(bal)} {esc(CURRENCY)}</b>\n"
-            f"Your plan: <b>{esc(cur_plan)}</b>\n"
-            f"Days left: <b>{days_left}</b>\n\n"
-            f"<b>{esc(free_title)}</b>\n{esc(free_desc)}\n\n"
-            f"<b>{esc(prem_title)}</b>\n{esc(prem_desc)}"
+async def admin_reply_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "admin_reply":
+        return
+    target_uid = int(data["target_uid"])
+    sid = int(data["shop_id"])
+    text = (update.message.text or "").strip()
+    if not text:
+        return
+    clear_state(context)
+    try:
+        await context.bot.send_message(target_uid, f"✅ Support Reply:\n\n{text}")
+    except Exception:
+        pass
+    # log in ticket
+    tid = await run_db(get_open_ticket, sid, target_uid) or await run_db(create_ticket, sid, target_uid)
+    await run_db(add_ticket_msg, tid, update.effective_user.id, text)
+    await update.message.reply_text("✅ Replied.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+
+# ---------- Connect Bot (master only) ----------
+async def connect_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    if bot_kind_of(context) != "master":
+        await update.callback_query.message.reply_text(
+            "This is only available in Main Shop.",
+            reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
         )
+        return
 
-        rows = [
-            [InlineKeyboardButton(free_title, callback_data="c:plan:free")],
-            [InlineKeyboardButton(prem_title, callback_data="c:plan:premium")],
-            [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
-        ]
-        await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    uid = update.effective_user.id
 
+    # If user is banned/restricted from Main Shop, block connect & plans
+    if await run_db(is_banned_user, SUPER_ADMIN_ID, uid):
+        await update.callback_query.message.reply_text(
+            "❌ You are restricted from Main Shop.",
+            reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
+        )
+        return
 
-    async def choose_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if bot_kind != "master":
-            return
+    sr = await run_db(seller_row, uid)
+    if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
+        await update.callback_query.message.reply_text(
+            "❌ Your seller account is restricted/banned.",
+            reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
+        )
+        return
 
-        uid = update.effective_user.id
-        ensure_seller(uid)
+    s = await run_db(get_shop_settings, SUPER_ADMIN_ID)
+    desc = (s["connect_desc"] or "").strip()
+    bal = await run_db(get_balance, SUPER_ADMIN_ID, uid)
+    cur_plan = await run_db(seller_plan, uid)
+    days_left = await run_db(seller_days_left, uid)
+
+    free_title = (s["connect_free_title"] or "🆓 Free to Use").strip()
+    free_desc  = (s["connect_free_desc"] or "Use the panel for free with branding enabled.").strip()
+    prem_title = (s["connect_premium_title"] or f"💎 Premium — {money(PLAN_A_PRICE)} {esc(CURRENCY)} / {PLAN_DAYS} days").strip()
+    prem_desc  = (s["connect_premium_desc"] or "Remove branding and run White-Label.").strip()
+
+    txt = (
+        f"{desc}\n\n"
+        f"Your Main Shop balance: <b>{money(bal)} {esc(CURRENCY)}</b>\n"
+        f"Your plan: <b>{esc(cur_plan)}</b>\n"
+        f"Days left: <b>{days_left}</b>\n\n"
+        f"<b>{esc(free_title)}</b>\n{esc(free_desc)}\n\n"
+        f"<b>{esc(prem_title)}</b>\n{esc(prem_desc)}"
+    )
 
-        # Block banned/restricted users from upgrading/connecting
-        if is_banned_user(SUPER_ADMIN_ID, uid):
-            await update.callback_query.message.reply_text("❌ You are restricted from Main Shop.")
-            return
-        sr = seller_row(uid)
-        if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
-            await update.callback_query.message.reply_text("❌ Your seller account is restricted/banned.")
-            return
+    rows = [
+        [InlineKeyboardButton(free_title, callback_data="c:plan:free")],
+        [InlineKeyboardButton(prem_title, callback_data="c:plan:premium")],
+        [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
+    ]
+    await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
 
-        plan = update.callback_query.data.split(":")[2]  # free / premium
-
-        if plan == "free":
-            # Free access with branding (branded plan)
-            seller_set_plan(uid, "branded")
-            # keep it effectively active for a long time
-            seller_add_days(uid, 3650)  # ~10 years
-            log_tx(SUPER_ADMIN_ID, uid, "plan", 0, "Free to Use (Branded)", 1)
-            set_state(context, "await_token", {"seller_id": uid})
-            await update.callback_query.message.reply_text(
-                "✅ Free to Use activated (branding enabled).\nNow send your <b>BotFather token</b>.",
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]])
-            )
-            return
 
-        # Premium (paid) -> White-label
-        price = float(PLAN_A_PRICE)
-        bal = get_balance(SUPER_ADMIN_ID, uid)
-        if bal < price:
-            await update.callback_query.message.reply_text("❌ Not enough Main Shop balance. Deposit first.")
-            return
+async def choose_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, plan: str):
+    await update.callback_query.answer()
+    if bot_kind_of(context) != "master":
+        return
 
-        set_balance(SUPER_ADMIN_ID, uid, bal - price)
-        seller_set_plan(uid, "whitelabel")
-        seller_add_days(uid, PLAN_DAYS)
-        log_tx(SUPER_ADMIN_ID, uid, "plan", -price, "Premium (White-Label)", 1)
+    uid = update.effective_user.id
 
+    # Block banned/restricted users from upgrading/connecting
+    if await run_db(is_banned_user, SUPER_ADMIN_ID, uid):
+        await update.callback_query.message.reply_text("❌ You are restricted from Main Shop.")
+        return
+    sr = await run_db(seller_row, uid)
+    if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
+        await update.callback_query.message.reply_text("❌ Your seller account is restricted/banned.")
+        return
+
+    if plan == "free":
+        # Free access with branding (branded plan)
+        await run_db(seller_set_plan, uid, "branded")
+        # keep it effectively active for a long time
+        await run_db(seller_add_days, uid, 3650)  # ~10 years
+        await run_db(log_tx, SUPER_ADMIN_ID, uid, "plan", 0, "Free to Use (Branded)", 1)
         set_state(context, "await_token", {"seller_id": uid})
         await update.callback_query.message.reply_text(
-            f"✅ Premium activated: <b>White-Label</b>\nPaid: <b>{money(price)} {esc(CURRENCY)}</b>\nNow send your <b>BotFather token</b>.",
+            "✅ Free to Use activated (branding enabled).\nNow send your <b>BotFather token</b>.",
             parse_mode=ParseMode.HTML,
             reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]])
         )
+        return
 
+    # Premium (paid) -> White-label
+    price = float(PLAN_A_PRICE)
+    bal = await run_db(get_balance, SUPER_ADMIN_ID, uid)
+    if bal < price:
+        await update.callback_query.message.reply_text("❌ Not enough Main Shop balance. Deposit first.")
+        return
 
-    async def token_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "await_token" or bot_kind != "master":
-            return
-        uid = update.effective_user.id
-        seller_id = int(data["seller_id"])
-        if uid != seller_id:
-            return
-
-        token = (update.message.text or "").strip()
-        try:
-            tmp = Application.builder().token(token).build()
-            await tmp.initialize()
-            me = await tmp.bot.get_me()
-            await tmp.shutdown()
-            bot_username = me.username or ""
-        except Exception:
-            await update.message.reply_text("❌ Invalid token. Try again.")
-            return
+    await run_db(set_balance, SUPER_ADMIN_ID, uid, bal - price)
+    await run_db(seller_set_plan, uid, "whitelabel")
+    await run_db(seller_add_days, uid, PLAN_DAYS)
+    await run_db(log_tx, SUPER_ADMIN_ID, uid, "plan", -price, "Premium (White-Label)", 1)
 
-        upsert_seller_bot(seller_id, token, bot_username)
-        ensure_shop_settings(seller_id)
-        clear_state(context)
+    set_state(context, "await_token", {"seller_id": uid})
+    await update.callback_query.message.reply_text(
+        f"✅ Premium activated: <b>White-Label</b>\nPaid: <b>{money(price)} {esc(CURRENCY)}</b>\nNow send your <b>BotFather token</b>.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="m:menu")]])
+    )
 
-        if seller_active(seller_id) and int(seller_row(seller_id)["banned_shop"] or 0) == 0:
-            await MANAGER.start_seller_bot(seller_id, token)
 
-        await update.message.reply_text(f"✅ Connected!\nYour bot is running: @{bot_username}\nOpen it and press /start.")
+async def token_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "await_token" or bot_kind_of(context) != "master":
+        return
+    uid = update.effective_user.id
+    seller_id = int(data["seller_id"])
+    if uid != seller_id:
+        return
 
-    # ---------- Extend Subscription ----------
-    async def extend_in_seller(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if bot_kind != "seller":
-            return
-        uid = update.effective_user.id
-        if uid != shop_owner_id and not is_super(uid):
-            await update.callback_query.message.reply_text("❌ Only the seller owner can use this.")
-            return
+    token = (update.message.text or "").strip()
+    try:
+        tmp = build_app(token)
+        await tmp.initialize()
+        me = await tmp.bot.get_me()
+        await tmp.shutdown()
+        bot_username = me.username or ""
+    except Exception:
+        await update.message.reply_text("❌ Invalid token. Try again.")
+        return
 
-        days_left = seller_days_left(shop_owner_id)
-        status = "✅ Active" if days_left > 0 else "❌ Ended"
-        plan = seller_plan(shop_owner_id)
-        txt = f"⏳ <b>Subscription</b>\nStatus: <b>{status}</b>\nDays left: <b>{days_left}</b>\nPlan: <b>{esc(plan)}</b>\n\nRenew in Main Shop."
+    await run_db(upsert_seller_bot, seller_id, token, bot_username)
+    clear_state(context)
 
-        if not MASTER_BOT_USERNAME:
-            await update.callback_query.message.reply_text(txt + "\n\n⚠️ Set MASTER_BOT_USERNAME env to show renew link.", parse_mode=ParseMode.HTML)
-            return
+    if await run_db(seller_bot_startable, seller_id):
+        await MANAGER.start_seller_bot(seller_id, token)
 
-        url = f"https://t.me/{MASTER_BOT_USERNAME}?start=extend"
-        await update.callback_query.message.reply_text(
-            txt, parse_mode=ParseMode.HTML,
-            reply_markup=kb([[InlineKeyboardButton("🏬 Open Main Shop (Renew)", url=url)],
-                             [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
-        )
+    await update.message.reply_text(f"✅ Connected!\nYour bot is running: @{bot_username}\nOpen it and press /start.")
 
-    async def show_extend_master(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int):
-        ensure_seller(uid)
-        cur_plan = seller_plan(uid)
-        days_left = seller_days_left(uid)
-        bal = get_balance(SUPER_ADMIN_ID, uid)
-        txt = f"⏳ <b>Extend Subscription</b>\n\nDays left: <b>{days_left}</b>\nCurrent plan: <b>{esc(cur_plan)}</b>\nMain Shop balance: <b>{money(bal)} {esc(CURRENCY)}</b>\n\nChoose:"
-        rows = []
-        rows.append([InlineKeyboardButton(f"💎 {money(PLAN_B_PRICE)} {CURRENCY} / {PLAN_DAYS} Days (White-label)", callback_data="e:plan:b")])
-        rows.append([InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
-        await update.effective_chat.send_message(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+# ---------- Extend Subscription ----------
+async def extend_in_seller(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    if bot_kind_of(context) != "seller":
+        return
+    uid = update.effective_user.id
+    owner = shop_owner_of(context)
+    if uid != owner and not is_super(uid):
+        await update.callback_query.message.reply_text("❌ Only the seller owner can use this.")
+        return
 
-    async def extend_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if bot_kind != "master":
-            return
-        uid = update.effective_user.id
-        plan = update.callback_query.data.split(":")[2]
-        ensure_seller(uid)
+    days_left = await run_db(seller_days_left, owner)
+    status = "✅ Active" if days_left > 0 else "❌ Ended"
+    plan = await run_db(seller_plan, owner)
+    txt = f"⏳ <b>Subscription</b>\nStatus: <b>{status}</b>\nDays left: <b>{days_left}</b>\nPlan: <b>{esc(plan)}</b>\n\nRenew in Main Shop."
 
-        # Block banned/restricted users from renewing subscription
-        if is_banned_user(SUPER_ADMIN_ID, uid):
-            await update.callback_query.message.reply_text("❌ You are banned/restricted from Main Shop.")
-            return
-        sr = seller_row(uid)
-        if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
-            await update.callback_query.message.reply_text("❌ Your seller shop is banned/restricted. You cannot renew subscription.")
-            return
-        cur_plan = seller_plan(uid)
-        if cur_plan == "whitelabel" and plan == "a":
-            await update.callback_query.message.reply_text("❌ White-Label cannot pay $5. Choose Plan B.")
-            return
+    if not MASTER_BOT_USERNAME:
+        await update.callback_query.message.reply_text(txt + "\n\n⚠️ Set MASTER_BOT_USERNAME env to show renew link.", parse_mode=ParseMode.HTML)
+        return
 
-        price = PLAN_A_PRICE if plan == "a" else PLAN_B_PRICE
-        bal = get_balance(SUPER_ADMIN_ID, uid)
-        if bal < price:
-            await update.callback_query.message.reply_text("❌ Not enough balance. Deposit first.")
-            return
+    url = f"https://t.me/{MASTER_BOT_USERNAME}?start=extend"
+    await update.callback_query.message.reply_text(
+        txt, parse_mode=ParseMode.HTML,
+        reply_markup=kb([[InlineKeyboardButton("🏬 Open Main Shop (Renew)", url=url)],
+                         [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]])
+    )
 
-        set_balance(SUPER_ADMIN_ID, uid, bal - price)
+async def show_extend_master(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    cur_plan = await run_db(seller_plan, uid)
+    days_left = await run_db(seller_days_left, uid)
+    bal = await run_db(get_balance, SUPER_ADMIN_ID, uid)
+    txt = f"⏳ <b>Extend Subscription</b>\n\nDays left: <b>{days_left}</b>\nCurrent plan: <b>{esc(cur_plan)}</b>\nMain Shop balance: <b>{money(bal)} {esc(CURRENCY)}</b>\n\nChoose:"
+    rows = []
+    rows.append([InlineKeyboardButton(f"💎 {money(PLAN_B_PRICE)} {CURRENCY} / {PLAN_DAYS} Days (White-label)", callback_data="e:plan:b")])
+    rows.append([InlineKeyboardButton("🏠 Menu", callback_data="m:menu")])
+    await update.effective_chat.send_message(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def extend_choose(update: Update, context: ContextTypes.DEFAULT_TYPE, plan: str):
+    await update.callback_query.answer()
+    if bot_kind_of(context) != "master":
+        return
+    uid = update.effective_user.id
+    # Block banned/restricted users from renewing subscription
+    if await run_db(is_banned_user, SUPER_ADMIN_ID, uid):
+        await update.callback_query.message.reply_text("❌ You are banned/restricted from Main Shop.")
+        return
+    sr = await run_db(seller_row, uid)
+    if sr and (int(sr["banned_shop"] or 0) == 1 or int(sr["restricted_until"] or 0) > ts()):
+        await update.callback_query.message.reply_text("❌ Your seller shop is banned/restricted. You cannot renew subscription.")
+        return
+    cur_plan = await run_db(seller_plan, uid)
+    if cur_plan == "whitelabel" and plan == "a":
+        await update.callback_query.message.reply_text("❌ White-Label cannot pay $5. Choose Plan B.")
+        return
 
-        if plan == "b":
-            seller_set_plan(uid, "whitelabel")
-            note = "White-Label"
-        else:
-            seller_set_plan(uid, "whitelabel")
-            note = "White-Label (upgrade via $5)"
+    price = PLAN_A_PRICE if plan == "a" else PLAN_B_PRICE
+    bal = await run_db(get_balance, SUPER_ADMIN_ID, uid)
+    if bal < price:
+        await update.callback_query.message.reply_text("❌ Not enough balance. Deposit first.")
+        return
 
-        seller_add_days(uid, PLAN_DAYS)
-        log_tx(SUPER_ADMIN_ID, uid, "plan", -price, note, 1)
+    await run_db(set_balance, SUPER_ADMIN_ID, uid, bal - price)
 
-        await update.callback_query.message.reply_text(f"✅ Renewed.\nPlan: {note}\nDays left: {seller_days_left(uid)}", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+    if plan == "b":
+        await run_db(seller_set_plan, uid, "whitelabel")
+        note = "White-Label"
+    else:
+        await run_db(seller_set_plan, uid, "whitelabel")
+        note = "White-Label (upgrade via $5)"
 
-        sb = get_seller_bot(uid)
-        if sb and int(sb["enabled"] or 0) == 1 and seller_active(uid):
-            try:
-                await MANAGER.start_seller_bot(uid, sb["bot_token"])
-            except Exception:
-                pass
+    await run_db(seller_add_days, uid, PLAN_DAYS)
+    await run_db(log_tx, SUPER_ADMIN_ID, uid, "plan", -price, note, 1)
 
-    # ---------- Admin Panel ----------
-    def can_use_admin(uid: int) -> bool:
-        if bot_kind == "seller":
-            r = seller_row(shop_owner_id)
-            if r and int(r["banned_panel"] or 0) == 1 and not is_super(uid):
-                return False
-            return uid == shop_owner_id or is_super(uid)
-        return is_super(uid)
-
-    def admin_panel_kb(sid: int) -> InlineKeyboardMarkup:
-        return grid([
-            InlineKeyboardButton("👥 Users List", callback_data=f"a:users:{sid}"),
-            InlineKeyboardButton("📢 Broadcast", callback_data=f"a:bcast:{sid}"),
-            InlineKeyboardButton("🖼 Edit Welcome", callback_data=f"a:welcome:{sid}"),
-            InlineKeyboardButton("💳 Deposit Methods", callback_data=f"a:pm:{sid}"),
-            InlineKeyboardButton("🧩 Manage Catalog", callback_data=f"a:manage:{sid}"),
-            InlineKeyboardButton("⬅️ Menu", callback_data="m:menu"),
-        ], 2)
-
-    async def admin_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        uid = update.effective_user.id
-        if not can_use_admin(uid):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        sid = current_shop_id()
-        await update.callback_query.message.reply_text("🛠 <b>Admin Panel</b>", parse_mode=ParseMode.HTML, reply_markup=admin_panel_kb(sid))
+    await update.callback_query.message.reply_text(f"✅ Renewed.\nPlan: {note}\nDays left: {await run_db(seller_days_left, uid)}", reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
 
-    # Users list + search
-    async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        conn = db(); cur = conn.cursor()
-        cur.execute("SELECT user_id FROM balances WHERE shop_owner_id=? ORDER BY rowid DESC LIMIT 80", (sid,))
-        ids = [int(r["user_id"]) for r in cur.fetchall()]
-        conn.close()
-        ids = [i for i in ids if i != sid]
-        rows = [[InlineKeyboardButton(user_display(i), callback_data=f"u:open:{sid}:{i}")] for i in ids[:40]]
-        rows.append([InlineKeyboardButton("🔍 Search", callback_data=f"u:search:{sid}"), InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
-        await update.callback_query.message.reply_text("Select a user:", reply_markup=kb(rows))
-
-    async def admin_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "user_search", {"shop_id": sid})
-        await update.callback_query.message.reply_text("Type username to search (example: rekko):", reply_markup=admin_panel_kb(sid))
-
-    async def admin_user_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "user_search":
-            return
-        sid = int(data["shop_id"])
-        q = (update.message.text or "").strip().lstrip("@").lower()
-        clear_state(context)
-        conn = db(); cur = conn.cursor()
-        cur.execute("""
-            SELECT u.user_id FROM users u
-            JOIN balances b ON b.user_id=u.user_id AND b.shop_owner_id=?
-            WHERE lower(u.username) LIKE ?
-            LIMIT 40
-        """, (sid, f"%{q}%"))
-        ids = [int(r["user_id"]) for r in cur.fetchall()]
-        conn.close()
-        if not ids:
-            await update.message.reply_text("No matches.", reply_markup=admin_panel_kb(sid))
-            return
-        rows = [[InlineKeyboardButton(user_display(i), callback_data=f"u:open:{sid}:{i}")] for i in ids]
-        rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
-        await update.message.reply_text("Matches:", reply_markup=kb(rows))
+    sb = await run_db(get_seller_bot, uid)
+    if sb and int(sb["enabled"] or 0) == 1 and await run_db(seller_active, uid):
+        try:
+            await MANAGER.start_seller_bot(uid, sb["bot_token"])
+        except Exception:
+            pass
 
-    async def admin_user_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, uid_s = update.callback_query.data.split(":")
-        sid = int(sid_s); target = int(uid_s)
-        bal = get_balance(sid, target)
-        txt = f"👤 <b>User</b>: {esc(user_display(target))}\nBalance: <b>{money(bal)} {esc(CURRENCY)}</b>"
-        await update.callback_query.message.reply_text(
-            txt, parse_mode=ParseMode.HTML,
-            reply_markup=kb([
-                [InlineKeyboardButton("➕ Add", callback_data=f"u:add:{sid}:{target}"),
-                 InlineKeyboardButton("➖ Deduct", callback_data=f"u:ded:{sid}:{target}")],
-                [InlineKeyboardButton("🚫 Ban", callback_data=f"u:ban:{sid}:{target}"),
-                 InlineKeyboardButton("✅ Unban", callback_data=f"u:unban:{sid}:{target}")],
-                [InlineKeyboardButton("⏳ 7d", callback_data=f"u:res:{sid}:{target}:7"),
-                 InlineKeyboardButton("⏳ 14d", callback_data=f"u:res:{sid}:{target}:14"),
-                 InlineKeyboardButton("⏳ 30d", callback_data=f"u:res:{sid}:{target}:30")],
-                [InlineKeyboardButton("📦 Orders", callback_data=f"u:orders:{sid}:{target}")],
-                [InlineKeyboardButton("↩️ Reply Support", callback_data=f"a:reply:{target}:{sid}")],
-                [InlineKeyboardButton("⬅️ Users", callback_data=f"a:users:{sid}")]
-            ])
-        )
+# ---------- Admin Panel ----------
+async def can_use_admin(context: ContextTypes.DEFAULT_TYPE, uid: int) -> bool:
+    if bot_kind_of(context) == "seller":
+        owner = shop_owner_of(context)
+        r = await run_db(seller_row, owner)
+        if r and int(r["banned_panel"] or 0) == 1 and not is_super(uid):
+            return False
+        return uid == owner or is_super(uid)
+    return is_super(uid)
+
+async def admin_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    uid = update.effective_user.id
+    if not await can_use_admin(context, uid):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    sid = current_shop_id(context)
+    await update.callback_query.message.reply_text("🛠 <b>Admin Panel</b>", parse_mode=ParseMode.HTML, reply_markup=admin_panel_kb(sid))
+
+# Users list + search
+async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    ids = await run_db(list_shop_user_ids, sid, 80)
+    ids = [i for i in ids if i != sid][:40]
+    names = await run_db(user_displays, ids)
+    rows = [[InlineKeyboardButton(name, callback_data=f"u:open:{sid}:{i}")] for i, name in zip(ids, names)]
+    rows.append([InlineKeyboardButton("🔍 Search", callback_data=f"u:search:{sid}"), InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
+    await update.callback_query.message.reply_text("Select a user:", reply_markup=kb(rows))
+
+async def admin_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    set_state(context, "user_search", {"shop_id": sid})
+    await update.callback_query.message.reply_text("Type username to search (example: rekko):", reply_markup=admin_panel_kb(sid))
+
+async def admin_user_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "user_search":
+        return
+    sid = int(data["shop_id"])
+    q = (update.message.text or "").strip().lstrip("@").lower()
+    clear_state(context)
+    ids = await run_db(search_shop_user_ids, sid, q, 40)
+    if not ids:
+        await update.message.reply_text("No matches.", reply_markup=admin_panel_kb(sid))
+        return
+    names = await run_db(user_displays, ids)
+    rows = [[InlineKeyboardButton(name, callback_data=f"u:open:{sid}:{i}")] for i, name in zip(ids, names)]
+    rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
+    await update.message.reply_text("Matches:", reply_markup=kb(rows))
+
+async def admin_user_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    bal = await run_db(get_balance, sid, target)
+    txt = f"👤 <b>User</b>: {esc(await run_db(user_display, target))}\nBalance: <b>{money(bal)} {esc(CURRENCY)}</b>"
+    await update.callback_query.message.reply_text(
+        txt, parse_mode=ParseMode.HTML,
+        reply_markup=kb([
+            [InlineKeyboardButton("➕ Add", callback_data=f"u:add:{sid}:{target}"),
+             InlineKeyboardButton("➖ Deduct", callback_data=f"u:ded:{sid}:{target}")],
+            [InlineKeyboardButton("🚫 Ban", callback_data=f"u:ban:{sid}:{target}"),
+             InlineKeyboardButton("✅ Unban", callback_data=f"u:unban:{sid}:{target}")],
+            [InlineKeyboardButton("⏳ 7d", callback_data=f"u:res:{sid}:{target}:7"),
+             InlineKeyboardButton("⏳ 14d", callback_data=f"u:res:{sid}:{target}:14"),
+             InlineKeyboardButton("⏳ 30d", callback_data=f"u:res:{sid}:{target}:30")],
+            [InlineKeyboardButton("📦 Orders", callback_data=f"u:orders:{sid}:{target}")],
+            [InlineKeyboardButton("↩️ Reply Support", callback_data=f"a:reply:{target}:{sid}")],
+            [InlineKeyboardButton("⬅️ Users", callback_data=f"a:users:{sid}")]
+        ])
+    )
 
-    async def admin_edit_amount_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str, sid: int, target: int):
-        set_state(context, "edit_balance", {"shop_id": sid, "target": target, "mode": mode})
-        await update.callback_query.message.reply_text("Send amount (number):", reply_markup=admin_panel_kb(sid))
+async def admin_edit_amount_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str, sid: int, target: int):
+    set_state(context, "edit_balance", {"shop_id": sid, "target": target, "mode": mode})
+    await update.callback_query.message.reply_text("Send amount (number):", reply_markup=admin_panel_kb(sid))
 
-    async def admin_user_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, target_s = update.callback_query.data.split(":")
-        await admin_edit_amount_prompt(update, context, "add", int(sid_s), int(target_s))
+async def admin_user_add(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    await admin_edit_amount_prompt(update, context, "add", sid, target)
 
-    async def admin_user_ded(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, target_s = update.callback_query.data.split(":")
-        await admin_edit_amount_prompt(update, context, "ded", int(sid_s), int(target_s))
+async def admin_user_ded(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    await admin_edit_amount_prompt(update, context, "ded", sid, target)
 
-    async def admin_user_edit_balance_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "edit_balance":
-            return
-        amt = parse_float(update.message.text or "")
-        if amt is None or amt <= 0:
-            await update.message.reply_text("❌ Invalid number.")
-            return
-        sid = int(data["shop_id"]); target = int(data["target"]); mode = data["mode"]
-        clear_state(context)
-        if mode == "add":
-            add_balance(sid, target, amt)
-            log_tx(sid, target, "balance_edit", amt, "")
-        else:
-            add_balance(sid, target, -amt)
-            log_tx(sid, target, "balance_edit", -amt, "")
-        await update.message.reply_text(f"✅ Updated.\nNew Balance: {money(get_balance(sid, target))} {CURRENCY}", reply_markup=admin_panel_kb(sid))
-
-
-    async def admin_user_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, uid_s = update.callback_query.data.split(":")
-        sid = int(sid_s); target = int(uid_s)
-        me = update.effective_user.id
-        if not (is_super(me) or me == sid):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        orders = list_orders(sid, target, limit=50)
-        if not orders:
-            await update.callback_query.message.reply_text("No orders yet.", reply_markup=kb([[InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")]]))
-            return
-        rows = []
-        for o in orders[:50]:
-            oid = o["order_id"]
-            pname = o["product_name"]
-            rows.append([InlineKeyboardButton(f"{oid} • {pname}", callback_data=f"o:view:{sid}:{target}:{oid}")])
-        rows.append([InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")])
-        await update.callback_query.message.reply_text("📦 Orders (tap to view):", reply_markup=kb(rows))
-
-    async def admin_order_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, uid_s, oid = update.callback_query.data.split(":")
-        sid = int(sid_s); target = int(uid_s)
-        me = update.effective_user.id
-        if not (is_super(me) or me == sid):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        o = get_order(sid, oid)
-        if not o:
-            await update.callback_query.message.reply_text("Order not found.")
-            return
-        keys_text = (o["keys_text"] or "").strip() or "-"
-        when = int(o["created_at"] or 0)
-        dt = time.strftime("%Y-%m-%d %H:%M", time.localtime(when))
-        txt = (
-            f"📦 <b>Order</b>\n"
-            f"Order ID: <code>{esc(o['order_id'])}</code>\n"
-            f"Date: <b>{esc(dt)}</b>\n"
-            f"User: <b>{esc(user_display(target))}</b>\n"
-            f"Product: <b>{esc(o['product_name'])}</b>\n"
-            f"Qty: <b>{int(o['qty'])}</b>\n"
-            f"Total: <b>{money(float(o['total']))} {esc(CURRENCY)}</b>\n\n"
-            f"<b>Key(s) Delivered:</b>\n" + "\n".join([f"<code>{esc(k)}</code>" for k in keys_text.splitlines() if k.strip()]) 
-        )
-        await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb([
-            [InlineKeyboardButton("⬅️ Orders", callback_data=f"u:orders:{sid}:{target}")],
-            [InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")]
-        ]))
-
-    
-    async def admin_user_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, target_s = update.callback_query.data.split(":")
-        ban_user(int(sid_s), int(target_s), 1)
-        await update.callback_query.message.reply_text("✅ Banned.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
-
-    async def admin_user_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, target_s = update.callback_query.data.split(":")
-        ban_user(int(sid_s), int(target_s), 0)
-        await update.callback_query.message.reply_text("✅ Unbanned.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
-
-    async def admin_user_restrict(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, target_s, days_s = update.callback_query.data.split(":")
-        restrict_user(int(sid_s), int(target_s), int(days_s))
-        await update.callback_query.message.reply_text("✅ Restricted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+async def admin_user_edit_balance_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "edit_balance":
+        return
+    amt = parse_float(update.message.text or "")
+    if amt is None or amt <= 0:
+        await update.message.reply_text("❌ Invalid number.")
+        return
+    sid = int(data["shop_id"]); target = int(data["target"]); mode = data["mode"]
+    clear_state(context)
+    if mode == "add":
+        await run_db(add_balance, sid, target, amt)
+        await run_db(log_tx, sid, target, "balance_edit", amt, "")
+    else:
+        await run_db(add_balance, sid, target, -amt)
+        await run_db(log_tx, sid, target, "balance_edit", -amt, "")
+    await update.message.reply_text(f"✅ Updated.\nNew Balance: {money(await run_db(get_balance, sid, target))} {CURRENCY}", reply_markup=admin_panel_kb(sid))
+
+
+async def admin_user_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    me = update.effective_user.id
+    if not (is_super(me) or me == sid):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    orders = await run_db(list_orders, sid, target, limit=50)
+    if not orders:
+        await update.callback_query.message.reply_text("No orders yet.", reply_markup=kb([[InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")]]))
+        return
+    rows = []
+    for o in orders[:50]:
+        oid = o["order_id"]
+        pname = o["product_name"]
+        rows.append([InlineKeyboardButton(f"{oid} • {pname}", callback_data=f"o:view:{sid}:{target}:{oid}")])
+    rows.append([InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")])
+    await update.callback_query.message.reply_text("📦 Orders (tap to view):", reply_markup=kb(rows))
+
+async def admin_order_view(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, oid: str, target: Optional[int] = None):
+    await update.callback_query.answer()
+    me = update.effective_user.id
+    if not (is_super(me) or me == sid):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    o = await run_db(get_order, sid, oid)
+    if not o:
+        await update.callback_query.message.reply_text("Order not found.")
+        return
+    if target is None:
+        target = int(o["user_id"])
+    keys_text = (o["keys_text"] or "").strip() or "-"
+    when = int(o["created_at"] or 0)
+    dt = time.strftime("%Y-%m-%d %H:%M", time.localtime(when))
+    txt = (
+        f"📦 <b>Order</b>\n"
+        f"Order ID: <code>{esc(o['order_id'])}</code>\n"
+        f"Date: <b>{esc(dt)}</b>\n"
+        f"User: <b>{esc(await run_db(user_display, target))}</b>\n"
+        f"Product: <b>{esc(o['product_name'])}</b>\n"
+        f"Qty: <b>{int(o['qty'])}</b>\n"
+        f"Total: <b>{money(float(o['total']))} {esc(CURRENCY)}</b>\n\n"
+        f"<b>Key(s) Delivered:</b>\n" + "\n".join([f"<code>{esc(k)}</code>" for k in keys_text.splitlines() if k.strip()]) 
+    )
+    await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb([
+        [InlineKeyboardButton("⬅️ Orders", callback_data=f"u:orders:{sid}:{target}")],
+        [InlineKeyboardButton("⬅️ User", callback_data=f"u:open:{sid}:{target}")]
+    ]))
+
+
+async def admin_user_ban(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    await run_db(ban_user, sid, target, 1)
+    await update.callback_query.message.reply_text("✅ Banned.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+
+async def admin_user_unban(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int):
+    await update.callback_query.answer()
+    await run_db(ban_user, sid, target, 0)
+    await update.callback_query.message.reply_text("✅ Unbanned.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+
+async def admin_user_restrict(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, target: int, days: int):
+    await update.callback_query.answer()
+    await run_db(restrict_user, sid, target, days)
+    await update.callback_query.message.reply_text("✅ Restricted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+
+
+# ----- Deposit Payment Methods (Admin) -----
+async def admin_pm_root(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    rows = [[InlineKeyboardButton("➕ Add Method", callback_data=f"apm:add:{sid}")]]
+    methods = await run_db(build_deposit_methods, sid)
+    # skip built-in default id=0 entry
+    for m in methods:
+        if m["id"] == "0":
+            continue
+        rows.append([InlineKeyboardButton(f"💳 {m['name']}", callback_data=f"apm:open:{sid}:{m['id']}")])
+    rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
+    await update.callback_query.message.reply_text("💳 <b>Deposit Methods</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def admin_pm_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pm_id: int):
+    await update.callback_query.answer()
+    r = await run_db(pm_get, pm_id)
+    if not r or int(r["shop_owner_id"]) != sid:
+        await update.callback_query.message.reply_text("Not found.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+        return
+    txt = f"💳 <b>{esc(r['name'])}</b>\n\n{esc(r['instructions'] or '')}"
+    await update.callback_query.message.reply_text(
+        txt, parse_mode=ParseMode.HTML,
+        reply_markup=kb([
+            [InlineKeyboardButton("✏️ Edit", callback_data=f"apm:edit:{sid}:{pm_id}")],
+            [InlineKeyboardButton("🗑 Delete", callback_data=f"apm:del:{sid}:{pm_id}")],
+            [InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]
+        ])
+    )
 
-    
-    # ----- Deposit Payment Methods (Admin) -----
-    async def admin_pm_root(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        rows = [[InlineKeyboardButton("➕ Add Method", callback_data=f"apm:add:{sid}")]]
-        methods = build_deposit_methods(sid)
-        # skip built-in default id=0 entry
-        for m in methods:
-            if m["id"] == "0":
-                continue
-            rows.append([InlineKeyboardButton(f"💳 {m['name']}", callback_data=f"apm:open:{sid}:{m['id']}")])
-        rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
-        await update.callback_query.message.reply_text("💳 <b>Deposit Methods</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def admin_pm_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, pm_s = update.callback_query.data.split(":")
-        sid = int(sid_s); pm_id = int(pm_s)
-        r = pm_get(pm_id)
-        if not r or int(r["shop_owner_id"]) != sid:
-            await update.callback_query.message.reply_text("Not found.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
-            return
-        txt = f"💳 <b>{esc(r['name'])}</b>\n\n{esc(r['instructions'] or '')}"
-        await update.callback_query.message.reply_text(
-            txt, parse_mode=ParseMode.HTML,
-            reply_markup=kb([
-                [InlineKeyboardButton("✏️ Edit", callback_data=f"apm:edit:{sid}:{pm_id}")],
-                [InlineKeyboardButton("🗑 Delete", callback_data=f"apm:del:{sid}:{pm_id}")],
-                [InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]
-            ])
-        )
+async def admin_pm_add(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    set_state(context, "pm_add_name", {"shop_id": sid})
+    await update.callback_query.message.reply_text("Send method name (example: PayNow):", reply_markup=admin_panel_kb(sid))
 
-    async def admin_pm_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "pm_add_name", {"shop_id": sid})
-        await update.callback_query.message.reply_text("Send method name (example: PayNow):", reply_markup=admin_panel_kb(sid))
-
-    async def admin_pm_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, pm_s = update.callback_query.data.split(":")
-        sid = int(sid_s); pm_id = int(pm_s)
-        r = pm_get(pm_id)
-        if not r or int(r["shop_owner_id"]) != sid:
-            await update.callback_query.message.reply_text("Not found.")
-            return
-        set_state(context, "pm_edit", {"shop_id": sid, "pm_id": pm_id})
-        await update.callback_query.message.reply_text("Send new method name, then on next message send instructions text.", reply_markup=admin_panel_kb(sid))
-        context.user_data["_pm_stage"] = "name"
-
-    async def admin_pm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, pm_s = update.callback_query.data.split(":")
-        sid = int(sid_s); pm_id = int(pm_s)
-        r = pm_get(pm_id)
-        if not r or int(r["shop_owner_id"]) != sid:
-            await update.callback_query.message.reply_text("Not found.")
-            return
-        pm_delete(pm_id)
-        await update.callback_query.message.reply_text("✅ Deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+async def admin_pm_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pm_id: int):
+    await update.callback_query.answer()
+    r = await run_db(pm_get, pm_id)
+    if not r or int(r["shop_owner_id"]) != sid:
+        await update.callback_query.message.reply_text("Not found.")
+        return
+    set_state(context, "pm_edit", {"shop_id": sid, "pm_id": pm_id})
+    await update.callback_query.message.reply_text("Send new method name, then on next message send instructions text.", reply_markup=admin_panel_kb(sid))
+    context.user_data["_pm_stage"] = "name"
+    STATE.mark(context)
+
+async def admin_pm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pm_id: int):
+    await update.callback_query.answer()
+    r = await run_db(pm_get, pm_id)
+    if not r or int(r["shop_owner_id"]) != sid:
+        await update.callback_query.message.reply_text("Not found.")
+        return
+    await run_db(pm_delete, pm_id)
+    await update.callback_query.message.reply_text("✅ Deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
 
 
 # Broadcast
-    async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "broadcast", {"shop_id": sid, "file_id": "", "file_type": "", "text": ""})
-        await update.callback_query.message.reply_text(
-            "📢 Send broadcast now (TEXT, or PHOTO/VIDEO with caption). Then press DONE.",
-            reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="b:done"), InlineKeyboardButton("❌ Cancel", callback_data="b:cancel")]])
-        )
-
-    async def broadcast_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state != "broadcast":
-            return
-        msg = update.message
-        if msg.photo:
-            data["file_id"] = msg.photo[-1].file_id
-            data["file_type"] = "photo"
-            data["text"] = (msg.caption or "").strip()
-        elif msg.video:
-            data["file_id"] = msg.video.file_id
-            data["file_type"] = "video"
-            data["text"] = (msg.caption or "").strip()
-        else:
-            data["text"] = (msg.text or "").strip()
-        set_state(context, "broadcast", data)
-        await msg.reply_text("✅ Saved. Press DONE to send.", reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="b:done")]]))
-
-    async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        clear_state(context)
-        await update.callback_query.message.reply_text("✅ Broadcast cancelled.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
-
-    async def broadcast_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        state, data = get_state(context)
-        if state != "broadcast":
-            await update.callback_query.message.reply_text("No broadcast prepared.")
-            return
-        sid = int(data["shop_id"])
-        file_id = (data.get("file_id") or "").strip()
-        ftype = (data.get("file_type") or "").strip()
-        text = (data.get("text") or "").strip()
-        clear_state(context)
-
-        recipients = list_shop_user_ids(sid)
-        status_msg = await update.callback_query.message.reply_text(f"📢 Broadcasting to <b>{len(recipients)}</b> users…", parse_mode=ParseMode.HTML)
-        sent = 0; failed = 0
-        for uid in recipients:
-            try:
-                if file_id and ftype == "photo":
-                    await context.bot.send_photo(uid, photo=file_id, caption=text or None)
-                elif file_id and ftype == "video":
-                    await context.bot.send_video(uid, video=file_id, caption=text or None)
-                else:
-                    await context.bot.send_message(uid, text or " ")
-                sent += 1
-            except Exception:
-                failed += 1
-            await asyncio.sleep(0.03)
-        try:
-            await status_msg.edit_text(f"✅ Broadcast done.\nSent: <b>{sent}</b>\nFailed: <b>{failed}</b>", parse_mode=ParseMode.HTML)
-        except Exception:
-            pass
+async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    set_state(context, "broadcast", {"shop_id": sid, "file_id": "", "file_type": "", "text": ""})
+    await update.callback_query.message.reply_text(
+        "📢 Send broadcast now (TEXT, or PHOTO/VIDEO with caption). Then press DONE.",
+        reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="b:done"), InlineKeyboardButton("❌ Cancel", callback_data="b:cancel")]])
+    )
 
-    # Edit welcome / wallet
-    async def edit_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "edit_welcome", {"shop_id": sid})
-        await update.callback_query.message.reply_text("Send welcome TEXT, or PHOTO/VIDEO with caption.", reply_markup=admin_panel_kb(sid))
-    # ---- Manage Catalog (FULL) ----
-    async def manage_root(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        cats = cat_list(sid)
-        rows = [[InlineKeyboardButton("➕ Add Category", callback_data=f"mg:addcat:{sid}")]]
-        for c in cats[:30]:
-            rows.append([InlineKeyboardButton(f"📁 {c['name']}", callback_data=f"mg:cat:{sid}:{c['id']}")])
-        rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
-        await update.callback_query.message.reply_text("🧩 Manage Catalog:", reply_markup=kb(rows))
-
-    async def mg_addcat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "mg_addcat", {"shop_id": sid})
-        await update.callback_query.message.reply_text("Send category name:", reply_markup=admin_panel_kb(sid))
-
-    async def mg_cat_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, cat_s = update.callback_query.data.split(":")
-        sid = int(sid_s); cat_id = int(cat_s)
-        c = cat_get(sid, cat_id)
-        if not c:
-            await update.callback_query.message.reply_text("Category not found.", reply_markup=admin_panel_kb(sid))
-            return
-        subs = cocat_list(sid, cat_id)
-        rows = [
-            [InlineKeyboardButton("➕ Add Sub-Category", callback_data=f"mg:addsub:{sid}:{cat_id}")],
-            [InlineKeyboardButton("✏️ Edit Category", callback_data=f"mg:editcat:{sid}:{cat_id}")],
-            [InlineKeyboardButton("🖼 Set Category Media", callback_data=f"mg:catmedia:{sid}:{cat_id}")],
-            [InlineKeyboardButton("🗑 Delete Category", callback_data=f"mg:delcat:{sid}:{cat_id}")],
-        ]
-        for sc in subs[:30]:
-            rows.append([InlineKeyboardButton(f"📂 {sc['name']}", callback_data=f"mg:sub:{sid}:{cat_id}:{sc['id']}")])
-        rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"a:manage:{sid}")])
-        await update.callback_query.message.reply_text(f"📁 <b>{esc(c['name'])}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def mg_addsub(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, cat_s = update.callback_query.data.split(":")
-        sid = int(sid_s); cat_id = int(cat_s)
-        set_state(context, "mg_addsub", {"shop_id": sid, "cat_id": cat_id})
-        await update.callback_query.message.reply_text("Send sub-category name:", reply_markup=admin_panel_kb(sid))
-
-    async def mg_sub_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, cat_s, sub_s = update.callback_query.data.split(":")
-        sid = int(sid_s); cat_id = int(cat_s); sub_id = int(sub_s)
-        sc = cocat_get(sid, sub_id)
-        if not sc:
-            await update.callback_query.message.reply_text("Sub-category not found.", reply_markup=admin_panel_kb(sid))
-            return
-        prods = prod_list(sid, cat_id, sub_id)
-        rows = [
-            [InlineKeyboardButton("➕ Add Product", callback_data=f"mg:addprod:{sid}:{cat_id}:{sub_id}")],
-            [InlineKeyboardButton("✏️ Edit Sub-Category", callback_data=f"mg:editsub:{sid}:{sub_id}:{cat_id}")],
-            [InlineKeyboardButton("🖼 Set Sub-Category Media", callback_data=f"mg:submedia:{sid}:{sub_id}:{cat_id}")],
-            [InlineKeyboardButton("🗑 Delete Sub-Category", callback_data=f"mg:delsub:{sid}:{sub_id}:{cat_id}")],
-        ]
-        for p in prods[:30]:
-            rows.append([InlineKeyboardButton(f"🛒 {p['name']}", callback_data=f"mg:prod:{sid}:{p['id']}")])
-        rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")])
-        await update.callback_query.message.reply_text(f"📂 <b>{esc(sc['name'])}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def mg_addprod(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, cat_s, sub_s = update.callback_query.data.split(":")
-        sid = int(sid_s); cat_id = int(cat_s); sub_id = int(sub_s)
-        set_state(context, "mg_addprod_name", {"shop_id": sid, "cat_id": cat_id, "sub_id": sub_id})
-        await update.callback_query.message.reply_text("Send product name:", reply_markup=admin_panel_kb(sid))
-
-    async def mg_prod_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        _, _, sid_s, pid_s = update.callback_query.data.split(":")
-        sid = int(sid_s); pid = int(pid_s)
-        p = prod_get(sid, pid)
-        if not p:
-            await update.callback_query.message.reply_text("Product not found.", reply_markup=admin_panel_kb(sid))
-            return
-        st = stock_count(sid, pid)
-        rows = [
-            [InlineKeyboardButton("✏️ Edit Name", callback_data=f"mg:editname:{sid}:{pid}"),
-             InlineKeyboardButton("💲 Edit Price", callback_data=f"mg:editprice:{sid}:{pid}")],
-            [InlineKeyboardButton("📝 Edit Description", callback_data=f"mg:desc:{sid}:{pid}")],
-            [InlineKeyboardButton("🖼 Set Media", callback_data=f"mg:media:{sid}:{pid}")],
-            [InlineKeyboardButton("🔗 Set Private Link", callback_data=f"mg:link:{sid}:{pid}")],
-            [InlineKeyboardButton(f"🔑 Add Keys (stock {st})", callback_data=f"mg:keys:{sid}:{pid}")],
-            [InlineKeyboardButton("🔍 View All Keys", callback_data=f"mg:viewkeys:{sid}:{pid}:0")],
-            [InlineKeyboardButton("🧹 Clear Keys", callback_data=f"mg:clearkeys:{sid}:{pid}")],
-            [InlineKeyboardButton("🗑 Delete Product", callback_data=f"mg:delprod:{sid}:{pid}")],
-            [InlineKeyboardButton("⬅️ Back", callback_data=f"mg:sub:{sid}:{p['category_id']}:{p['cocategory_id']}")],
-        ]
-        await update.callback_query.message.reply_text(f"🛒 <b>{esc(p['name'])}</b>\nStock: <b>{st}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+async def broadcast_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state != "broadcast":
+        return
+    msg = update.message
+    if msg.photo:
+        data["file_id"] = msg.photo[-1].file_id
+        data["file_type"] = "photo"
+        data["text"] = (msg.caption or "").strip()
+    elif msg.video:
+        data["file_id"] = msg.video.file_id
+        data["file_type"] = "video"
+        data["text"] = (msg.caption or "").strip()
+    else:
+        data["text"] = (msg.text or "").strip()
+    set_state(context, "broadcast", data)
+    await msg.reply_text("✅ Saved. Press DONE to send.", reply_markup=kb([[InlineKeyboardButton("✅ DONE", callback_data="b:done")]]))
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    clear_state(context)
+    await update.callback_query.message.reply_text("✅ Broadcast cancelled.", reply_markup=kb([[InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")]]))
+
+async def broadcast_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    state, data = get_state(context)
+    if state != "broadcast":
+        await update.callback_query.message.reply_text("No broadcast prepared.")
+        return
+    sid = int(data["shop_id"])
+    file_id = (data.get("file_id") or "").strip()
+    ftype = (data.get("file_type") or "").strip()
+    text = (data.get("text") or "").strip()
+    clear_state(context)
+
+    # queued as a durable job; BROADCASTS sends it in the background and edits the status message
+    total = await run_db(count_shop_users, sid)
+    job_id = await run_db(broadcast_create, sid, bot_key_of(context), text, file_id, ftype, total)
+    status_msg = await update.callback_query.message.reply_text(
+        f"📢 Broadcasting to <b>{total}</b> users…", parse_mode=ParseMode.HTML,
+        reply_markup=kb([[InlineKeyboardButton("⏹ Stop", callback_data=f"b:stop:{job_id}")]])
+    )
+    await run_db(broadcast_set_message, job_id, status_msg.chat_id, status_msg.message_id)
+    BROADCASTS.start(job_id)
+
+async def broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, job_id: int):
+    await update.callback_query.answer()
+    job = await run_db(broadcast_get, job_id)
+    me = update.effective_user.id
+    if not job or not (me == int(job["shop_owner_id"]) or is_super(me)):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    if not await run_db(broadcast_finish, job_id, "cancelled"):
+        await update.callback_query.message.reply_text("Broadcast already finished.")
+
+# Edit welcome / wallet
+async def edit_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    set_state(context, "edit_welcome", {"shop_id": sid})
+    await update.callback_query.message.reply_text("Send welcome TEXT, or PHOTO/VIDEO with caption.", reply_markup=admin_panel_kb(sid))
+# ---- Manage Catalog (FULL) ----
+async def manage_root(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    cats = await run_db(cat_list, sid)
+    rows = [[InlineKeyboardButton("➕ Add Category", callback_data=f"mg:addcat:{sid}")]]
+    for c in cats[:30]:
+        rows.append([InlineKeyboardButton(f"📁 {c['name']}", callback_data=f"mg:cat:{sid}:{c['id']}")])
+    rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
+    await update.callback_query.message.reply_text("🧩 Manage Catalog:", reply_markup=kb(rows))
+
+async def mg_addcat(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    set_state(context, "mg_addcat", {"shop_id": sid})
+    await update.callback_query.message.reply_text("Send category name:", reply_markup=admin_panel_kb(sid))
+
+async def mg_cat_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, cat_id: int):
+    await update.callback_query.answer()
+    c = await run_db(cat_get, sid, cat_id)
+    if not c:
+        await update.callback_query.message.reply_text("Category not found.", reply_markup=admin_panel_kb(sid))
+        return
+    subs = await run_db(cocat_list, sid, cat_id)
+    rows = [
+        [InlineKeyboardButton("➕ Add Sub-Category", callback_data=f"mg:addsub:{sid}:{cat_id}")],
+        [InlineKeyboardButton("✏️ Edit Category", callback_data=f"mg:editcat:{sid}:{cat_id}")],
+        [InlineKeyboardButton("🖼 Set Category Media", callback_data=f"mg:catmedia:{sid}:{cat_id}")],
+        [InlineKeyboardButton("🗑 Delete Category", callback_data=f"mg:delcat:{sid}:{cat_id}")],
+    ]
+    for sc in subs[:30]:
+        rows.append([InlineKeyboardButton(f"📂 {sc['name']}", callback_data=f"mg:sub:{sid}:{cat_id}:{sc['id']}")])
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"a:manage:{sid}")])
+    await update.callback_query.message.reply_text(f"📁 <b>{esc(c['name'])}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def mg_addsub(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, cat_id: int):
+    await update.callback_query.answer()
+    set_state(context, "mg_addsub", {"shop_id": sid, "cat_id": cat_id})
+    await update.callback_query.message.reply_text("Send sub-category name:", reply_markup=admin_panel_kb(sid))
+
+async def mg_sub_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, cat_id: int, sub_id: int):
+    await update.callback_query.answer()
+    sc = await run_db(cocat_get, sid, sub_id)
+    if not sc:
+        await update.callback_query.message.reply_text("Sub-category not found.", reply_markup=admin_panel_kb(sid))
+        return
+    prods = await run_db(prod_list, sid, cat_id, sub_id)
+    rows = [
+        [InlineKeyboardButton("➕ Add Product", callback_data=f"mg:addprod:{sid}:{cat_id}:{sub_id}")],
+        [InlineKeyboardButton("✏️ Edit Sub-Category", callback_data=f"mg:editsub:{sid}:{sub_id}:{cat_id}")],
+        [InlineKeyboardButton("🖼 Set Sub-Category Media", callback_data=f"mg:submedia:{sid}:{sub_id}:{cat_id}")],
+        [InlineKeyboardButton("🗑 Delete Sub-Category", callback_data=f"mg:delsub:{sid}:{sub_id}:{cat_id}")],
+    ]
+    for p in prods[:30]:
+        rows.append([InlineKeyboardButton(f"🛒 {p['name']}", callback_data=f"mg:prod:{sid}:{p['id']}")])
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")])
+    await update.callback_query.message.reply_text(f"📂 <b>{esc(sc['name'])}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def mg_addprod(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, cat_id: int, sub_id: int):
+    await update.callback_query.answer()
+    set_state(context, "mg_addprod_name", {"shop_id": sid, "cat_id": cat_id, "sub_id": sub_id})
+    await update.callback_query.message.reply_text("Send product name:", reply_markup=admin_panel_kb(sid))
+
+async def mg_prod_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int):
+    await update.callback_query.answer()
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.callback_query.message.reply_text("Product not found.", reply_markup=admin_panel_kb(sid))
+        return
+    st = await run_db(stock_count, sid, pid)
+    rows = [
+        [InlineKeyboardButton("✏️ Edit Name", callback_data=f"mg:editname:{sid}:{pid}"),
+         InlineKeyboardButton("💲 Edit Price", callback_data=f"mg:editprice:{sid}:{pid}")],
+        [InlineKeyboardButton("📝 Edit Description", callback_data=f"mg:desc:{sid}:{pid}")],
+        [InlineKeyboardButton("🖼 Set Media", callback_data=f"mg:media:{sid}:{pid}")],
+        [InlineKeyboardButton("🔗 Set Private Link", callback_data=f"mg:link:{sid}:{pid}")],
+        [InlineKeyboardButton(f"🔑 Add Keys (stock {st})", callback_data=f"mg:keys:{sid}:{pid}")],
+        [InlineKeyboardButton("🔍 View All Keys", callback_data=f"mg:viewkeys:{sid}:{pid}:0")],
+        [InlineKeyboardButton("🧹 Clear Keys", callback_data=f"mg:clearkeys:{sid}:{pid}")],
+        [InlineKeyboardButton("🗑 Delete Product", callback_data=f"mg:delprod:{sid}:{pid}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=f"mg:sub:{sid}:{p['category_id']}:{p['cocategory_id']}")],
+    ]
+    await update.callback_query.message.reply_text(f"🛒 <b>{esc(p['name'])}</b>\nStock: <b>{st}</b>", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
 
-    
-    async def mg_viewkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        parts = update.callback_query.data.split(":")
-        # mg:viewkeys:sid:pid:page
-        sid = int(parts[2]); pid = int(parts[3]); page = int(parts[4])
-        per_page = 15
-        total = count_product_keys(sid, pid)
-        offset = max(0, page) * per_page
-        rows_db = list_product_keys(sid, pid, limit=per_page, offset=offset)
-
-        if not rows_db:
-            await update.callback_query.message.reply_text(
-                "No keys found for this product.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:prod:{sid}:{pid}")]])
-            )
-            return
 
-        lines = [f"🔑 <b>All Keys</b> (page {page+1})\n"]
-        btn_rows = []
-        for r in rows_db:
-            kid = int(r["id"])
-            key_line = (r["key_line"] or "").strip()
-            delivered = int(r["delivered_once"] or 0) == 1
-            mark = "✅ Delivered" if delivered else "🟢 Unused"
-            lines.append(f"<b>#{kid}</b> — {mark}\n<code>{esc(key_line)}</code>")
-            if not delivered:
-                btn_rows.append([InlineKeyboardButton(f"❌ Delete #{kid}", callback_data=f"mg:delkey:{sid}:{pid}:{kid}:{page}")])
-
-        nav = []
-        if offset > 0:
-            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"mg:viewkeys:{sid}:{pid}:{page-1}"))
-        if offset + per_page < total:
-            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"mg:viewkeys:{sid}:{pid}:{page+1}"))
-        if nav:
-            btn_rows.append(nav)
-
-        btn_rows.append([InlineKeyboardButton("🧹 Delete ALL Unused Keys", callback_data=f"mg:delallkeys:{sid}:{pid}:{page}")])
-        btn_rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"mg:prod:{sid}:{pid}")])
+async def mg_viewkeys(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int, page: int):
+    await update.callback_query.answer()
+    per_page = 15
+    total = await run_db(count_product_keys, sid, pid)
+    offset = max(0, page) * per_page
+    rows_db = await run_db(list_product_keys, sid, pid, limit=per_page, offset=offset)
 
+    if not rows_db:
         await update.callback_query.message.reply_text(
-            "\n\n".join(lines),
-            parse_mode=ParseMode.HTML,
-            reply_markup=kb(btn_rows[:90])
+            "No keys found for this product.",
+            reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:prod:{sid}:{pid}")]])
         )
+        return
 
-    async def mg_delkey(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        parts = update.callback_query.data.split(":")
-        # mg:delkey:sid:pid:kid:page
-        sid = int(parts[2]); pid = int(parts[3]); kid = int(parts[4]); page = int(parts[5])
-
-        conn = db(); cur = conn.cursor()
-        cur.execute("SELECT delivered_once FROM product_keys WHERE shop_owner_id=? AND id=? AND product_id=?", (sid, kid, pid))
-        r = cur.fetchone()
-        if not r:
-            conn.close()
-            await update.callback_query.message.reply_text(
-                "Key not found.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
-            )
-            return
-        if int(r["delivered_once"] or 0) == 1:
-            conn.close()
-            await update.callback_query.message.reply_text(
-                "❌ Delivered keys cannot be deleted.",
-                reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
-            )
-            return
+    lines = [f"🔑 <b>All Keys</b> (page {page+1})\n"]
+    btn_rows = []
+    for r in rows_db:
+        kid = int(r["id"])
+        key_line = (r["key_line"] or "").strip()
+        delivered = int(r["delivered_once"] or 0) == 1
+        mark = "✅ Delivered" if delivered else "🟢 Unused"
+        lines.append(f"<b>#{kid}</b> — {mark}\n<code>{esc(key_line)}</code>")
+        if not delivered:
+            btn_rows.append([InlineKeyboardButton(f"❌ Delete #{kid}", callback_data=f"mg:delkey:{sid}:{pid}:{kid}:{page}")])
+
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"mg:viewkeys:{sid}:{pid}:{page-1}"))
+    if offset + per_page < total:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"mg:viewkeys:{sid}:{pid}:{page+1}"))
+    if nav:
+        btn_rows.append(nav)
+
+    btn_rows.append([InlineKeyboardButton("🧹 Delete ALL Unused Keys", callback_data=f"mg:delallkeys:{sid}:{pid}:{page}")])
+    btn_rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"mg:prod:{sid}:{pid}")])
+
+    await update.callback_query.message.reply_text(
+        "\n\n".join(lines),
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb(btn_rows[:90])
+    )
 
-        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND id=? AND product_id=? AND delivered_once=0", (sid, kid, pid))
-        conn.commit(); conn.close()
+async def mg_delkey(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int, kid: int, page: int):
+    await update.callback_query.answer()
+    r = await run_db(key_get, sid, pid, kid)
+    if not r:
         await update.callback_query.message.reply_text(
-            "✅ Key deleted.",
+            "Key not found.",
             reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
         )
-
-    async def mg_delallkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        parts = update.callback_query.data.split(":")
-        # mg:delallkeys:sid:pid:page
-        sid = int(parts[2]); pid = int(parts[3]); page = int(parts[4])
-
-        conn = db(); cur = conn.cursor()
-        cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id=? AND delivered_once=0", (sid, pid))
-        conn.commit(); conn.close()
+        return
+    if int(r["delivered_once"] or 0) == 1:
         await update.callback_query.message.reply_text(
-            "✅ Deleted all unused keys.",
+            "❌ Delivered keys cannot be deleted.",
             reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
         )
+        return
 
+    await run_db(delete_key, sid, pid, kid)
+    await update.callback_query.message.reply_text(
+        "✅ Key deleted.",
+        reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
+    )
 
-    # Super Admin area
-    async def super_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if not is_super(update.effective_user.id):
-            await update.callback_query.message.reply_text('❌ Not allowed.')
-            return
-        txt = (
-            "👑 <b>Super Admin Panel</b>\n\n"
-            "• Edit Connect Bot text/buttons\n"
-            "• Manage sellers and deposits\n"
-        )
-        rows = [
-            [InlineKeyboardButton("✏️ Edit Button/Desc", callback_data="sa:editui")],
-            [InlineKeyboardButton("🧾 Sellers List", callback_data="sa:sellers")],
-            [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
-        ]
-        await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-    async def sa_editui(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        s = dict(get_shop_settings(SUPER_ADMIN_ID))
-
-        def cur(k: str) -> str:
-            return (s.get(k) or "").strip() or "(empty)"
-
-        fields = [
-            ("connect_desc", "Connect Bot — Description"),
-            ("connect_free_title", "Free to Use — Button Text"),
-            ("connect_free_desc", "Free to Use — Description"),
-            ("connect_premium_title", "Premium — Button Text"),
-            ("connect_premium_desc", "Premium — Description"),
-        ]
+async def mg_delallkeys(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int, page: int):
+    await update.callback_query.answer()
+    await run_db(clear_keys, sid, pid)
+    await update.callback_query.message.reply_text(
+        "✅ Deleted all unused keys.",
+        reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:viewkeys:{sid}:{pid}:{page}")]])
+    )
 
-        lines = ["✏️ <b>Edit Button/Desc</b>\n"]
-        for k, label in fields:
-            val = cur(k)
-            # show only first 60 chars
-            short = val if len(val) <= 60 else val[:60] + "…"
-            lines.append(f"<b>{esc(label)}</b>\n<code>{esc(short)}</code>\n")
 
-        rows = [[InlineKeyboardButton(label, callback_data=f"sa:editui:pick:{k}")] for k, label in fields]
-        rows.append([InlineKeyboardButton("⬅️ Back", callback_data="sa:home")])
+# Super Admin area
+async def super_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    if not is_super(update.effective_user.id):
+        await update.callback_query.message.reply_text('❌ Not allowed.')
+        return
+    txt = (
+        "👑 <b>Super Admin Panel</b>\n\n"
+        "• Edit Connect Bot text/buttons\n"
+        "• Manage sellers and deposits\n"
+    )
+    rows = [
+        [InlineKeyboardButton("✏️ Edit Button/Desc", callback_data="sa:editui")],
+        [InlineKeyboardButton("🧾 Sellers List", callback_data="sa:sellers")],
+        [InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]
+    ]
+    await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+async def sa_editui(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    s = await run_db(get_shop_settings, SUPER_ADMIN_ID)
+
+    def cur(k: str) -> str:
+        return (s.get(k) or "").strip() or "(empty)"
+
+    fields = [
+        ("connect_desc", "Connect Bot — Description"),
+        ("connect_free_title", "Free to Use — Button Text"),
+        ("connect_free_desc", "Free to Use — Description"),
+        ("connect_premium_title", "Premium — Button Text"),
+        ("connect_premium_desc", "Premium — Description"),
+    ]
 
-        await update.callback_query.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+    lines = ["✏️ <b>Edit Button/Desc</b>\n"]
+    for k, label in fields:
+        val = cur(k)
+        # show only first 60 chars
+        short = val if len(val) <= 60 else val[:60] + "…"
+        lines.append(f"<b>{esc(label)}</b>\n<code>{esc(short)}</code>\n")
 
-    async def sa_edittexts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if not is_super(update.effective_user.id):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
+    rows = [[InlineKeyboardButton(label, callback_data=f"sa:editui:pick:{k}")] for k, label in fields]
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data="sa:home")])
 
-        # Keys we allow editing (English only)
-        keys = [
-            ("btn_products", "Menu Button: Products"),
-            ("btn_wallet", "Menu Button: Wallet"),
-            ("btn_history", "Menu Button: History"),
-            ("btn_support", "Menu Button: Support"),
-            ("btn_connect", "Menu Button: Connect Bot"),
-            ("btn_lang", "Menu Button: Language"),
-            ("btn_admin", "Menu Button: Admin Panel"),
-            ("btn_super", "Menu Button: Super Admin"),
-            ("btn_extend", "Menu Button: Extend Subscription"),
-            ("lang_title", "Language Screen Title"),
-            ("lang_saved", "Language Saved Message"),
-        ]
+    await update.callback_query.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=kb(rows))
 
-        rows = []
-        for k, label in keys:
-            cur = ui_get(k) or (TRANSLATIONS.get('en', {}).get(k, k))
-            rows.append([InlineKeyboardButton(f"✏️ {label}", callback_data=f"sa:edittext:{k}")])
-            rows.append([InlineKeyboardButton(f"• Current: {cur[:35] + ('…' if len(cur)>35 else '')}", callback_data="sa:noop")])
-        rows.append([InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
-        await update.callback_query.message.reply_text("📝 <b>Edit UI Texts (English)</b>\nTap a field to edit.", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def sa_edittext_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        if not is_super(update.effective_user.id):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        key = update.callback_query.data.split(":", 2)[2]
-        set_state(context, "sa_edittext", {"key": key})
-        cur = ui_get(key) or (TRANSLATIONS.get('en', {}).get(key, key))
-        msg = f"Send new text for <b>{esc(key)}</b>\n\nCurrent: <code>{esc(cur)}</code>\n\nSend \'-\' to reset to default."
+async def sa_edittexts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    if not is_super(update.effective_user.id):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
 
-        await update.callback_query.message.reply_text(msg,
+    # Keys we allow editing (English only)
+    keys = [
+        ("btn_products", "Menu Button: Products"),
+        ("btn_wallet", "Menu Button: Wallet"),
+        ("btn_history", "Menu Button: History"),
+        ("btn_support", "Menu Button: Support"),
+        ("btn_connect", "Menu Button: Connect Bot"),
+        ("btn_lang", "Menu Button: Language"),
+        ("btn_admin", "Menu Button: Admin Panel"),
+        ("btn_super", "Menu Button: Super Admin"),
+        ("btn_extend", "Menu Button: Extend Subscription"),
+        ("lang_title", "Language Screen Title"),
+        ("lang_saved", "Language Saved Message"),
+    ]
 
-            parse_mode=ParseMode.HTML,
-            reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:super")]])
-        )
+    rows = []
+    for k, label in keys:
+        cur = ui_get(k) or (TRANSLATIONS.get('en', {}).get(k, k))
+        rows.append([InlineKeyboardButton(f"✏️ {label}", callback_data=f"sa:edittext:{k}")])
+        rows.append([InlineKeyboardButton(f"• Current: {cur[:35] + ('…' if len(cur)>35 else '')}", callback_data="sa:noop")])
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
+    await update.callback_query.message.reply_text("📝 <b>Edit UI Texts (English)</b>\nTap a field to edit.", parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def sa_edittext_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, key: str):
+    await update.callback_query.answer()
+    if not is_super(update.effective_user.id):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    set_state(context, "sa_edittext", {"key": key})
+    cur = ui_get(key) or (TRANSLATIONS.get('en', {}).get(key, key))
+    msg = f"Send new text for <b>{esc(key)}</b>\n\nCurrent: <code>{esc(cur)}</code>\n\nSend \'-\' to reset to default."
 
+    await update.callback_query.message.reply_text(msg,
+
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:super")]])
+    )
 
-    async def sa_editui_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        parts = update.callback_query.data.split(":")
-        field = parts[3]
-        set_state(context, "sa_editui", {"field": field})
-        await update.callback_query.message.reply_text(
-            "Send the new text now.\n\n"
-            "Tip: you can use emojis and new lines.",
-            reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="sa:home")]])
-        )
 
+async def sa_editui_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str):
+    await update.callback_query.answer()
+    set_state(context, "sa_editui", {"field": field})
+    await update.callback_query.message.reply_text(
+        "Send the new text now.\n\n"
+        "Tip: you can use emojis and new lines.",
+        reply_markup=kb([[InlineKeyboardButton("❌ Cancel", callback_data="sa:home")]])
+    )
 
 
-    async def super_sellers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sellers = list_sellers_only()
-        rows = [[InlineKeyboardButton(user_display(int(s["seller_id"])), callback_data=f"sa:sel:{int(s['seller_id'])}")]
-                for s in sellers[:50]]
-        rows.append([InlineKeyboardButton("🔍 Search", callback_data="sa:search"), InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
-        await update.callback_query.message.reply_text("Sellers:", reply_markup=kb(rows))
 
-    async def super_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        set_state(context, "super_search", {})
-        await update.callback_query.message.reply_text("Type seller username to search:", reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:super")]]))
+async def super_sellers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    sellers = await run_db(list_sellers_only)
+    ids = [int(s["seller_id"]) for s in sellers[:50]]
+    names = await run_db(user_displays, ids)
+    rows = [[InlineKeyboardButton(name, callback_data=f"sa:sel:{sid}")] for sid, name in zip(ids, names)]
+    rows.append([InlineKeyboardButton("🔍 Search", callback_data="sa:search"), InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
+    await update.callback_query.message.reply_text("Sellers:", reply_markup=kb(rows))
 
-    async def super_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, _ = get_state(context)
-        if state != "super_search":
-            return
-        q = (update.message.text or "").strip().lstrip("@").lower()
-        clear_state(context)
-        sellers = list_sellers_only()
-        matched: List[int] = []
-        for s in sellers:
-            sid = int(s["seller_id"])
-            u = user_row(sid)
-            if u and (u["username"] or "").lower().find(q) != -1:
-                matched.append(sid)
-        if not matched:
-            await update.message.reply_text("No matches.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
-            return
-        rows = [[InlineKeyboardButton(user_display(sid), callback_data=f"sa:sel:{sid}")] for sid in matched[:50]]
-        rows.append([InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
-        await update.message.reply_text("Matches:", reply_markup=kb(rows))
+async def super_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    set_state(context, "super_search", {})
+    await update.callback_query.message.reply_text("Type seller username to search:", reply_markup=kb([[InlineKeyboardButton("⬅️ Cancel", callback_data="m:super")]]))
+
+async def super_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, _ = get_state(context)
+    if state != "super_search":
+        return
+    q = (update.message.text or "").strip().lstrip("@").lower()
+    clear_state(context)
+    matched = await run_db(search_seller_ids, q)
+    if not matched:
+        await update.message.reply_text("No matches.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
+        return
+    matched = matched[:50]
+    names = await run_db(user_displays, matched)
+    rows = [[InlineKeyboardButton(name, callback_data=f"sa:sel:{sid}")] for sid, name in zip(matched, names)]
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data="m:super")])
+    await update.message.reply_text("Matches:", reply_markup=kb(rows))
+
+async def super_seller_open(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    r = await run_db(seller_row, sid)
+    if not r:
+        await update.callback_query.message.reply_text("Seller not found.")
+        return
+    days = await run_db(seller_days_left, sid)
+    plan = await run_db(seller_plan, sid)
+    txt = f"👤 Seller: <b>{esc(await run_db(user_display, sid))}</b>\nPlan: <b>{esc(plan)}</b>\nDays left: <b>{days}</b>"
+    rows = [
+        [InlineKeyboardButton("🚫 Ban Shop", callback_data=f"sa:ban:{sid}"), InlineKeyboardButton("✅ Unban Shop", callback_data=f"sa:unban:{sid}")],
+        [InlineKeyboardButton("🛑 Ban Panel", callback_data=f"sa:banp:{sid}"), InlineKeyboardButton("✅ Unban Panel", callback_data=f"sa:unbanp:{sid}")],
+        [InlineKeyboardButton("⏳ Restrict 7d", callback_data=f"sa:res:{sid}:7"),
+         InlineKeyboardButton("⏳ 30d", callback_data=f"sa:res:{sid}:30")],
+        [InlineKeyboardButton("💰 Edit Seller Balance", callback_data=f"sa:bal:{sid}")],
+        [InlineKeyboardButton("🔔 Warn Expiring", callback_data=f"sa:warn:{sid}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="sa:sellers")]
+    ]
+    # Seller bot controls (Super Admin)
+    sb = await run_db(get_seller_bot, sid)
+    if sb and (sb["bot_username"] or "").strip():
+        bot_un = (sb["bot_username"] or "").strip().lstrip("@")
+        rows.insert(0, [InlineKeyboardButton("🤖 View Bot", url=f"https://t.me/{bot_un}")])
+        rows.insert(1, [InlineKeyboardButton("▶️ Start Bot", callback_data=f"sa:startbot:{sid}"),
+                        InlineKeyboardButton("⏹ Stop Bot", callback_data=f"sa:stopbot:{sid}")])
+        rows.insert(2, [InlineKeyboardButton("🔌 Disconnect Bot", callback_data=f"sa:disconnect:{sid}")])
 
-    async def super_seller_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        sid = int(update.callback_query.data.split(":")[2])
-        r = seller_row(sid)
-        if not r:
-            await update.callback_query.message.reply_text("Seller not found.")
-            return
-        days = seller_days_left(sid)
-        plan = seller_plan(sid)
-        txt = f"👤 Seller: <b>{esc(user_display(sid))}</b>\nPlan: <b>{esc(plan)}</b>\nDays left: <b>{days}</b>"
-        rows = [
-            [InlineKeyboardButton("🚫 Ban Shop", callback_data=f"sa:ban:{sid}"), InlineKeyboardButton("✅ Unban Shop", callback_data=f"sa:unban:{sid}")],
-            [InlineKeyboardButton("🛑 Ban Panel", callback_data=f"sa:banp:{sid}"), InlineKeyboardButton("✅ Unban Panel", callback_data=f"sa:unbanp:{sid}")],
-            [InlineKeyboardButton("⏳ Restrict 7d", callback_data=f"sa:res:{sid}:7"),
-             InlineKeyboardButton("⏳ 30d", callback_data=f"sa:res:{sid}:30")],
-            [InlineKeyboardButton("💰 Edit Seller Balance", callback_data=f"sa:bal:{sid}")],
-            [InlineKeyboardButton("🔔 Warn Expiring", callback_data=f"sa:warn:{sid}")],
-            [InlineKeyboardButton("⬅️ Back", callback_data="sa:sellers")]
-        ]
-        # Seller bot controls (Super Admin)
-        sb = get_seller_bot(sid)
-        if sb and (sb["bot_username"] or "").strip():
-            bot_un = (sb["bot_username"] or "").strip().lstrip("@")
-            rows.insert(0, [InlineKeyboardButton("🤖 View Bot", url=f"https://t.me/{bot_un}")])
-            rows.insert(1, [InlineKeyboardButton("▶️ Start Bot", callback_data=f"sa:startbot:{sid}"),
-                            InlineKeyboardButton("⏹ Stop Bot", callback_data=f"sa:stopbot:{sid}")])
-            rows.insert(2, [InlineKeyboardButton("🔌 Disconnect Bot", callback_data=f"sa:disconnect:{sid}")])
-
-
-
-        await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def super_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        parts = update.callback_query.data.split(":")
-        act = parts[1]
-        sid = int(parts[2])
-        if act == "ban":
-            super_set_seller_flag(sid, "banned_shop", 1)
-            try:
-                disable_seller_bot(sid)
-                await MANAGER.stop_seller_bot(sid)
-            except Exception:
-                pass
-            await update.callback_query.message.reply_text("✅ Seller shop banned.")
-        elif act == "unban":
-            super_set_seller_flag(sid, "banned_shop", 0)
-            sb = get_seller_bot(sid)
-            if sb and seller_active(sid) and int(sb["enabled"] or 0) == 1:
-                try:
-                    await MANAGER.start_seller_bot(sid, sb["bot_token"])
-                except Exception:
-                    pass
-            await update.callback_query.message.reply_text("✅ Seller shop unbanned.")
-        elif act == "banp":
-            super_set_seller_flag(sid, "banned_panel", 1)
-            await update.callback_query.message.reply_text("✅ Seller panel banned.")
-        elif act == "unbanp":
-            super_set_seller_flag(sid, "banned_panel", 0)
-            await update.callback_query.message.reply_text("✅ Seller panel unbanned.")
-        elif act == "res":
-            days = int(parts[3])
-            super_restrict_seller(sid, days)
-            try:
-                disable_seller_bot(sid)
-                await MANAGER.stop_seller_bot(sid)
-            except Exception:
-                pass
-            await update.callback_query.message.reply_text(f"✅ Restricted for {days} days.")
-        elif act == "bal":
-            set_state(context, "super_edit_balance", {"seller_id": sid})
-            await update.callback_query.message.reply_text("Send amount (+add or -deduct), example: +10 or -5")
-
-        elif act == "startbot":
-            sb = get_seller_bot(sid)
-            if not sb:
-                await update.callback_query.message.reply_text("No bot connected for this seller.")
-                return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE seller_bots SET enabled=1, updated_at=? WHERE seller_id=?", (ts(), sid))
-            conn.commit(); conn.close()
-            if seller_active(sid) and int(seller_row(sid)["banned_shop"] or 0) == 0:
-                try:
-                    await MANAGER.start_seller_bot(sid, sb["bot_token"])
-                except Exception:
-                    log.exception("Failed to start seller bot via super admin")
-            await update.callback_query.message.reply_text("✅ Bot started (if subscription active).")
 
-        elif act == "stopbot":
-            try:
-                await MANAGER.stop_seller_bot(sid)
-            except Exception:
-                pass
-            await update.callback_query.message.reply_text("✅ Bot stopped.")
 
-        elif act == "disconnect":
+    await update.callback_query.message.reply_text(txt, parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def super_action(update: Update, context: ContextTypes.DEFAULT_TYPE, act: str, sid: int, days: int = 0):
+    await update.callback_query.answer()
+    if act == "ban":
+        await run_db(super_set_seller_flag, sid, "banned_shop", 1)
+        try:
+            await run_db(disable_seller_bot, sid)
+            await MANAGER.stop_seller_bot(sid)
+        except Exception:
+            pass
+        await update.callback_query.message.reply_text("✅ Seller shop banned.")
+    elif act == "unban":
+        await run_db(super_set_seller_flag, sid, "banned_shop", 0)
+        sb = await run_db(get_seller_bot, sid)
+        if sb and await run_db(seller_active, sid) and int(sb["enabled"] or 0) == 1:
             try:
-                await MANAGER.stop_seller_bot(sid)
+                await MANAGER.start_seller_bot(sid, sb["bot_token"])
             except Exception:
                 pass
-            conn = db(); cur = conn.cursor()
-            cur.execute("DELETE FROM seller_bots WHERE seller_id=?", (sid,))
-            conn.commit(); conn.close()
-            await update.callback_query.message.reply_text("✅ Bot disconnected (removed).")
-
-        elif act == "warn":
+        await update.callback_query.message.reply_text("✅ Seller shop unbanned.")
+    elif act == "banp":
+        await run_db(super_set_seller_flag, sid, "banned_panel", 1)
+        await update.callback_query.message.reply_text("✅ Seller panel banned.")
+    elif act == "unbanp":
+        await run_db(super_set_seller_flag, sid, "banned_panel", 0)
+        await update.callback_query.message.reply_text("✅ Seller panel unbanned.")
+    elif act == "res":
+        await run_db(super_restrict_seller, sid, days)
+        try:
+            await run_db(disable_seller_bot, sid)
+            await MANAGER.stop_seller_bot(sid)
+        except Exception:
+            pass
+        await update.callback_query.message.reply_text(f"✅ Restricted for {days} days.")
+    elif act == "bal":
+        set_state(context, "super_edit_balance", {"seller_id": sid})
+        await update.callback_query.message.reply_text("Send amount (+add or -deduct), example: +10 or -5")
+
+    elif act == "startbot":
+        sb = await run_db(get_seller_bot, sid)
+        if not sb:
+            await update.callback_query.message.reply_text("No bot connected for this seller.")
+            return
+        await run_db(enable_seller_bot, sid)
+        if await run_db(seller_bot_startable, sid):
             try:
-                await context.bot.send_message(sid, "⏳ Your subscription is ending soon. Please renew in Main Shop.")
+                await MANAGER.start_seller_bot(sid, sb["bot_token"])
             except Exception:
-                pass
-            await update.callback_query.message.reply_text("✅ Warning sent.")
+                log.exception("Failed to start seller bot via super admin")
+        await update.callback_query.message.reply_text("✅ Bot started (if subscription active).")
 
-    
-    # ---------- Language ----------
-    async def language_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        uid = update.effective_user.id
-        rows = []
-        cur = get_user_lang(uid)
-        for code, name in SUPPORTED_LANGS.items():
-            label = f"{'✅ ' if code==cur else ''}{name}"
-            rows.append([InlineKeyboardButton(label, callback_data=f"lang:set:{code}")])
-        rows.append([InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")])
-        await update.callback_query.message.reply_text(tr(uid, "lang_title"), parse_mode=ParseMode.HTML, reply_markup=kb(rows))
-
-    async def language_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        uid = update.effective_user.id
-        code = update.callback_query.data.split(":")[2]
-        set_user_lang(uid, code)
-        await update.callback_query.message.reply_text(tr(uid, "lang_saved"), reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
-
-    # ---------- Admin: Search Order ID (text search) ----------
-    async def admin_order_search_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
-        uid = update.effective_user.id
-        if not can_use_admin(uid):
-            await update.callback_query.message.reply_text("❌ Not allowed.")
-            return
-        sid = int(update.callback_query.data.split(":")[2])
-        set_state(context, "order_search", {"shop_id": sid})
-        await update.callback_query.message.reply_text(tr(uid, "ask_order_id"), reply_markup=admin_panel_kb(sid))
+    elif act == "stopbot":
+        try:
+            await MANAGER.stop_seller_bot(sid)
+        except Exception:
+            pass
+        await update.callback_query.message.reply_text("✅ Bot stopped.")
+
+    elif act == "disconnect":
+        try:
+            await MANAGER.stop_seller_bot(sid)
+        except Exception:
+            pass
+        await run_db(delete_seller_bot, sid)
+        await update.callback_query.message.reply_text("✅ Bot disconnected (removed).")
+
+    elif act == "warn":
+        try:
+            await context.bot.send_message(sid, "⏳ Your subscription is ending soon. Please renew in Main Shop.")
+        except Exception:
+            pass
+        await update.callback_query.message.reply_text("✅ Warning sent.")
+
+
+# ---------- Language ----------
+async def language_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    uid = update.effective_user.id
+    rows = []
+    cur = cached_user_lang(uid)
+    for code, name in SUPPORTED_LANGS.items():
+        label = f"{'✅ ' if code==cur else ''}{name}"
+        rows.append([InlineKeyboardButton(label, callback_data=f"lang:set:{code}")])
+    rows.append([InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")])
+    await update.callback_query.message.reply_text(tr(uid, "lang_title"), parse_mode=ParseMode.HTML, reply_markup=kb(rows))
+
+async def language_set(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str):
+    await update.callback_query.answer()
+    uid = update.effective_user.id
+    await run_db(set_user_lang, uid, code)
+    await update.callback_query.message.reply_text(tr(uid, "lang_saved"), reply_markup=kb([[InlineKeyboardButton("⬅️ Menu", callback_data="m:menu")]]))
+
+# ---------- Admin: Search Order ID (text search) ----------
+async def admin_order_search_start(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    await update.callback_query.answer()
+    uid = update.effective_user.id
+    if not await can_use_admin(context, uid):
+        await update.callback_query.message.reply_text("❌ Not allowed.")
+        return
+    set_state(context, "order_search", {"shop_id": sid})
+    await update.callback_query.message.reply_text(tr(uid, "ask_order_id"), reply_markup=admin_panel_kb(sid))
 
 # ---------- TEXT/MEDIA INPUT (all flows) ----------
-    async def text_or_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        upsert_user(update.effective_user)
-        state, data = get_state(context)
-
-        # deposit
-        if state == "deposit_amount":
-            await deposit_amount_msg(update, context); return
-        if state == "deposit_proof":
-            await deposit_proof_msg(update, context); return
-
-        # support draft
-        if state == "support_draft":
-            await support_collect(update, context); return
-
-        # admin reply
-        if state == "admin_reply":
-            await admin_reply_text(update, context); return
-
-        # token
-        if state == "sa_editui":
-            field = data.get("field")
-            txt = (update.message.text or update.message.caption or "").strip()
-            if not txt:
-                await update.message.reply_text("Send text (cannot be empty).")
-                return
-            set_shop_setting(SUPER_ADMIN_ID, field, txt)
-            clear_state(context)
-            await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Super Admin", callback_data="sa:home")]]))
+async def text_or_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    prof = user_profile_stale(update.effective_user)
+    if prof is not None:
+        await run_db(upsert_user, update.effective_user, prof)
+    state, data = get_state(context)
+
+    # deposit
+    if state == "deposit_amount":
+        await deposit_amount_msg(update, context); return
+    if state == "deposit_proof":
+        await deposit_proof_msg(update, context); return
+
+    # typed purchase quantity
+    if state == "qty_input":
+        await product_qty_text(update, context); return
+
+    # support draft
+    if state == "support_draft":
+        await support_collect(update, context); return
+
+    # admin reply
+    if state == "admin_reply":
+        await admin_reply_text(update, context); return
+
+    # token
+    if state == "sa_editui":
+        field = data.get("field")
+        txt = (update.message.text or update.message.caption or "").strip()
+        if not txt:
+            await update.message.reply_text("Send text (cannot be empty).")
             return
+        await run_db(set_shop_setting, SUPER_ADMIN_ID, field, txt)
+        clear_state(context)
+        await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Super Admin", callback_data="sa:home")]]))
+        return
 
-        if state == "await_token":
-            await token_text(update, context); return
-
-        # admin search
-        if state == "user_search":
-            await admin_user_search_text(update, context); return
-
-        # edit balance
-        if state == "edit_balance":
-            await admin_user_edit_balance_text(update, context); return
-
-        # broadcast
-        if state == "broadcast":
-            await broadcast_collect(update, context); return
-
-        # edit welcome
-        if state == "edit_welcome":
-            sid = int(data["shop_id"])
-            msg = update.message
-            if msg.photo:
-                set_shop_setting(sid, "welcome_file_id", msg.photo[-1].file_id)
-                set_shop_setting(sid, "welcome_file_type", "photo")
-                set_shop_setting(sid, "welcome_text", msg.caption or "")
-            elif msg.video:
-                set_shop_setting(sid, "welcome_file_id", msg.video.file_id)
-                set_shop_setting(sid, "welcome_file_type", "video")
-                set_shop_setting(sid, "welcome_text", msg.caption or "")
-            else:
-                set_shop_setting(sid, "welcome_file_id", "")
-                set_shop_setting(sid, "welcome_file_type", "")
-                set_shop_setting(sid, "welcome_text", msg.text or "")
-            clear_state(context)
-            await msg.reply_text("✅ Welcome updated.", reply_markup=admin_panel_kb(sid))
-            return
+    if state == "await_token":
+        await token_text(update, context); return
 
-        # payment methods add/edit
-        if state == "pm_add_name":
-            sid = int(data["shop_id"])
-            name = (update.message.text or "").strip()
-            if not name:
-                await update.message.reply_text("Send a method name (example: PAYPAL)."); return
-            set_state(context, "pm_add_text", {"shop_id": sid, "name": name})
-            await update.message.reply_text("Send instructions text for this method:"); return
+    # admin search
+    if state == "user_search":
+        await admin_user_search_text(update, context); return
 
-        if state == "pm_add_text":
-            sid = int(data["shop_id"])
-            txt = (update.message.text or "").strip()
-            if txt == "-":
-                txt = ""
-            pm_add(sid, data.get("name","Method"), txt)
-            clear_state(context)
-            await update.message.reply_text("✅ Added payment method.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
-            return
+    # edit balance
+    if state == "edit_balance":
+        await admin_user_edit_balance_text(update, context); return
 
-        if state == "pm_edit":
-            sid = int(data["shop_id"])
-            pmid = int(data["pm_id"])
-            txt = (update.message.text or "").strip()
-            if txt == "-":
-                txt = ""
-            r = pm_get(pmid)
-            if r and int(r["shop_owner_id"]) == sid:
-                pm_update(pmid, r["name"], txt)
-            clear_state(context)
-            await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+    # broadcast
+    if state == "broadcast":
+        await broadcast_collect(update, context); return
+
+    # edit welcome
+    if state == "edit_welcome":
+        sid = int(data["shop_id"])
+        msg = update.message
+        if msg.photo:
+            await run_db(set_shop_setting, sid, "welcome_file_id", msg.photo[-1].file_id)
+            await run_db(set_shop_setting, sid, "welcome_file_type", "photo")
+            await run_db(set_shop_setting, sid, "welcome_text", msg.caption or "")
+        elif msg.video:
+            await run_db(set_shop_setting, sid, "welcome_file_id", msg.video.file_id)
+            await run_db(set_shop_setting, sid, "welcome_file_type", "video")
+            await run_db(set_shop_setting, sid, "welcome_text", msg.caption or "")
+        else:
+            await run_db(set_shop_setting, sid, "welcome_file_id", "")
+            await run_db(set_shop_setting, sid, "welcome_file_type", "")
+            await run_db(set_shop_setting, sid, "welcome_text", msg.text or "")
+        clear_state(context)
+        await msg.reply_text("✅ Welcome updated.", reply_markup=admin_panel_kb(sid))
+        return
+
+    # payment methods add/edit
+    if state == "pm_add_name":
+        sid = int(data["shop_id"])
+        name = (update.message.text or "").strip()
+        if not name:
+            await update.message.reply_text("Send a method name (example: PAYPAL)."); return
+        set_state(context, "pm_add_text", {"shop_id": sid, "name": name})
+        await update.message.reply_text("Send instructions text for this method:"); return
+
+    if state == "pm_add_text":
+        sid = int(data["shop_id"])
+        txt = (update.message.text or "").strip()
+        if txt == "-":
+            txt = ""
+        await run_db(pm_add, sid, data.get("name","Method"), txt)
+        clear_state(context)
+        await update.message.reply_text("✅ Added payment method.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+        return
+
+    if state == "pm_edit":
+        sid = int(data["shop_id"])
+        pmid = int(data["pm_id"])
+        txt = (update.message.text or "").strip()
+        if txt == "-":
+            txt = ""
+        r = await run_db(pm_get, pmid)
+        if r and int(r["shop_owner_id"]) == sid:
+            await run_db(pm_update, pmid, r["name"], txt)
+        clear_state(context)
+        await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+        return
+
+
+    
+    # deposit payment methods admin
+    if state == "pm_add_name":
+        sid = int(data["shop_id"])
+        name = (update.message.text or "").strip()
+        if not name:
             return
+        set_state(context, "pm_add_text", {"shop_id": sid, "name": name})
+        await update.message.reply_text("Now send instructions text (wallet / payment details):")
+        return
 
+    if state == "pm_add_text":
+        sid = int(data["shop_id"])
+        name = (data.get("name") or "").strip()
+        txt = (update.message.text or "").strip()
+        if not name:
+            clear_state(context); return
+        await run_db(pm_add, sid, name, txt)
+        clear_state(context)
+        await update.message.reply_text("✅ Method added.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
+        return
 
-        
-        # deposit payment methods admin
-        if state == "pm_add_name":
-            sid = int(data["shop_id"])
+    if state == "pm_edit":
+        sid = int(data["shop_id"]); pm_id = int(data["pm_id"])
+        stage = context.user_data.get("_pm_stage") or "name"
+        if stage == "name":
             name = (update.message.text or "").strip()
             if not name:
                 return
-            set_state(context, "pm_add_text", {"shop_id": sid, "name": name})
-            await update.message.reply_text("Now send instructions text (wallet / payment details):")
+            context.user_data["_pm_new_name"] = name
+            context.user_data["_pm_stage"] = "text"
+            STATE.mark(context)
+            await update.message.reply_text("Now send new instructions text:")
             return
-
-        if state == "pm_add_text":
-            sid = int(data["shop_id"])
-            name = (data.get("name") or "").strip()
+        else:
+            name = (context.user_data.get("_pm_new_name") or "").strip()
             txt = (update.message.text or "").strip()
-            if not name:
-                clear_state(context); return
-            pm_add(sid, name, txt)
+            await run_db(pm_update, pm_id, name or "Method", txt)
+            context.user_data.pop("_pm_stage", None)
+            context.user_data.pop("_pm_new_name", None)
             clear_state(context)
-            await update.message.reply_text("✅ Method added.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
-            return
-
-        if state == "pm_edit":
-            sid = int(data["shop_id"]); pm_id = int(data["pm_id"])
-            stage = context.user_data.get("_pm_stage") or "name"
-            if stage == "name":
-                name = (update.message.text or "").strip()
-                if not name:
-                    return
-                context.user_data["_pm_new_name"] = name
-                context.user_data["_pm_stage"] = "text"
-                await update.message.reply_text("Now send new instructions text:")
-                return
-            else:
-                name = (context.user_data.get("_pm_new_name") or "").strip()
-                txt = (update.message.text or "").strip()
-                pm_update(pm_id, name or "Method", txt)
-                context.user_data.pop("_pm_stage", None)
-                context.user_data.pop("_pm_new_name", None)
-                clear_state(context)
-                await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
-                return
-            rows = [[InlineKeyboardButton(oid, callback_data=f"o:view:{sid}:{oid}")] for oid in ids]
-            rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
-            await update.message.reply_text("Matches:", reply_markup=kb(rows))
+            await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"a:pm:{sid}")]]))
             return
+        rows = [[InlineKeyboardButton(oid, callback_data=f"o:view:{sid}:{oid}")] for oid in ids]
+        rows.append([InlineKeyboardButton("⬅️ Admin", callback_data="m:admin")])
+        await update.message.reply_text("Matches:", reply_markup=kb(rows))
+        return
 
 # super admin seller balance
-        if state == "super_edit_balance":
-            sid = int(data["seller_id"])
-            t = (update.message.text or "").strip().replace(" ", "")
-            clear_state(context)
-            m = re.fullmatch(r"([+-])(\d+(?:\.\d+)?)", t)
-            if not m:
-                await update.message.reply_text("❌ Invalid. Example: +10 or -5"); return
-            sign = m.group(1); amt = float(m.group(2))
-            if sign == "+":
-                add_balance(SUPER_ADMIN_ID, sid, amt); log_tx(SUPER_ADMIN_ID, sid, "balance_edit", amt, "Super admin")
-            else:
-                add_balance(SUPER_ADMIN_ID, sid, -amt); log_tx(SUPER_ADMIN_ID, sid, "balance_edit", -amt, "Super admin")
-            await update.message.reply_text(f"✅ Updated seller balance. New: {money(get_balance(SUPER_ADMIN_ID, sid))} {CURRENCY}")
-            return
+    if state == "super_edit_balance":
+        sid = int(data["seller_id"])
+        t = (update.message.text or "").strip().replace(" ", "")
+        clear_state(context)
+        m = re.fullmatch(r"([+-])(\d+(?:\.\d+)?)", t)
+        if not m:
+            await update.message.reply_text("❌ Invalid. Example: +10 or -5"); return
+        sign = m.group(1); amt = float(m.group(2))
+        if sign == "+":
+            await run_db(add_balance, SUPER_ADMIN_ID, sid, amt); await run_db(log_tx, SUPER_ADMIN_ID, sid, "balance_edit", amt, "Super admin")
+        else:
+            await run_db(add_balance, SUPER_ADMIN_ID, sid, -amt); await run_db(log_tx, SUPER_ADMIN_ID, sid, "balance_edit", -amt, "Super admin")
+        await update.message.reply_text(f"✅ Updated seller balance. New: {money(await run_db(get_balance, SUPER_ADMIN_ID, sid))} {CURRENCY}")
+        return
 
 
-        # super admin edit english ui text
-        if state == "sa_edittext":
-            key = (data.get("key") or "").strip()
-            val = (update.message.text or "").strip()
-            clear_state(context)
-            if val == "-":
-                ui_delete(key)
-                await update.message.reply_text("✅ Reset to default.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
-            else:
-                ui_set(key, val)
-                await update.message.reply_text("✅ Saved.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
+    # super admin edit english ui text
+    if state == "sa_edittext":
+        key = (data.get("key") or "").strip()
+        val = (update.message.text or "").strip()
+        clear_state(context)
+        if val == "-":
+            await run_db(ui_delete, key)
+            await update.message.reply_text("✅ Reset to default.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
+        else:
+            await run_db(ui_set, key, val)
+            await update.message.reply_text("✅ Saved.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data="m:super")]]))
+        return
+    # super search
+    if state == "super_search":
+        await super_search_text(update, context); return
+
+    # order id search (admin)
+        o = get_order_by_id(oid) if 'get_order_by_id' in globals() else None
+        # Fallback to get_order() if present
+        if not o and 'get_order' in globals():
+            o = await run_db(get_order, sid, oid)
+        if not o:
+            await update.message.reply_text(tr(update.effective_user.id, "no_match"), reply_markup=admin_panel_kb(sid))
             return
-        # super search
-        if state == "super_search":
-            await super_search_text(update, context); return
-
-        # order id search (admin)
-            o = get_order_by_id(oid) if 'get_order_by_id' in globals() else None
-            # Fallback to get_order() if present
-            if not o and 'get_order' in globals():
-                o = get_order(sid, oid)
-            if not o:
+        # Ensure shop matches
+        try:
+            if sid and int(o.get("shop_owner_id") if hasattr(o,'get') else o["shop_owner_id"]) != sid:
                 await update.message.reply_text(tr(update.effective_user.id, "no_match"), reply_markup=admin_panel_kb(sid))
                 return
-            # Ensure shop matches
-            try:
-                if sid and int(o.get("shop_owner_id") if hasattr(o,'get') else o["shop_owner_id"]) != sid:
-                    await update.message.reply_text(tr(update.effective_user.id, "no_match"), reply_markup=admin_panel_kb(sid))
-                    return
-            except Exception:
-                pass
-            created = int(o["created_at"] or 0)
-            dt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)) if created else "-"
-            keys = (o["keys_text"] or "").strip()
-            delivered = "\n".join([f"<code>{esc(k)}</code>" for k in keys.splitlines() if k.strip()]) or "-"
-            msg = (
-                f"{tr(update.effective_user.id, 'order_found')}\n\n"
-                f"Order ID: <code>{esc(oid)}</code>\n"
-                f"Date: <b>{esc(dt)}</b>\n"
-                f"User: <b>{esc(user_display(int(o['user_id'])) )}</b>\n"
-                f"Product: <b>{esc(o['product_name'])}</b>\n"
-                f"Qty: <b>{int(o['qty'] or 1)}</b>\n"
-                f"Total: <b>{money(float(o['total'] or 0))} {esc(CURRENCY)}</b>\n\n"
-                f"<b>Delivered Key(s):</b>\n{delivered}"
-            )
-            await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=admin_panel_kb(sid))
-            return
-
-        # ---- Manage Catalog states ----
-        if state == "mg_addcat":
-            sid = int(data["shop_id"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            conn = db(); cur = conn.cursor()
-            cur.execute("INSERT INTO categories(shop_owner_id,name) VALUES(?,?)", (sid, name))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Category added.", reply_markup=admin_panel_kb(sid))
-            return
+        except Exception:
+            pass
+        created = int(o["created_at"] or 0)
+        dt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)) if created else "-"
+        keys = (o["keys_text"] or "").strip()
+        delivered = "\n".join([f"<code>{esc(k)}</code>" for k in keys.splitlines() if k.strip()]) or "-"
+        msg = (
+            f"{tr(update.effective_user.id, 'order_found')}\n\n"
+            f"Order ID: <code>{esc(oid)}</code>\n"
+            f"Date: <b>{esc(dt)}</b>\n"
+            f"User: <b>{esc(await run_db(user_display, int(o['user_id'])) )}</b>\n"
+            f"Product: <b>{esc(o['product_name'])}</b>\n"
+            f"Qty: <b>{int(o['qty'] or 1)}</b>\n"
+            f"Total: <b>{money(float(o['total'] or 0))} {esc(CURRENCY)}</b>\n\n"
+            f"<b>Delivered Key(s):</b>\n{delivered}"
+        )
+        await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=admin_panel_kb(sid))
+        return
 
-        if state == "mg_addsub":
-            sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            conn = db(); cur = conn.cursor()
-            cur.execute("INSERT INTO cocategories(shop_owner_id,category_id,name) VALUES(?,?,?)", (sid, cat_id, name))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Sub-category added.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
-            return
+    # ---- Manage Catalog states ----
+    if state == "mg_addcat":
+        sid = int(data["shop_id"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        await run_db(cat_add, sid, name)
+        clear_state(context)
+        await update.message.reply_text("✅ Category added.", reply_markup=admin_panel_kb(sid))
+        return
 
-        if state == "mg_addprod_name":
-            sid = int(data["shop_id"]); cat_id = int(data["cat_id"]); sub_id = int(data["sub_id"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            data["name"] = name
-            set_state(context, "mg_addprod_price", data)
-            await update.message.reply_text("Send product price (number):")
-            return
+    if state == "mg_addsub":
+        sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        await run_db(cocat_add, sid, cat_id, name)
+        clear_state(context)
+        await update.message.reply_text("✅ Sub-category added.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+        return
 
-        if state == "mg_addprod_price":
-            sid = int(data["shop_id"]); cat_id = int(data["cat_id"]); sub_id = int(data["sub_id"])
-            price = parse_float(update.message.text or "")
-            if price is None or price <= 0:
-                await update.message.reply_text("❌ Invalid price. Send number."); return
-            name = data["name"]
-            conn = db(); cur = conn.cursor()
-            cur.execute("""INSERT INTO products(shop_owner_id,category_id,cocategory_id,name,price) VALUES(?,?,?,?,?)""",
-                        (sid, cat_id, sub_id, name, float(price)))
-            pid = int(cur.lastrowid)
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Product added.", reply_markup=kb([[InlineKeyboardButton("Open Product", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_addprod_name":
+        sid = int(data["shop_id"]); cat_id = int(data["cat_id"]); sub_id = int(data["sub_id"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        data["name"] = name
+        set_state(context, "mg_addprod_price", data)
+        await update.message.reply_text("Send product price (number):")
+        return
 
-        if state == "mg_edit_name":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE products SET name=? WHERE shop_owner_id=? AND id=?", (name, sid, pid))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_addprod_price":
+        sid = int(data["shop_id"]); cat_id = int(data["cat_id"]); sub_id = int(data["sub_id"])
+        price = parse_float(update.message.text or "")
+        if price is None or price <= 0:
+            await update.message.reply_text("❌ Invalid price. Send number."); return
+        name = data["name"]
+        pid = await run_db(prod_add, sid, cat_id, sub_id, name, float(price))
+        clear_state(context)
+        await update.message.reply_text("✅ Product added.", reply_markup=kb([[InlineKeyboardButton("Open Product", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-        if state == "mg_edit_price":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            price = parse_float(update.message.text or "")
-            if price is None or price <= 0:
-                await update.message.reply_text("❌ Invalid price."); return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE products SET price=? WHERE shop_owner_id=? AND id=?", (float(price), sid, pid))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_edit_name":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        await run_db(catalog_update, "products", sid, pid, name=name)
+        clear_state(context)
+        await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-        if state == "mg_edit_desc":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            desc = (update.message.text or "").strip()
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE products SET description=? WHERE shop_owner_id=? AND id=?", (desc, sid, pid))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Description updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_edit_price":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        price = parse_float(update.message.text or "")
+        if price is None or price <= 0:
+            await update.message.reply_text("❌ Invalid price."); return
+        await run_db(catalog_update, "products", sid, pid, price=float(price))
+        clear_state(context)
+        await update.message.reply_text("✅ Updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-        if state == "mg_edit_link":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            link = (update.message.text or "").strip()
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE products SET tg_link=? WHERE shop_owner_id=? AND id=?", (link, sid, pid))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Link updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_edit_desc":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        desc = (update.message.text or "").strip()
+        await run_db(catalog_update, "products", sid, pid, description=desc)
+        clear_state(context)
+        await update.message.reply_text("✅ Description updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
+    if state == "mg_edit_link":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        link = (update.message.text or "").strip()
+        await run_db(catalog_update, "products", sid, pid, tg_link=link)
+        clear_state(context)
+        await update.message.reply_text("✅ Link updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-        if state == "mg_cat_media":
-            sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
-            msg = update.message
-            file_id = ""; ftype = ""
-            if msg.photo:
-                file_id = msg.photo[-1].file_id; ftype = "photo"
-            elif msg.video:
-                file_id = msg.video.file_id; ftype = "video"
-            else:
-                await update.message.reply_text("Send a PHOTO or VIDEO."); return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE categories SET file_id=?, file_type=? WHERE shop_owner_id=? AND id=?", (file_id, ftype, sid, cat_id))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Category media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
-            return
 
-        if state == "mg_sub_media":
-            sid = int(data["shop_id"]); sub_id = int(data["sub_id"]); cat_id = int(data["cat_id"])
-            msg = update.message
-            file_id = ""; ftype = ""
-            if msg.photo:
-                file_id = msg.photo[-1].file_id; ftype = "photo"
-            elif msg.video:
-                file_id = msg.video.file_id; ftype = "video"
-            else:
-                await update.message.reply_text("Send a PHOTO or VIDEO."); return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE cocategories SET file_id=?, file_type=? WHERE shop_owner_id=? AND id=?", (file_id, ftype, sid, sub_id))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Sub-category media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
-            return
+    if state == "mg_cat_media":
+        sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
+        msg = update.message
+        file_id = ""; ftype = ""
+        if msg.photo:
+            file_id = msg.photo[-1].file_id; ftype = "photo"
+        elif msg.video:
+            file_id = msg.video.file_id; ftype = "video"
+        else:
+            await update.message.reply_text("Send a PHOTO or VIDEO."); return
+        await run_db(catalog_update, "categories", sid, cat_id, file_id=file_id, file_type=ftype)
+        clear_state(context)
+        await update.message.reply_text("✅ Category media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+        return
 
-        if state == "mg_edit_media":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            msg = update.message
-            file_id = ""; ftype = ""
-            if msg.photo:
-                file_id = msg.photo[-1].file_id; ftype = "photo"
-            elif msg.video:
-                file_id = msg.video.file_id; ftype = "video"
-            else:
-                await update.message.reply_text("Send a PHOTO or VIDEO."); return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE products SET file_id=?, file_type=? WHERE shop_owner_id=? AND id=?", (file_id, ftype, sid, pid))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_sub_media":
+        sid = int(data["shop_id"]); sub_id = int(data["sub_id"]); cat_id = int(data["cat_id"])
+        msg = update.message
+        file_id = ""; ftype = ""
+        if msg.photo:
+            file_id = msg.photo[-1].file_id; ftype = "photo"
+        elif msg.video:
+            file_id = msg.video.file_id; ftype = "video"
+        else:
+            await update.message.reply_text("Send a PHOTO or VIDEO."); return
+        await run_db(catalog_update, "cocategories", sid, sub_id, file_id=file_id, file_type=ftype)
+        clear_state(context)
+        await update.message.reply_text("✅ Sub-category media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+        return
 
-        if state == "mg_add_keys":
-            sid = int(data["shop_id"]); pid = int(data["pid"])
-            raw = (update.message.text or "").strip()
-            lines = raw.splitlines()
-            n = add_keys(sid, pid, lines)
-            clear_state(context)
-            await update.message.reply_text(f"✅ Added {n} key(s). Stock now: {stock_count(sid, pid)}", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
-            return
+    if state == "mg_edit_media":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        msg = update.message
+        file_id = ""; ftype = ""
+        if msg.photo:
+            file_id = msg.photo[-1].file_id; ftype = "photo"
+        elif msg.video:
+            file_id = msg.video.file_id; ftype = "video"
+        else:
+            await update.message.reply_text("Send a PHOTO or VIDEO."); return
+        await run_db(catalog_update, "products", sid, pid, file_id=file_id, file_type=ftype)
+        clear_state(context)
+        await update.message.reply_text("✅ Media set.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-        await update.message.reply_text("Use the buttons. Type /start to reopen menu.")
+    if state == "mg_add_keys":
+        sid = int(data["shop_id"]); pid = int(data["pid"])
+        raw = (update.message.text or "").strip()
+        lines = raw.splitlines()
+        n = await run_db(add_keys, sid, pid, lines)
+        clear_state(context)
+        await update.message.reply_text(f"✅ Added {n} key(s). Stock now: {await run_db(stock_count, sid, pid)}", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+        return
 
-    # ---------- CALLBACK ROUTER ----------
-    async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        q = update.callback_query
-        data = q.data
-        uid = update.effective_user.id
-
-        # menu
-        if data == "m:menu":
-            await menu_cb(update, context); return
-
-        # main buttons
-        if data == "m:products":
-            await products_root(update, context); return
-        if data.startswith("p:cat:"):
-            await products_cat(update, context); return
-        if data.startswith("p:sub:"):
-            await products_sub(update, context); return
-        if data.startswith("p:prod:"):
-            await product_view(update, context); return
-        if data.startswith("p:q:"):
-            await product_qty(update, context); return
-        if data.startswith("p:buy:"):
-            await product_buy(update, context); return
-        if data.startswith("p:file:"):
-            await product_file(update, context); return
-        if data.startswith("p:filecheck:"):
-            await product_file(update, context); return
-
-        if data == "m:wallet":
-            await wallet(update, context); return
-        if data == "w:deposit":
-            await deposit_start(update, context); return
-        if data.startswith("w:method:"):
-            await deposit_method(update, context); return
-        if data.startswith("w:method:"):
-            await deposit_method(update, context); return
-        if data.startswith("d:"):
-            await deposit_decision(update, context); return
-
-        if data == "m:history":
-            await history(update, context); return
-
-        if data == "m:support":
-            await support_start(update, context); return
-        if data == "s:done":
-            await support_done(update, context); return
-
-        if data.startswith("a:reply:"):
-            await admin_reply_start(update, context); return
-
-
-        # language
-        if data == "m:lang":
-            await language_menu(update, context); return
-        if data.startswith("lang:set:"):
-            await language_set(update, context); return
-
-        # order id search (admin)
-        if data.startswith("a:osearch:"):
-            await admin_order_search_start(update, context); return
-
-        # connect
-        if data == "m:connect":
-            await connect_screen(update, context); return
-        if data.startswith("c:plan:"):
-            await choose_plan(update, context); return
-
-        # extend
-        if data == "m:extend":
-            await extend_in_seller(update, context); return
-        if data.startswith("e:plan:"):
-            await extend_choose(update, context); return
-
-        # admin panel
-        if data == "m:admin":
-            await admin_open(update, context); return
-        if data.startswith("a:users:"):
-            await admin_users(update, context); return
-        if data.startswith("u:search:"):
-            await admin_user_search(update, context); return
-        if data.startswith("u:open:"):
-            await admin_user_open(update, context); return
-        if data.startswith("u:orders:"):
-            await admin_user_orders(update, context); return
-        if data.startswith("o:view:"):
-            await admin_order_view(update, context); return
-        if data.startswith("u:add:"):
-            await admin_user_add(update, context); return
-        if data.startswith("u:ded:"):
-            await admin_user_ded(update, context); return
-        if data.startswith("u:ban:"):
-            await admin_user_ban(update, context); return
-        if data.startswith("u:unban:"):
-            await admin_user_unban(update, context); return
-        if data.startswith("u:res:"):
-            await admin_user_restrict(update, context); return
-
-        if data.startswith("a:bcast:"):
-            await broadcast_start(update, context); return
-        if data == "b:done":
-            await broadcast_done(update, context); return
-        if data == "b:cancel":
-            await broadcast_cancel(update, context); return
-
-        if data.startswith("a:welcome:"):
-            await edit_welcome(update, context); return
-        if data.startswith("a:pm:"):
-            await admin_pm_root(update, context); return
-        if data.startswith("apm:add:"):
-            await admin_pm_add(update, context); return
-        if data.startswith("apm:open:"):
-            await admin_pm_open(update, context); return
-        if data.startswith("apm:edit:"):
-            await admin_pm_edit(update, context); return
-        if data.startswith("apm:del:"):
-            await admin_pm_delete(update, context); return
-        if data.startswith("pm:editdefault:"):
-            await pm_edit_default(update, context); return
-        if data.startswith("apm:add:"):
-            await pm_add_start(update, context); return
-        if data.startswith("apm:open:"):
-            await pm_open(update, context); return
-        if data.startswith("apm:edit:"):
-            await pm_edit_start(update, context); return
-        if data.startswith("apm:del:"):
-            await pm_delete_cb(update, context); return
-
-        if data.startswith("a:manage:"):
-            await manage_root(update, context); return
-
-        # manage callbacks
-        if data.startswith("mg:addcat:"):
-            await mg_addcat(update, context); return
-        if data.startswith("mg:cat:"):
-            await mg_cat_open(update, context); return
-        if data.startswith("mg:addsub:"):
-            await mg_addsub(update, context); return
-        if data.startswith("mg:sub:"):
-            await mg_sub_open(update, context); return
-        if data.startswith("mg:addprod:"):
-            await mg_addprod(update, context); return
-        if data.startswith("mg:prod:"):
-            await mg_prod_open(update, context); return
-
-
-        if data.startswith("mg:viewkeys:"):
-            await mg_viewkeys(update, context); return
-        if data.startswith("mg:delkey:"):
-            await mg_delkey(update, context); return
-        if data.startswith("mg:delallkeys:"):
-            await mg_delallkeys(update, context); return
-
-        # product edit actions
-        if data.startswith("mg:editname:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_edit_name", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send new product name:"); return
-        if data.startswith("mg:editprice:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_edit_price", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send new product price (number):"); return
-        if data.startswith("mg:desc:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_edit_desc", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send description (or '-' to clear):"); return
-        if data.startswith("mg:link:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_edit_link", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send private Telegram link (or '-' to clear):"); return
-        if data.startswith("mg:media:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_edit_media", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send PHOTO or VIDEO to set as product media:"); return
-        if data.startswith("mg:keys:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            set_state(context, "mg_add_keys", {"shop_id": int(sid_s), "pid": int(pid_s)})
-            await q.message.reply_text("Send keys (1 per line). Each line = 1 stock:"); return
-        if data.startswith("mg:clearkeys:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            sid = int(sid_s); pid = int(pid_s)
-            clear_keys(sid, pid)
-            await q.message.reply_text("✅ Cleared all unused keys.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]])); return
-        if data.startswith("mg:delprod:"):
-            await q.answer()
-            _, _, sid_s, pid_s = data.split(":")
-            sid = int(sid_s); pid = int(pid_s)
-            p = prod_get(sid, pid)
-            if not p:
-                await q.message.reply_text("Not found."); return
-            conn = db(); cur = conn.cursor()
-            cur.execute("DELETE FROM products WHERE shop_owner_id=? AND id=?", (sid, pid))
-            cur.execute("DELETE FROM product_keys WHERE shop_owner_id=? AND product_id=?", (sid, pid))
-            conn.commit(); conn.close()
-            await q.message.reply_text("✅ Product deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:sub:{sid}:{p['category_id']}:{p['cocategory_id']}")]])); return
-
-
-        # category/subcategory media set
-        if data.startswith("mg:catmedia:"):
-            await q.answer()
-            _, _, sid_s, cat_s = data.split(":")
-            set_state(context, "mg_cat_media", {"shop_id": int(sid_s), "cat_id": int(cat_s)})
-            await q.message.reply_text("Send PHOTO or VIDEO for this category (caption ignored):")
-            return
+    await update.message.reply_text("Use the buttons. Type /start to reopen menu.")
+
+# ---------- CALLBACK ROUTER ----------
+async def mg_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, state: str, prompt: str, sid: int, **ids):
+    await update.callback_query.answer()
+    set_state(context, state, {"shop_id": sid, **ids})
+    await update.callback_query.message.reply_text(prompt)
+
+async def mg_clearkeys(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int):
+    await update.callback_query.answer()
+    await run_db(clear_keys, sid, pid)
+    await update.callback_query.message.reply_text("✅ Cleared all unused keys.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:prod:{sid}:{pid}")]]))
+
+async def mg_delprod(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, pid: int):
+    await update.callback_query.answer()
+    p = await run_db(prod_get, sid, pid)
+    if not p:
+        await update.callback_query.message.reply_text("Not found."); return
+    await run_db(prod_delete, sid, pid)
+    await update.callback_query.message.reply_text("✅ Product deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:sub:{sid}:{p['category_id']}:{p['cocategory_id']}")]]))
+
+async def mg_delcat(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, cat_id: int):
+    await update.callback_query.answer()
+    # delete cascade
+    await run_db(cat_delete, sid, cat_id)
+    await update.callback_query.message.reply_text("✅ Category deleted.", reply_markup=admin_panel_kb(sid))
+
+async def mg_delsub(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, sub_id: int, cat_id: int):
+    await update.callback_query.answer()
+    await run_db(cocat_delete, sid, sub_id)
+    await update.callback_query.message.reply_text("✅ Sub-category deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+
+async def answer_only(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+
+ROUTER = CallbackRouter()
+
+# menu / shop
+ROUTER.add("m:menu", menu_cb)
+ROUTER.add("m:products", products_root)
+ROUTER.add("p:cat:{cat_id:int}", products_cat)
+ROUTER.add("p:sub:{cat_id:int}:{sub_id:int}", products_sub)
+ROUTER.add("p:prod:{pid:int}", product_view)
+ROUTER.add("p:q:{pid:int}:{qty:int}", product_qty)
+ROUTER.add("p:qty:{pid:int}:{qty:int}", product_qty_prompt)
+ROUTER.add("p:buy:{pid:int}:{qty:int}", product_buy)
+# cards sent before the quantity moved into callback data
+ROUTER.add("p:q:+:{pid:int}", product_legacy_card, step=1)
+ROUTER.add("p:q:-:{pid:int}", product_legacy_card, step=-1)
+ROUTER.add("p:buy:{pid:int}", product_legacy_card)
+ROUTER.add("p:file:{pid:int}", product_file)
+ROUTER.add("p:filecheck:{pid:int}", product_file)
+
+# wallet / deposits
+ROUTER.add("m:wallet", wallet)
+ROUTER.add("w:deposit", deposit_start)
+ROUTER.add("w:method:{pm_id}", deposit_method)
+ROUTER.add("d:{decision}:{rid:int}", deposit_decision)
+ROUTER.add("m:history", history)
+
+# support
+ROUTER.add("m:support", support_start)
+ROUTER.add("s:done", support_done)
+ROUTER.add("a:reply:{target_uid:int}:{sid:int}", admin_reply_start)
+
+# language
+ROUTER.add("m:lang", language_menu)
+ROUTER.add("lang:set:{code}", language_set)
+
+# connect / extend
+ROUTER.add("m:connect", connect_screen)
+ROUTER.add("c:plan:{plan}", choose_plan)
+ROUTER.add("m:extend", extend_in_seller)
+ROUTER.add("e:plan:{plan}", extend_choose)
+
+# admin panel
+ROUTER.add("m:admin", admin_open)
+ROUTER.add("a:osearch:{sid:int}", admin_order_search_start)
+ROUTER.add("a:users:{sid:int}", admin_users)
+ROUTER.add("u:search:{sid:int}", admin_user_search)
+ROUTER.add("u:open:{sid:int}:{target:int}", admin_user_open)
+ROUTER.add("u:orders:{sid:int}:{target:int}", admin_user_orders)
+ROUTER.add("o:view:{sid:int}:{oid}", admin_order_view)
+ROUTER.add("o:view:{sid:int}:{target:int}:{oid}", admin_order_view)
+ROUTER.add("u:add:{sid:int}:{target:int}", admin_user_add)
+ROUTER.add("u:ded:{sid:int}:{target:int}", admin_user_ded)
+ROUTER.add("u:ban:{sid:int}:{target:int}", admin_user_ban)
+ROUTER.add("u:unban:{sid:int}:{target:int}", admin_user_unban)
+ROUTER.add("u:res:{sid:int}:{target:int}:{days:int}", admin_user_restrict)
+ROUTER.add("a:bcast:{sid:int}", broadcast_start)
+ROUTER.add("b:done", broadcast_done)
+ROUTER.add("b:cancel", broadcast_cancel)
+ROUTER.add("b:stop:{job_id:int}", broadcast_stop)
+ROUTER.add("a:welcome:{sid:int}", edit_welcome)
+ROUTER.add("a:pm:{sid:int}", admin_pm_root)
+ROUTER.add("apm:add:{sid:int}", admin_pm_add)
+ROUTER.add("apm:open:{sid:int}:{pm_id:int}", admin_pm_open)
+ROUTER.add("apm:edit:{sid:int}:{pm_id:int}", admin_pm_edit)
+ROUTER.add("apm:del:{sid:int}:{pm_id:int}", admin_pm_delete)
+
+# manage catalog
+ROUTER.add("a:manage:{sid:int}", manage_root)
+ROUTER.add("mg:addcat:{sid:int}", mg_addcat)
+ROUTER.add("mg:cat:{sid:int}:{cat_id:int}", mg_cat_open)
+ROUTER.add("mg:addsub:{sid:int}:{cat_id:int}", mg_addsub)
+ROUTER.add("mg:sub:{sid:int}:{cat_id:int}:{sub_id:int}", mg_sub_open)
+ROUTER.add("mg:addprod:{sid:int}:{cat_id:int}:{sub_id:int}", mg_addprod)
+ROUTER.add("mg:prod:{sid:int}:{pid:int}", mg_prod_open)
+ROUTER.add("mg:viewkeys:{sid:int}:{pid:int}:{page:int}", mg_viewkeys)
+ROUTER.add("mg:delkey:{sid:int}:{pid:int}:{kid:int}:{page:int}", mg_delkey)
+ROUTER.add("mg:delallkeys:{sid:int}:{pid:int}:{page:int}", mg_delallkeys)
+ROUTER.add("mg:editname:{sid:int}:{pid:int}", mg_prompt, state="mg_edit_name", prompt="Send new product name:")
+ROUTER.add("mg:editprice:{sid:int}:{pid:int}", mg_prompt, state="mg_edit_price", prompt="Send new product price (number):")
+ROUTER.add("mg:desc:{sid:int}:{pid:int}", mg_prompt, state="mg_edit_desc", prompt="Send description (or '-' to clear):")
+ROUTER.add("mg:link:{sid:int}:{pid:int}", mg_prompt, state="mg_edit_link", prompt="Send private Telegram link (or '-' to clear):")
+ROUTER.add("mg:media:{sid:int}:{pid:int}", mg_prompt, state="mg_edit_media", prompt="Send PHOTO or VIDEO to set as product media:")
+ROUTER.add("mg:keys:{sid:int}:{pid:int}", mg_prompt, state="mg_add_keys", prompt="Send keys (1 per line). Each line = 1 stock:")
+ROUTER.add("mg:clearkeys:{sid:int}:{pid:int}", mg_clearkeys)
+ROUTER.add("mg:delprod:{sid:int}:{pid:int}", mg_delprod)
+ROUTER.add("mg:catmedia:{sid:int}:{cat_id:int}", mg_prompt, state="mg_cat_media", prompt="Send PHOTO or VIDEO for this category (caption ignored):")
+ROUTER.add("mg:submedia:{sid:int}:{sub_id:int}:{cat_id:int}", mg_prompt, state="mg_sub_media", prompt="Send PHOTO or VIDEO for this sub-category (caption ignored):")
+ROUTER.add("mg:editcat:{sid:int}:{cat_id:int}", mg_prompt, state="mg_edit_cat_name", prompt="Send new category name:")
+ROUTER.add("mg:delcat:{sid:int}:{cat_id:int}", mg_delcat)
+ROUTER.add("mg:editsub:{sid:int}:{sub_id:int}:{cat_id:int}", mg_prompt, state="mg_edit_sub_name", prompt="Send new sub-category name:")
+ROUTER.add("mg:delsub:{sid:int}:{sub_id:int}:{cat_id:int}", mg_delsub)
+
+# super admin
+ROUTER.add("m:super", super_open)
+ROUTER.add("sa:home", super_open)
+ROUTER.add("sa:sellers", super_sellers)
+ROUTER.add("sa:search", super_search)
+ROUTER.add("sa:sel:{sid:int}", super_seller_open)
+ROUTER.add("sa:editui", sa_editui)
+ROUTER.add("sa:editui:pick:{field}", sa_editui_pick)
+ROUTER.add("sa:edittexts", sa_edittexts)
+ROUTER.add("sa:edittext:{key:rest}", sa_edittext_pick)
+ROUTER.add("sa:noop", answer_only)
+ROUTER.add("sa:res:{sid:int}:{days:int}", super_action, act="res")
+ROUTER.add("sa:{act}:{sid:int}", super_action)
+ROUTER.add("noop", answer_only)
+
+# extra: handle edit cat/sub name states in text_or_media via simple hooks
+async def extra_text_states(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state, data = get_state(context)
+    if state == "mg_edit_cat_name":
+        sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        await run_db(catalog_update, "categories", sid, cat_id, name=name)
+        clear_state(context)
+        await update.message.reply_text("✅ Category updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+        return True
+    if state == "mg_edit_sub_name":
+        sid = int(data["shop_id"]); sub_id = int(data["sub_id"]); cat_id = int(data["cat_id"])
+        name = (update.message.text or "").strip()
+        if not name: return
+        await run_db(catalog_update, "cocategories", sid, sub_id, name=name)
+        clear_state(context)
+        await update.message.reply_text("✅ Sub-category updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
+        return True
+    return False
 
-        if data.startswith("mg:submedia:"):
-            await q.answer()
-            _, _, sid_s, sub_s, cat_s = data.split(":")
-            set_state(context, "mg_sub_media", {"shop_id": int(sid_s), "sub_id": int(sub_s), "cat_id": int(cat_s)})
-            await q.message.reply_text("Send PHOTO or VIDEO for this sub-category (caption ignored):")
+# wrap main message handler to include extra_text_states
+async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message and update.message.text:
+        handled = await extra_text_states(update, context)
+        if handled:
             return
-        # category edit/delete
-        if data.startswith("mg:editcat:"):
-            await q.answer()
-            _, _, sid_s, cat_s = data.split(":")
-            set_state(context, "mg_edit_cat_name", {"shop_id": int(sid_s), "cat_id": int(cat_s)})
-            await q.message.reply_text("Send new category name:"); return
-        if data.startswith("mg:delcat:"):
-            await q.answer()
-            _, _, sid_s, cat_s = data.split(":")
-            sid = int(sid_s); cat_id = int(cat_s)
-            # delete cascade
-            conn = db(); cur = conn.cursor()
-            cur.execute("DELETE FROM categories WHERE shop_owner_id=? AND id=?", (sid, cat_id))
-            cur.execute("DELETE FROM cocategories WHERE shop_owner_id=? AND category_id=?", (sid, cat_id))
-            cur.execute("DELETE FROM products WHERE shop_owner_id=? AND category_id=?", (sid, cat_id))
-            conn.commit(); conn.close()
-            await q.message.reply_text("✅ Category deleted.", reply_markup=admin_panel_kb(sid)); return
-
-        # subcat edit/delete
-        if data.startswith("mg:editsub:"):
-            await q.answer()
-            _, _, sid_s, sub_s, cat_s = data.split(":")
-            set_state(context, "mg_edit_sub_name", {"shop_id": int(sid_s), "sub_id": int(sub_s), "cat_id": int(cat_s)})
-            await q.message.reply_text("Send new sub-category name:"); return
-        if data.startswith("mg:delsub:"):
-            await q.answer()
-            _, _, sid_s, sub_s, cat_s = data.split(":")
-            sid = int(sid_s); sub_id = int(sub_s); cat_id = int(cat_s)
-            conn = db(); cur = conn.cursor()
-            cur.execute("DELETE FROM cocategories WHERE shop_owner_id=? AND id=?", (sid, sub_id))
-            cur.execute("DELETE FROM products WHERE shop_owner_id=? AND cocategory_id=?", (sid, sub_id))
-            conn.commit(); conn.close()
-            await q.message.reply_text("✅ Sub-category deleted.", reply_markup=kb([[InlineKeyboardButton("⬅️ Back", callback_data=f"mg:cat:{sid}:{cat_id}")]])); return
-
-        # super admin
-        if data == "m:super":
-            await super_open(update, context); return
-        if data == "sa:sellers":
-            await super_sellers(update, context); return
-        if data == "sa:search":
-            await super_search(update, context); return
-        if data.startswith("sa:sel:"):
-            await super_seller_open(update, context); return
-        if data == "sa:home":
-            await super_open(update, context); return
-        if data == "sa:editui":
-            await sa_editui(update, context); return
-        if data.startswith("sa:editui:pick:"):
-            await sa_editui_pick(update, context); return
-        if data == "sa:edittexts":
-            await sa_edittexts(update, context); return
-        if data.startswith("sa:edittext:"):
-            await sa_edittext_pick(update, context); return
-        if data == "sa:noop":
-            await q.answer(); return
-        if data.startswith("sa:"):
-            await super_action(update, context); return
-
-        if data == "noop":
-            await q.answer(); return
-
-        await q.answer()
-
-    # extra: handle edit cat/sub name states in text_or_media via simple hooks
-    async def extra_text_states(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        state, data = get_state(context)
-        if state == "mg_edit_cat_name":
-            sid = int(data["shop_id"]); cat_id = int(data["cat_id"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE categories SET name=? WHERE shop_owner_id=? AND id=?", (name, sid, cat_id))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Category updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
-            return True
-        if state == "mg_edit_sub_name":
-            sid = int(data["shop_id"]); sub_id = int(data["sub_id"]); cat_id = int(data["cat_id"])
-            name = (update.message.text or "").strip()
-            if not name: return
-            conn = db(); cur = conn.cursor()
-            cur.execute("UPDATE cocategories SET name=? WHERE shop_owner_id=? AND id=?", (name, sid, sub_id))
-            conn.commit(); conn.close()
-            clear_state(context)
-            await update.message.reply_text("✅ Sub-category updated.", reply_markup=kb([[InlineKeyboardButton("Back", callback_data=f"mg:cat:{sid}:{cat_id}")]]))
-            return True
-        return False
-
-    # wrap main message handler to include extra_text_states
-    async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if update.message and update.message.text:
-            handled = await extra_text_states(update, context)
-            if handled:
-                return
-        await text_or_media(update, context)
+    await text_or_media(update, context)
 
+def register_handlers(app: Application, shop_owner_id: int, bot_kind: str):
+    # handlers are shared module-level functions; the shop context lives in bot_data
+    app.bot_data["shop_owner_id"] = int(shop_owner_id)
+    app.bot_data["bot_kind"] = bot_kind
+    app.add_handler(TypeHandler(Update, note_activity), group=-2)
+    app.add_handler(TypeHandler(Update, warm_user_lang), group=-1)
     app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CallbackQueryHandler(callbacks))
+    app.add_handler(CallbackQueryHandler(ROUTER.dispatch))
     app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO, message_router))
     app.add_error_handler(on_error)
 
 # ---------------- MAIN ----------------
+SELLER_START_CONCURRENCY = int((os.getenv("SELLER_START_CONCURRENCY") or "20").strip() or "20")
+SELLER_START_TIMEOUT = float((os.getenv("SELLER_START_TIMEOUT") or "30").strip() or "30")
+
 async def main():
+    t0 = time.monotonic()
     init_db()
+    if WEBHOOK_URL:
+        await WEBHOOK_SERVER.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
 
-    # start seller bots
-    for r in list_enabled_seller_bots():
-        sid = int(r["seller_id"])
-        if seller_active(sid) and int(seller_row(sid)["banned_shop"] or 0) == 0:
-            try:
-                await MANAGER.start_seller_bot(sid, r["bot_token"])
-            except Exception:
-                log.exception("Failed to start seller bot %s", sid)
-
-    master = Application.builder().token(BOT_TOKEN).build()
+    # master first, so the main shop answers while seller bots come up
+    master = build_app(BOT_TOKEN)
     register_handlers(master, shop_owner_id=SUPER_ADMIN_ID, bot_kind="master")
 
     await master.initialize()
     await master.start()
-    asyncio.create_task(master.updater.start_polling(drop_pending_updates=True))
-    asyncio.create_task(watchdog())
-    log.info("Master bot started.")
+    await MANAGER.serve(MASTER_BOT_KEY, master)
+    log.info("Master bot started in %.1fs.", time.monotonic() - t0)
 
-    while True:
-        await asyncio.sleep(3600)
+    # start seller bots
+    bots = [(int(r["seller_id"]), r["bot_token"]) for r in await run_db(list_enabled_seller_bots)]
+    started, failed = await MANAGER.start_many(bots, SELLER_START_CONCURRENCY, SELLER_START_TIMEOUT)
+    log.info("Boot complete in %.1fs: %s seller bot(s) started, %s failed, %s skipped.",
+             time.monotonic() - t0, started, failed, len(bots) - started - failed)
+
+    spawn(EXPIRY.run(), name="expiry")
+    await BROADCASTS.resume()
+    spawn(watchdog(), name="watchdog")
+    spawn(stock_reconciler(), name="stock_reconciler")
+    spawn(STATE.run(), name="state")
+
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await WEBHOOK_SERVER.stop()
+        await cancel_background_tasks()
+        await STATE.flush()
+        await SharedRequest.aclose_all()
 
 if __name__ == "__main__":
     asyncio.run(main())
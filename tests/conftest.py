@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py reads its config at import time: point it at a throwaway database first
+_TMP = tempfile.mkdtemp(prefix="autopanel-tests-")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("SUPER_ADMIN_ID", "1")
+os.environ["DB_FILE"] = os.path.join(_TMP, "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# number of steps the very first migrate() applied, taken before any test touches the DB
+FRESH_STEPS = main.migrate()
+
+
+@pytest.fixture(scope="session")
+def M():
+    return main
+
+
+@pytest.fixture(scope="session")
+def fresh_steps():
+    return FRESH_STEPS
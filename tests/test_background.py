@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+
+def test_spawn_logs_failure_and_drops_reference(M, caplog):
+    async def boom():
+        raise ValueError("boom")
+
+    async def go():
+        task = M.spawn(boom(), name="boom")
+        assert task in M.BACKGROUND_TASKS
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        return task
+
+    with caplog.at_level(logging.ERROR):
+        task = asyncio.run(go())
+    assert task not in M.BACKGROUND_TASKS
+    assert any("boom" in r.getMessage() for r in caplog.records)
+
+
+def test_cancel_background_tasks(M):
+    async def go():
+        started = asyncio.Event()
+
+        async def forever():
+            started.set()
+            await asyncio.sleep(3600)
+
+        task = M.spawn(forever(), name="forever")
+        await started.wait()
+        await M.cancel_background_tasks()
+        return task
+
+    task = asyncio.run(go())
+    assert task.cancelled()
+    assert not M.BACKGROUND_TASKS
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class FakeBot:
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    async def send_message(self, uid, text, rate_limit_args=None):
+        self.sent.append(uid)
+        if self.on_send:
+            self.on_send(uid)
+
+    async def edit_message_text(self, *a, **kw):
+        pass
+
+
+def _job(M, monkeypatch, bot_key, users, bot):
+    sid = bot_key
+    for uid in users:
+        M.add_balance(sid, uid, 1)
+    monkeypatch.setitem(M.MANAGER.apps, bot_key, SimpleNamespace(bot=bot))
+    monkeypatch.setattr(M, "BROADCAST_PAGE", 3)
+    return M.broadcast_create(sid, bot_key, "hi", "", "", len(users))
+
+
+async def _resume_and_wait(M):
+    await M.BROADCASTS.resume()
+    await asyncio.gather(*M.BROADCASTS.tasks.values())
+
+
+def test_resume_continues_after_persisted_cursor(M, monkeypatch):
+    bot = FakeBot()
+    users = list(range(101, 111))
+    job_id = _job(M, monkeypatch, 9101, users, bot)
+    M.broadcast_progress(job_id, 104, 4, 0)  # the previous run got through user 104
+
+    asyncio.run(_resume_and_wait(M))
+
+    assert bot.sent == users[4:]
+    job = M.broadcast_get(job_id)
+    assert job["status"] == "done"
+    assert (job["sent"], job["failed"], job["last_user_id"]) == (10, 0, 110)
+    assert job_id not in M.BROADCASTS.tasks
+
+
+def test_stop_ends_the_job_after_the_current_page(M, monkeypatch):
+    holder = {}
+    bot = FakeBot(on_send=lambda uid: uid == 202 and M.broadcast_finish(holder["id"], "cancelled"))
+    holder["id"] = job_id = _job(M, monkeypatch, 9102, list(range(201, 211)), bot)
+
+    asyncio.run(_resume_and_wait(M))
+
+    assert bot.sent == [201, 202, 203]
+    job = M.broadcast_get(job_id)
+    assert job["status"] == "cancelled" and job["last_user_id"] == 203
+
+
+def test_watchdog_resume_picks_up_a_job_whose_bot_came_back(M, monkeypatch):
+    bot = FakeBot()
+    job_id = _job(M, monkeypatch, 9103, [301, 302], bot)
+    monkeypatch.delitem(M.MANAGER.apps, 9103)
+
+    async def go():
+        await _resume_and_wait(M)  # bot down: the job stays running, nothing sent
+        assert M.broadcast_get(job_id)["status"] == "running" and job_id in M.BROADCASTS._parked
+        M.MANAGER.apps[9103] = SimpleNamespace(bot=bot)
+        await _resume_and_wait(M)
+
+    asyncio.run(go())
+    assert bot.sent == [301, 302]
+    assert M.broadcast_get(job_id)["status"] == "done" and job_id not in M.BROADCASTS._parked
+
+
+def test_crashed_job_reports_paused_and_is_retried(M, monkeypatch):
+    edits = []
+
+    class CrashingBot(FakeBot):
+        async def edit_message_text(self, text, **kw):
+            edits.append(text)
+
+    bot = CrashingBot()
+    job_id = _job(M, monkeypatch, 9104, [401, 402], bot)
+    M.broadcast_set_message(job_id, 1, 1)
+    real = M.broadcast_progress
+    monkeypatch.setattr(M, "broadcast_progress", lambda *a: (_ for _ in ()).throw(RuntimeError("db locked")))
+
+    async def go():
+        await _resume_and_wait(M)
+        assert edits and edits[-1].startswith("⏸") and M.broadcast_get(job_id)["status"] == "running"
+        monkeypatch.setattr(M, "broadcast_progress", real)
+        await _resume_and_wait(M)
+
+    asyncio.run(go())
+    assert M.broadcast_get(job_id)["status"] == "done"
+    assert edits[-1].startswith("✅")
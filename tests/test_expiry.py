@@ -0,0 +1,50 @@
+import asyncio
+
+
+def _seller(M, sid, days):
+    M.upsert_seller_bot(sid, f"{sid}:tok", f"bot{sid}")
+    M.seller_add_days(sid, days)
+
+
+def test_repeated_wakes_keep_one_live_deadline_per_seller(M):
+    async def run():
+        sched = M.ExpiryScheduler()
+        _seller(M, 7001, 10)
+        _seller(M, 7002, 20)
+        await sched._sweep()
+        assert sched.stats()["deadlines"] >= 2
+        before = len(sched._heap)
+        for _ in range(5):
+            await sched._check({7001})
+        assert len(sched._heap) == before  # same deadline: nothing pushed again
+        M.seller_add_days(7001, 1)  # deadline moves: one new entry, the old one goes stale
+        await sched._check({7001})
+        assert len(sched._heap) == before + 1
+        assert sched._next[7001] == int(M.seller_row(7001)["sub_until"])
+        live = [(t, s) for t, s in sched._heap if sched._next.get(s) == t]
+        assert sorted(s for _, s in live) == sorted(sched._next)
+
+    asyncio.run(run())
+
+
+def test_due_deadline_stops_the_bot(M, monkeypatch):
+    stopped = []
+
+    async def run():
+        sched = M.ExpiryScheduler()
+        _seller(M, 7003, 1)
+        await sched._sweep()
+        assert 7003 in sched._next
+        M.db_exec("UPDATE sellers SET sub_until=? WHERE seller_id=?", (M.ts() - 1, 7003))
+        M._SELLER_CACHE.invalidate(7003)
+
+        async def stop(sid):
+            stopped.append(sid)
+            await M.run_db(M.disable_seller_bot, sid)
+
+        monkeypatch.setattr(sched, "_stop", stop)
+        await sched._check({7003})
+        assert 7003 not in sched._next
+
+    asyncio.run(run())
+    assert stopped == [7003]
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+
+def test_tr_miss_on_the_loop_does_not_block(M, monkeypatch):
+    lang = sorted(k for k in M.SUPPORTED_LANGS if k != "en")[0]
+    M.set_user_lang(4242, lang)
+    M._LANG_CACHE.invalidate(4242)  # as if evicted
+    loop_thread = []
+    real = M._LANG_CACHE.loader
+
+    def loader(uid):
+        loop_thread.append(threading.current_thread().name)
+        return real(uid)
+
+    monkeypatch.setattr(M._LANG_CACHE, "loader", loader)
+
+    async def run():
+        first = M.cached_user_lang(4242)
+        for _ in range(100):
+            if M.user_lang_cached(4242):
+                break
+            await asyncio.sleep(0.01)
+        return first, M.cached_user_lang(4242)
+
+    first, second = asyncio.run(run())
+    assert first == "en" and second == lang
+    assert loop_thread and all(name.startswith("db") for name in loop_thread)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def test_language_set_replies_in_the_new_language(M):
+    lang = sorted(k for k in M.SUPPORTED_LANGS if k != "en" and "lang_saved" in M.TRANSLATIONS.get(k, {}))[0]
+    M.set_user_lang(4343, "en")
+    message = FakeMessage()
+
+    async def answer():
+        pass
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=4343),
+                             callback_query=SimpleNamespace(answer=answer, message=message))
+    asyncio.run(M.language_set(update, None, lang))
+    assert message.replies == [M.TRANSLATIONS[lang]["lang_saved"]]
+    assert M.cached_user_lang(4343) == lang
+
+
+def test_menu_cache_key_matches_the_rendered_language(M):
+    lang = sorted(k for k in M.SUPPORTED_LANGS if k != "en" and "btn_products" in M.TRANSLATIONS.get(k, {}))[0]
+    M.set_user_lang(4444, lang)
+    M._LANG_CACHE.invalidate(4444)
+    M._KB_CACHE.clear()
+
+    async def run():
+        return M.master_menu(4444)  # miss on the loop: rendered and keyed as English
+
+    markup = asyncio.run(run())
+    assert markup.inline_keyboard[0][0].text == M.tr_lang("en", "btn_products")
+    assert M._KB_CACHE.get(("master", "en", M.is_super(4444))) is markup
+    assert M._KB_CACHE.get(("master", lang, M.is_super(4444))) is None
@@ -0,0 +1,39 @@
+def _tables(M):
+    conn = M.db()
+    names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table','index')")}
+    conn.close()
+    return names
+
+
+def test_fresh_db_applies_every_step(M, fresh_steps):
+    assert fresh_steps == len(M.MIGRATIONS)
+    conn = M.db()
+    assert M.schema_version(conn.cursor()) == M.SCHEMA_VERSION
+    conn.close()
+    names = _tables(M)
+    assert {"products", "broadcast_jobs", "user_state", "idx_product_keys_stock", "idx_broadcast_jobs_status"} <= names
+
+
+def test_at_version_db_is_a_no_op(M):
+    assert M.migrate() == 0
+
+
+def test_behind_db_applies_only_missing_steps(M):
+    # roll the DB back to just before the user_state step
+    since = next(v for v, name, _ in M.MIGRATIONS if name == "user_state")
+    conn = M.db()
+    conn.execute("DROP TABLE user_state")
+    conn.execute("DELETE FROM schema_version WHERE version>=?", (since,))
+    conn.commit()
+    conn.close()
+    assert "user_state" not in _tables(M)
+    assert M.migrate() == M.SCHEMA_VERSION - since + 1
+    assert "user_state" in _tables(M)
+    assert M.migrate() == 0
+
+
+def test_hot_queries_use_indexes(M):
+    plans = M.explain_hot_queries()
+    assert {"catalog_cats", "catalog_cocats", "catalog_prods"} <= set(plans)
+    for name, steps in plans.items():
+        assert not any("TEMP B-TREE" in st for st in steps), (name, steps)
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+class FakeUpdater:
+    def __init__(self, fail=0):
+        self.running = False
+        self.calls = []
+        self.fail = fail
+
+    async def start_polling(self, **kw):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("network down")
+        self.calls.append((kw["poll_interval"], kw["timeout"]))
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+
+def _manager(M, key, updater):
+    mgr = M.BotManager()
+    mgr.apps[key] = SimpleNamespace(updater=updater)
+    mgr.polling[key] = M.PollState()
+    return mgr
+
+
+def test_quiet_bots_move_to_longer_polls_and_wake_on_update(M):
+    async def go():
+        up = FakeUpdater()
+        mgr = _manager(M, 1, up)
+        st = mgr.polling[1]
+        await mgr._poll(1, mgr.apps[1], "active")
+
+        st.last_update = time.time() - M.POLL_IDLE_AFTER - 1
+        await mgr.tune_polling()
+        assert st.mode == "idle" and up.calls[-1] == M.POLL_PROFILES["idle"]
+
+        st.last_update = time.time() - M.POLL_PARK_AFTER - 1
+        await mgr.tune_polling()
+        assert st.mode == "parked" and up.calls[-1] == M.POLL_PROFILES["parked"]
+        assert mgr.polling_stats()["parked"] == 1
+
+        mgr.note_update(1)
+        mgr.note_update(1)  # one wake-up at a time
+        await asyncio.gather(*[t for t in M.BACKGROUND_TASKS if t.get_name() == "repoll:1"])
+        assert st.mode == "active" and up.calls[-1] == M.POLL_PROFILES["active"]
+        assert len(up.calls) == 4
+
+    asyncio.run(go())
+
+
+def test_failed_start_backs_off_then_retries(M):
+    async def go():
+        up = FakeUpdater(fail=1)
+        mgr = _manager(M, 2, up)
+        st = mgr.polling[2]
+        await mgr._poll(2, mgr.apps[2], "active")
+        assert st.errors == 1 and st.retry_at > time.time()
+        assert mgr.polling_stats()["retrying"] == 1
+
+        await mgr.tune_polling()  # backoff not over yet
+        assert not up.calls
+
+        st.retry_at = time.time() - 1
+        await mgr.tune_polling()
+        assert up.calls == [M.POLL_PROFILES["active"]] and st.retry_at == 0.0
+
+    asyncio.run(go())
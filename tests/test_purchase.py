@@ -0,0 +1,123 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+_SHOPS = itertools.count(1000)
+
+
+@pytest.fixture
+def shop(M):
+    sid = next(_SHOPS)
+    cat = M.cat_add(sid, "Cat")
+    pid = M.prod_add(sid, cat, 0, "Prod", 2.0)
+    return sid, pid
+
+
+def _available(M, sid, pid):
+    return M.stock_count(sid, pid)
+
+
+def test_missing_product(M, shop):
+    sid, _ = shop
+    assert M.purchase(sid, 5, 999999, 1)["status"] == "missing"
+
+
+def test_not_enough_stock(M, shop):
+    sid, pid = shop
+    M.add_keys(sid, pid, ["a"])
+    M.add_balance(sid, 5, 100)
+    assert M.purchase(sid, 5, pid, 2)["status"] == "stock"
+    assert _available(M, sid, pid) == 1
+    assert M.get_balance(sid, 5) == 100
+
+
+def test_not_enough_balance(M, shop):
+    sid, pid = shop
+    M.add_keys(sid, pid, ["a", "b"])
+    M.add_balance(sid, 5, 3)
+    res = M.purchase(sid, 5, pid, 2)
+    assert res["status"] == "balance" and res["balance"] == 3
+    assert _available(M, sid, pid) == 2
+
+
+def test_ok_claims_keys_and_moves_the_counter(M, shop):
+    sid, pid = shop
+    M.add_keys(sid, pid, ["a", "b", "c"])
+    M.add_balance(sid, 5, 10)
+    res = M.purchase(sid, 5, pid, 2)
+    assert res["status"] == "ok"
+    assert res["keys"] == ["a", "b"] and res["total"] == 4.0 and res["order_id"]
+    assert _available(M, sid, pid) == 1
+    assert M.get_balance(sid, 5) == 6
+    assert M.purchase(sid, 5, pid, 1)["keys"] == ["c"]
+    assert _available(M, sid, pid) == 0
+
+
+def test_drifted_counter_returns_stock_and_is_corrected(M, shop):
+    sid, pid = shop
+    M.add_keys(sid, pid, ["a"])
+    M.add_balance(sid, 5, 10)
+    M.db_exec("UPDATE products SET available_count=5 WHERE shop_owner_id=? AND id=?", (sid, pid))
+    assert M.purchase(sid, 5, pid, 3)["status"] == "stock"
+    assert _available(M, sid, pid) == 1
+    assert M.get_balance(sid, 5) == 10
+    # the key put back is still sellable
+    assert M.purchase(sid, 5, pid, 1)["keys"] == ["a"]
+
+
+def test_category_delete_removes_product_keys(M):
+    sid = next(_SHOPS)
+    cat = M.cat_add(sid, "Cat")
+    sub = M.cocat_add(sid, cat, "Sub")
+    direct = M.prod_add(sid, cat, 0, "Direct", 1.0)
+    nested = M.prod_add(sid, cat, sub, "Nested", 1.0)
+    M.add_keys(sid, direct, ["a"])
+    M.add_keys(sid, nested, ["b", "c"])
+    M.cocat_delete(sid, sub)
+    assert M.count_product_keys(sid, nested) == 0
+    assert M.count_product_keys(sid, direct) == 1
+    M.cat_delete(sid, cat)
+    assert M.count_product_keys(sid, direct) == 0
+
+
+class _Card:
+    chat_id, message_id, photo, video = 5, 77, None, None
+
+
+def test_legacy_buy_button_reshows_the_card_instead_of_buying(M, shop, monkeypatch):
+    sid, pid = shop
+    M.add_keys(sid, pid, ["a", "b", "c", "d"])
+    M.add_balance(sid, 5, 100)
+    edits, answers = [], []
+
+    async def answer(*args, **kwargs):
+        answers.append(args)
+
+    async def edit(text, **kwargs):
+        edits.append((text, kwargs["reply_markup"]))
+
+    monkeypatch.setattr(M, "current_shop_id", lambda context: sid)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=5),
+                             callback_query=SimpleNamespace(answer=answer, message=_Card()))
+    context = SimpleNamespace(user_data={f"qty_{sid}_{pid}": 3}, bot=SimpleNamespace(edit_message_text=edit))
+    asyncio.run(M.product_legacy_card(update, context, pid))
+
+    assert M.get_balance(sid, 5) == 100 and _available(M, sid, pid) == 4
+    assert f"qty_{sid}_{pid}" not in context.user_data
+    text, markup = edits[0]
+    assert "Qty: <b>3</b>" in text
+    assert any(b.callback_data == f"p:buy:{pid}:3" for row in markup.inline_keyboard for b in row)
+
+
+def test_reconcile_stock_fixes_only_drifted_products(M, shop):
+    sid, pid = shop
+    other = M.prod_add(sid, M.cat_add(sid, "Cat2"), 0, "Other", 1.0)
+    M.add_keys(sid, pid, ["a", "b"])
+    M.add_keys(sid, other, ["c"])
+    M.db_exec("UPDATE products SET available_count=7 WHERE shop_owner_id=? AND id=?", (sid, pid))
+    fixed = [f for f in M.reconcile_stock() if f[0] == sid]
+    assert fixed == [(sid, pid, 7, 2)]
+    assert _available(M, sid, pid) == 2 and _available(M, sid, other) == 1
+    assert not [f for f in M.reconcile_stock() if f[0] == sid]
@@ -0,0 +1,56 @@
+import pytest
+
+
+def _router(M):
+    r = M.CallbackRouter(M.RouteStats())
+    r.add("p:prod:{pid:int}", "view")
+    r.add("p:q:{pid:int}:{qty:int}", "qty")
+    r.add("p:buy:{pid:int}:{qty:int}", "buy_qty")
+    r.add("p:buy:{pid:int}", "buy")
+    r.add("p:q:+:{pid:int}", "legacy", step=1)
+    r.add("sa:act:{act}:{sid:int}", "act", days=0)
+    r.add("ui:{key:rest}", "ui")
+    r.add("m:menu", "menu")
+    return r
+
+
+def test_typed_args_are_parsed(M):
+    r = _router(M)
+    assert r.match("p:prod:12") == ("p:prod:{pid:int}", "view", {"pid": 12})
+    assert r.match("p:q:12:3")[2] == {"pid": 12, "qty": 3}
+    assert r.match("sa:act:ban:7") == ("sa:act:{act}:{sid:int}", "act", {"days": 0, "act": "ban", "sid": 7})
+
+
+def test_arity_selects_between_routes_on_one_prefix(M):
+    r = _router(M)
+    assert r.match("p:buy:4")[1] == "buy"
+    assert r.match("p:buy:4:2")[1] == "buy_qty"
+
+
+def test_literal_segment_wins_over_typed_args(M):
+    assert _router(M).match("p:q:+:5") == ("p:q:+:{pid:int}", "legacy", {"step": 1, "pid": 5})
+
+
+def test_legacy_card_buttons_are_routed(M):
+    for data in ("p:q:+:5", "p:q:-:5", "p:buy:5"):
+        assert M.ROUTER.match(data)[1] is M.product_legacy_card
+    assert M.ROUTER.match("p:buy:5:2")[1] is M.product_buy
+
+
+def test_rest_keeps_colons(M):
+    assert _router(M).match("ui:a:b:c")[2] == {"key": "a:b:c"}
+
+
+@pytest.mark.parametrize("data", ["p:prod:x", "p:q:*:5", "p:prod", "p:prod:1:2", "nope", "", "m:menu:extra"])
+def test_non_matching_data(M, data):
+    assert _router(M).match(data) is None
+
+
+def test_literal_match(M):
+    assert _router(M).match("m:menu") == ("m:menu", "menu", {})
+
+
+@pytest.mark.parametrize("pattern", ["a:{x:float}", "a:{x}:lit", "a:{x:rest}:{y}"])
+def test_bad_patterns_are_rejected(M, pattern):
+    with pytest.raises(ValueError):
+        M.CallbackRouter(M.RouteStats()).add(pattern, None)
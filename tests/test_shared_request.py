@@ -0,0 +1,38 @@
+import asyncio
+
+
+def test_bots_share_one_client_per_pool_until_aclose_all(M):
+    async def run():
+        a = M.SharedRequest("test-pool", 2, 4, 2)
+        b = M.SharedRequest("test-pool", 2, 4, 2)
+        other = M.SharedRequest("test-other", 1, None, None)
+        assert a._client is b._client
+        assert other._client is not a._client
+        await a.shutdown()  # one bot stopping must not close the shared client
+        assert not b._client.is_closed
+        client = a._client
+        await M.SharedRequest.aclose_all()
+        assert client.is_closed and other._client.is_closed
+        assert M.SharedRequest._clients == {}
+
+    asyncio.run(run())
+
+
+def test_per_bot_cap_limits_in_flight_requests(M, monkeypatch):
+    async def run():
+        req = M.SharedRequest("test-cap", 2, 4, 2)
+        state = {"now": 0, "peak": 0}
+
+        async def fake(self, *args, **kwargs):
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+            await asyncio.sleep(0.01)
+            state["now"] -= 1
+            return 200, b"{}"
+
+        monkeypatch.setattr(M.HTTPXRequest, "do_request", fake)
+        await asyncio.gather(*(req.do_request("u", "POST") for _ in range(6)))
+        await M.SharedRequest.aclose_all()
+        return state["peak"]
+
+    assert asyncio.run(run()) == 2
@@ -0,0 +1,47 @@
+def _racing_cache(M, during_load):
+    """Cache whose loader runs `during_load` once, mid-load, to simulate a concurrent writer."""
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        if len(calls) == 1:
+            during_load(cache)
+        return f"v{len(calls)}"
+
+    cache = M.SnapshotCache(8, loader)
+    return cache, calls
+
+
+def test_invalidate_during_load_is_not_cached(M):
+    cache, calls = _racing_cache(M, lambda c: c.invalidate("k"))
+    assert cache.get("k") == "v1"
+    assert "k" not in cache
+    assert cache.get("k") == "v2"
+    assert cache.get("k") == "v2" and len(calls) == 2
+
+
+def test_clear_during_load_of_unseen_key_is_not_cached(M):
+    cache, calls = _racing_cache(M, lambda c: c.clear())
+    assert cache.get("fresh") == "v1"
+    assert "fresh" not in cache
+
+
+def test_generations_do_not_outlive_loads(M):
+    cache = M.SnapshotCache(4, lambda k: k * 2)
+    for k in range(100):
+        cache.get(k)
+        cache.invalidate(k)
+    cache.clear()
+    assert cache._gen == {}
+
+
+def test_failed_load_drops_its_generation(M):
+    def loader(key):
+        raise RuntimeError("db down")
+
+    cache = M.SnapshotCache(4, loader)
+    try:
+        cache.get("k")
+    except RuntimeError:
+        pass
+    assert cache._gen == {} and "k" not in cache
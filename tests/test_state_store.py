@@ -0,0 +1,134 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+def _ctx(user_data):
+    return SimpleNamespace(user_data=user_data)
+
+
+def test_marked_users_are_flushed_in_one_batch_and_reloaded(M, monkeypatch):
+    batches = []
+    real_save = M.user_state_save
+    monkeypatch.setattr(M, "user_state_save", lambda rows: batches.append(list(rows)) or real_save(rows))
+    store = M.StateStore()
+
+    async def go():
+        a, b = {}, {}
+        await store.load(a, 9201, 1)
+        await store.load(b, 9201, 2)
+        a["state"], a["state_data"] = "deposit", {"amount": 5}
+        store.mark(_ctx(a))
+        b["lang"] = "en"
+        b["__scratch"] = object()  # memory-only key
+        store.mark(_ctx(b))
+        store.mark(_ctx(b))
+        assert store.stats()["dirty"] == 2
+        assert await store.flush() == 2
+        assert await store.flush() == 0
+
+        fresh = {}
+        await M.StateStore().load(fresh, 9201, 2)
+        return fresh
+
+    fresh = asyncio.run(go())
+    assert len(batches) == 1 and len(batches[0]) == 2
+    assert fresh == {"__key": (9201, 2), "lang": "en"}
+    assert store.stats()["flushed"] == 2
+
+
+def test_non_json_values_are_skipped(M):
+    store = M.StateStore()
+
+    async def go():
+        ud = {}
+        await store.load(ud, 9202, 1)
+        ud["ok"] = [1, 2]
+        ud["bad"] = {1, 2}
+        store.mark(_ctx(ud))
+        await store.flush()
+        reloaded = {}
+        await M.StateStore().load(reloaded, 9202, 1)
+        return reloaded
+
+    assert asyncio.run(go()) == {"__key": (9202, 1), "ok": [1, 2]}
+    assert store.skipped == 1
+
+
+def test_failed_flush_keeps_users_dirty(M, monkeypatch):
+    store = M.StateStore()
+
+    def fail(rows):
+        raise RuntimeError("disk full")
+
+    async def go():
+        ud = {}
+        await store.load(ud, 9203, 1)
+        ud["x"] = 1
+        store.mark(_ctx(ud))
+        monkeypatch.setattr(M, "user_state_save", fail)
+        with pytest.raises(RuntimeError):
+            await store.flush()
+        assert store.stats()["dirty"] == 1
+        monkeypatch.undo()
+        assert await store.flush() == 1
+
+    asyncio.run(go())
+
+
+def test_failed_load_does_not_overwrite_the_saved_row(M, monkeypatch):
+    store = M.StateStore()
+
+    async def go():
+        ud = {}
+        await store.load(ud, 9204, 1)
+        ud["state"], ud["state_data"] = "deposit", {"amount": 5}
+        store.mark(_ctx(ud))
+        await store.flush()
+
+        def busy(*args):
+            raise RuntimeError("database is locked")
+
+        other = M.StateStore()
+        fresh = {}
+        monkeypatch.setattr(M, "user_state_load", busy)
+        with pytest.raises(RuntimeError):
+            await other.load(fresh, 9204, 1)
+        # later handler groups still run with the empty dict
+        M.clear_state(_ctx(fresh))
+        assert await other.flush() == 0
+        monkeypatch.undo()
+        await other.load(fresh, 9204, 1)  # the next update retries
+        return fresh
+
+    assert asyncio.run(go()) == {"__key": (9204, 1), "state": "deposit", "state_data": {"amount": 5}}
+
+
+def test_concurrent_loads_of_one_user_wait_for_the_first(M, monkeypatch):
+    store = M.StateStore()
+    calls = []
+    real = M.user_state_load
+
+    def slow(*args):
+        calls.append(args)
+        time.sleep(0.05)
+        return real(*args)
+
+    async def go():
+        ud = {}
+        await store.load(ud, 9205, 1)
+        ud["x"] = 1
+        store.mark(_ctx(ud))
+        await store.flush()
+
+        monkeypatch.setattr(M, "user_state_load", slow)
+        shared = {}
+        other = M.StateStore()
+        await asyncio.gather(other.load(shared, 9205, 1), other.load(shared, 9205, 1))
+        assert not other._loading
+        return shared
+
+    assert asyncio.run(go()) == {"__key": (9205, 1), "x": 1}
+    assert len(calls) == 1
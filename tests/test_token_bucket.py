@@ -0,0 +1,34 @@
+import asyncio
+
+
+def test_transactional_overtakes_waiting_bulk(M):
+    async def run():
+        bucket = M.TokenBucket(20, 1)
+        order = []
+
+        async def take(tag, bulk):
+            await bucket.acquire(bulk)
+            order.append(tag)
+
+        await bucket.acquire(True)  # drain the burst
+        tasks = [asyncio.create_task(take(f"bulk{i}", True)) for i in range(3)]
+        await asyncio.sleep(0.01)  # bulk callers are now waiting for the next token
+        tasks.append(asyncio.create_task(take("tx", False)))
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert order[0] == "tx"
+    assert sorted(order[1:]) == ["bulk0", "bulk1", "bulk2"]
+
+
+def test_pause_holds_every_caller(M):
+    async def run():
+        bucket = M.TokenBucket(1000, 10)
+        bucket.pause(0.2)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        await bucket.acquire()
+        return loop.time() - t0
+
+    assert asyncio.run(run()) >= 0.18
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+
+def _user(uid, username="alice"):
+    return SimpleNamespace(id=uid, username=username, first_name="A", last_name=None)
+
+
+def test_profile_written_once_until_it_changes(M, monkeypatch):
+    writes = []
+    real = M.db_exec
+    monkeypatch.setattr(M, "db_exec", lambda sql, params=(): writes.append(params) or real(sql, params))
+    u = _user(8101)
+    prof = M.user_profile_stale(u)
+    assert prof == ("alice", "A", "")
+    M.upsert_user(u, prof)
+    assert M.user_profile_stale(u) is None
+    M.upsert_user(u)
+    assert len(writes) == 1
+    renamed = _user(8101, "alice2")
+    M.upsert_user(renamed, M.user_profile_stale(renamed))
+    assert len(writes) == 2
+    assert M.user_row(8101)["username"] == "alice2"
+
+
+def test_one_cache_read_per_update(M, monkeypatch):
+    reads = []
+    real_get = M._USER_CACHE.get
+    monkeypatch.setattr(M._USER_CACHE, "get", lambda k, d=None: reads.append(k) or real_get(k, d))
+    u = _user(8102)
+    prof = M.user_profile_stale(u)
+    M.upsert_user(u, prof)
+    assert reads == [8102]
@@ -0,0 +1,103 @@
+import asyncio
+
+from telegram import Bot
+
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "hi"}}
+
+
+class SlowApp:
+    """Stands in for an Application: one fetcher drains update_queue one update at a time."""
+    def __init__(self):
+        self.bot = Bot("1:test")
+        self.update_queue = asyncio.Queue()
+        self.release = asyncio.Event()
+        self.seen = []
+        self.done = []
+        self.fetcher = asyncio.ensure_future(self._fetch())
+
+    async def _fetch(self):
+        while True:
+            update = await self.update_queue.get()
+            self.seen.append(update.update_id)
+            await self.release.wait()
+            self.done.append(update.update_id)
+
+
+async def _serve(M, backlog=4):
+    srv = M.WebhookServer("sekret", backlog)
+    await srv.start("127.0.0.1", 0)
+    return srv, srv._server.sockets[0].getsockname()[1]
+
+
+def test_acknowledges_before_processing_finishes(M):
+    async def go():
+        srv, port = await _serve(M)
+        app = srv.apps[7] = SlowApp()
+        try:
+            code = await asyncio.wait_for(M.fake_telegram_post(7, UPDATE, port=port, secret="sekret"), 5)
+            assert code == 200
+            await asyncio.sleep(0)
+            assert app.seen == [1] and app.done == []
+            app.release.set()
+            await asyncio.sleep(0)
+            assert app.done == [1]
+        finally:
+            app.fetcher.cancel()
+            await srv.stop()
+
+    asyncio.run(go())
+
+
+def test_rejects_bad_secret_and_unknown_bot(M):
+    async def go():
+        srv, port = await _serve(M)
+        app = srv.apps[7] = SlowApp()
+        try:
+            assert await M.fake_telegram_post(7, UPDATE, port=port, secret="wrong") == 404
+            assert await M.fake_telegram_post(8, UPDATE, port=port, secret="sekret") == 404
+        finally:
+            app.fetcher.cancel()
+            await srv.stop()
+
+    asyncio.run(go())
+
+
+def test_updates_of_one_bot_are_processed_one_at_a_time_in_order(M):
+    async def go():
+        srv, port = await _serve(M)
+        app = srv.apps[7] = SlowApp()
+        try:
+            for i in (1, 2, 3):
+                assert await M.fake_telegram_post(7, dict(UPDATE, update_id=i), port=port, secret="sekret") == 200
+            await asyncio.sleep(0.05)
+            assert app.seen == [1] and app.update_queue.qsize() == 2
+            app.release.set()
+            await asyncio.sleep(0.05)
+            assert app.done == [1, 2, 3]
+        finally:
+            app.fetcher.cancel()
+            await srv.stop()
+
+    asyncio.run(go())
+
+
+def test_full_backlog_holds_the_reply_until_the_queue_drains(M):
+    async def go():
+        srv, port = await _serve(M, backlog=1)
+        app = srv.apps[7] = SlowApp()
+        try:
+            assert await M.fake_telegram_post(7, UPDATE, port=port, secret="sekret") == 200
+            await asyncio.sleep(0.05)  # 1 is being processed, the queue is empty again
+            assert await M.fake_telegram_post(7, dict(UPDATE, update_id=2), port=port, secret="sekret") == 200
+            third = asyncio.ensure_future(M.fake_telegram_post(7, dict(UPDATE, update_id=3), port=port, secret="sekret"))
+            await asyncio.sleep(0.2)
+            assert not third.done()
+            app.release.set()
+            assert await asyncio.wait_for(third, 5) == 200
+            await asyncio.sleep(0.05)
+            assert app.done == [1, 2, 3]
+        finally:
+            app.fetcher.cancel()
+            await srv.stop()
+
+    asyncio.run(go())